@@ -0,0 +1,99 @@
+"""
+Benchmark the group and permission attribute callbacks.
+
+Compares iterating ``user.groups.all()`` and ``get_all_permissions()``
+against the built-in callbacks, uncached and cached, for a user in many
+groups. Run from the repository root:
+
+    python benchmarks/bench_groups.py --groups 5000
+"""
+import argparse
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'mama_cas.tests.settings')
+
+import django  # noqa: E402
+django.setup()
+
+from django.contrib.auth import get_user_model  # noqa: E402
+from django.contrib.auth.models import Group  # noqa: E402
+from django.contrib.auth.models import Permission  # noqa: E402
+from django.core.management import call_command  # noqa: E402
+from django.db import connection  # noqa: E402
+from django.test.utils import CaptureQueriesContext  # noqa: E402
+from django.test.utils import override_settings  # noqa: E402
+
+from mama_cas.callbacks import user_group_attributes  # noqa: E402
+from mama_cas.callbacks import user_permission_attributes  # noqa: E402
+from mama_cas.utils import get_cache  # noqa: E402
+
+
+def create_user(groups):
+    """Create a user belonging to ``groups`` groups, each with a permission."""
+    user = get_user_model().objects.create_user('ellen')
+    Group.objects.bulk_create([Group(name='group%05d' % i) for i in range(groups)])
+    groups = list(Group.objects.all())
+    permissions = list(Permission.objects.all())
+    Group.permissions.through.objects.bulk_create([
+        Group.permissions.through(group=group, permission=permissions[i % len(permissions)])
+        for i, group in enumerate(groups)
+    ])
+    user.groups.add(*groups)
+    return get_user_model().objects.get(pk=user.pk)
+
+
+def measure(fn, repeat, clear=False):
+    """Return the median time of ``fn`` and the queries made by one call."""
+    timings = []
+    for _ in range(repeat):
+        if clear:
+            get_cache().clear()
+        start = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - start)
+    if clear:
+        get_cache().clear()
+    with CaptureQueriesContext(connection) as queries:
+        fn()
+    return statistics.median(timings), len(queries)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--groups', type=int, default=5000)
+    parser.add_argument('--repeat', type=int, default=50)
+    args = parser.parse_args()
+
+    call_command('migrate', run_syncdb=True, verbosity=0)
+    user = create_user(args.groups)
+    service = 'https://www.example.com/'
+
+    def model_groups():
+        return [group.name for group in user.groups.all()]
+
+    def model_permissions():
+        # Bypass the per-instance permission cache of ModelBackend
+        return get_user_model().objects.get(pk=user.pk).get_all_permissions()
+
+    cases = [
+        ('groups: model instances', model_groups, False),
+        ('groups: uncached', lambda: user_group_attributes(user, service), True),
+        ('groups: cached', lambda: user_group_attributes(user, service), False),
+        ('permissions: get_all_permissions', model_permissions, False),
+        ('permissions: uncached', lambda: user_permission_attributes(user, service), True),
+        ('permissions: cached', lambda: user_permission_attributes(user, service), False),
+    ]
+
+    print('groups: %d' % args.groups)
+    with override_settings(MAMA_CAS_GROUP_CACHE_TIMEOUT=3600):
+        for name, fn, clear in cases:
+            median, queries = measure(fn, args.repeat, clear=clear)
+            print('%-34s %9.2f ms  %d queries' % (name + ':', median * 1000, queries))
+
+
+if __name__ == '__main__':
+    main()
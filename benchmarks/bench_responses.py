@@ -0,0 +1,69 @@
+"""
+Benchmark rendering validation responses in XML and JSON format.
+
+Renders a validation success with a proxy-granting ticket, proxies and
+attribute sets of increasing size. Run from the repository root:
+
+    python benchmarks/bench_responses.py --values 0 10 1000
+"""
+import argparse
+import os
+import statistics
+import sys
+import time
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'mama_cas.tests.settings')
+
+import django  # noqa: E402
+django.setup()
+
+from mama_cas.response import JsonValidationResponse  # noqa: E402
+from mama_cas.response import ValidationResponse  # noqa: E402
+
+
+def build_context(values):
+    """
+    Return a validation success context with ``values`` attribute
+    values, split between single-valued and multi-valued attributes.
+    """
+    user = SimpleNamespace(get_username=lambda: 'ellen')
+    attributes = {}
+    for i in range(min(values, 10)):
+        attributes['attribute%d' % i] = 'value <%d> & "more"' % i
+    if values > 10:
+        attributes['memberOf'] = ['cn=group%d,ou=groups,dc=example,dc=com' % i for i in range(values - 10)]
+    return {
+        'ticket': SimpleNamespace(user=user),
+        'pgt': SimpleNamespace(iou='PGTIOU-1856392-b98xZrQN4p90ASrw96c8'),
+        'proxies': ['https://proxy2/pgtUrl', 'https://proxy1/pgtUrl'],
+        'attributes': attributes,
+        'error': None,
+    }
+
+
+def measure(response_class, context, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        response = response_class(context)
+        timings.append(time.perf_counter() - start)
+    return statistics.median(timings), len(response.content)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--values', type=int, nargs='+', default=[0, 10, 1000])
+    parser.add_argument('--repeat', type=int, default=500)
+    args = parser.parse_args()
+
+    for values in args.values:
+        context = build_context(values)
+        for name, response_class in (('xml', ValidationResponse), ('json', JsonValidationResponse)):
+            median, size = measure(response_class, context, args.repeat)
+            print('%5d values %-5s %9.1f us  %7d bytes' % (values, name + ':', median * 1e6, size))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,120 @@
+"""
+Benchmark ``FileBackend`` against a synthetic service registry.
+
+Measures the time to load and compile a registry, the memory used per
+entry, and the latency of service lookups, compared with testing each
+regular expression in turn. Run from the repository root:
+
+    python benchmarks/bench_services.py --entries 50000
+    python benchmarks/bench_services.py --entries 3000 --regex-only
+"""
+import argparse
+import json
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'mama_cas.tests.settings')
+
+import django  # noqa: E402
+django.setup()
+
+from django.test.utils import override_settings  # noqa: E402
+
+from mama_cas.services.backends import FileBackend  # noqa: E402
+
+
+def generate_registry(entries, regex_only=False, seed=0):
+    """
+    Return a list of service definitions mixing exact URLs, exact and
+    wildcard hosts and regular expressions, along with sample services
+    matching them.
+    """
+    rng = random.Random(seed)
+    definitions = []
+    samples = []
+    for i in range(entries):
+        kind = 1 if regex_only else rng.random()
+        domain = 'app%d.example%d.com' % (i, i % 97)
+        if kind < 0.4:
+            definitions.append({'URL': 'https://%s/login' % domain})
+            samples.append('https://%s/login?next=/' % domain)
+        elif kind < 0.7:
+            definitions.append({'HOST': domain, 'SCHEME': 'https'})
+            samples.append('https://%s/path' % domain)
+        elif kind < 0.9:
+            definitions.append({'HOST': '*.%s' % domain})
+            samples.append('https://www.%s/' % domain)
+        else:
+            definitions.append({'SERVICE': r'^https://%s/.*' % domain.replace('.', r'\.')})
+            samples.append('https://%s/app' % domain)
+    return definitions, samples
+
+
+def linear_scan(config, service):
+    """Return the first service matched by testing every pattern in turn."""
+    for i, definition in config.matcher.regex_services:
+        if definition['MATCH'].match(service):
+            return definition
+    return None
+
+
+def time_lookups(fn, samples, lookups):
+    """Return the sorted timings of ``fn`` over a mix of hits and misses."""
+    rng = random.Random(1)
+    misses = ['https://unknown%d.example.net/' % i for i in range(100)]
+    timings = []
+    for _ in range(lookups):
+        service = rng.choice(samples) if rng.random() < 0.9 else rng.choice(misses)
+        start = time.perf_counter()
+        fn(service)
+        timings.append(time.perf_counter() - start)
+    timings.sort()
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--entries', type=int, default=20000)
+    parser.add_argument('--lookups', type=int, default=20000)
+    parser.add_argument('--regex-only', action='store_true', help='use only SERVICE regular expressions')
+    args = parser.parse_args()
+
+    definitions, samples = generate_registry(args.entries, regex_only=args.regex_only)
+    fd, path = tempfile.mkstemp(suffix='.json')
+    with os.fdopen(fd, 'w') as f:
+        json.dump(definitions, f)
+
+    try:
+        with override_settings(MAMA_CAS_SERVICES_FILE=path, MAMA_CAS_SERVICE_RELOAD_INTERVAL=3600):
+            backend = FileBackend()
+
+            tracemalloc.start()
+            start = time.perf_counter()
+            config = backend.get_service_config()
+            load = time.perf_counter() - start
+            size, _ = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+
+            timings = time_lookups(backend.service_allowed, samples, args.lookups)
+            scan = time_lookups(lambda service: linear_scan(config, service), samples, args.lookups)
+    finally:
+        FileBackend.reset()
+        os.remove(path)
+
+    print('entries:          %d (%d regular expressions)' % (args.entries, len(config.matcher.regex_services)))
+    print('load:             %.1f ms' % (load * 1000))
+    print('memory per entry: %.0f bytes' % (size / args.entries))
+    print('lookup median:    %.1f us' % (statistics.median(timings) * 1e6))
+    print('lookup p99:       %.1f us' % (timings[int(len(timings) * 0.99)] * 1e6))
+    print('scan median:      %.1f us' % (statistics.median(scan) * 1e6))
+    print('scan p99:         %.1f us' % (scan[int(len(scan) * 0.99)] * 1e6))
+
+
+if __name__ == '__main__':
+    main()
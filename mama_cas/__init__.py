@@ -1,2 +1,11 @@
 __version_info__ = (2, 5, 0)
 __version__ = '.'.join([str(v) for v in __version_info__])
+
+try:
+    import django
+except ImportError:  # pragma: no cover
+    # The version is read by setup.py, possibly without Django installed
+    pass
+else:
+    if django.VERSION < (3, 2):
+        default_app_config = 'mama_cas.apps.MamaCasConfig'
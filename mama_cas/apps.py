@@ -0,0 +1,10 @@
+from django.apps import AppConfig
+from django.contrib.auth import get_user_model
+
+
+class MamaCasConfig(AppConfig):
+    name = 'mama_cas'
+
+    def ready(self):
+        from mama_cas.models import connect_user_signals
+        connect_user_signals(get_user_model())
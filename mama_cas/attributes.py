@@ -0,0 +1,515 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+import hashlib
+import inspect
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.db import close_old_connections
+from django.db import connections
+from django.utils.encoding import force_bytes
+
+from mama_cas.exceptions import InternalError
+from mama_cas.exceptions import ValidationError
+from mama_cas.services import get_service_context
+from mama_cas.utils import get_cache
+
+
+logger = logging.getLogger(__name__)
+
+FAILURE_POLICIES = ('fail', 'omit', 'cached')
+
+_executor = None
+_refresh_executor = None
+_executor_lock = threading.Lock()
+_refresh_lock = threading.Lock()
+_refreshing = set()
+_breakers = {}
+
+
+def get_changed_key(user):
+    return 'mama_cas:attributes:changed:%s' % user.pk
+
+
+def get_recent_key(user):
+    return 'mama_cas:attributes:recent:%s' % user.pk
+
+
+def get_cache_key(user, path):
+    digest = hashlib.sha256(force_bytes(path)).hexdigest()
+    return 'mama_cas:attributes:%s:%s' % (user.pk, digest)
+
+
+def is_cacheable(callback):
+    """Return whether a callback permits its results to be cached."""
+    return getattr(callback, 'cacheable', True)
+
+
+def is_released(callback, release):
+    """
+    Return whether a callback may provide any of the released attribute
+    names, according to its ``provides`` attribute, if declared.
+    """
+    provides = getattr(callback, 'provides', None)
+    return provides is None or not release.isdisjoint(provides)
+
+
+def get_batch(callback):
+    """
+    Return a callback's batch form, declared with a ``many`` attribute,
+    which is called as ``many(users, service)`` and returns a dictionary
+    of results keyed by user primary key.
+    """
+    return getattr(callback, 'many', None)
+
+
+def get_timeout(callback):
+    return getattr(callback, 'timeout', getattr(settings, 'MAMA_CAS_ATTRIBUTE_TIMEOUT', None))
+
+
+def get_failure_policy(callback):
+    policy = getattr(callback, 'failure_policy', getattr(settings, 'MAMA_CAS_ATTRIBUTE_FAILURE_POLICY', 'fail'))
+    if policy not in FAILURE_POLICIES:
+        raise ValueError("Unknown attribute callback failure policy: %s" % policy)
+    return policy
+
+
+def invalidate_attributes(*users):
+    """
+    Invalidate all cached attributes for the given users. Entries
+    computed before this time are treated as missing.
+    """
+    changed = time.time()
+    get_cache().set_many(dict((get_changed_key(user), changed) for user in users), None)
+
+
+class CircuitBreaker(object):
+    """
+    Track consecutive failures of a callback. After
+    ``MAMA_CAS_ATTRIBUTE_BREAKER_THRESHOLD`` failures the breaker opens
+    and the callback is not called for ``MAMA_CAS_ATTRIBUTE_BREAKER_RESET``
+    seconds, after which a single trial call is allowed through. A
+    successful call closes the breaker.
+    """
+    def __init__(self):
+        self.failures = 0
+        self.opened = None
+        self._lock = threading.Lock()
+
+    def allow(self):
+        with self._lock:
+            if self.opened is None:
+                return True
+            reset = getattr(settings, 'MAMA_CAS_ATTRIBUTE_BREAKER_RESET', 30)
+            if time.monotonic() - self.opened >= reset:
+                # Hold the breaker open for other callers during the trial
+                self.opened = time.monotonic()
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened = None
+
+    def record_failure(self):
+        threshold = getattr(settings, 'MAMA_CAS_ATTRIBUTE_BREAKER_THRESHOLD', 5)
+        with self._lock:
+            self.failures += 1
+            if threshold and self.failures >= threshold:
+                self.opened = time.monotonic()
+
+
+def get_breaker(path):
+    """
+    Return the circuit breaker for a callback, or ``None`` unless
+    callbacks run on the thread pool, as a callback called in the
+    request thread cannot be abandoned when it hangs.
+    """
+    if not getattr(settings, 'MAMA_CAS_ATTRIBUTE_WORKERS', 0):
+        return None
+    with _executor_lock:
+        try:
+            return _breakers[path]
+        except KeyError:
+            breaker = _breakers[path] = CircuitBreaker()
+            return breaker
+
+
+def record_success(breaker):
+    if breaker is not None:
+        breaker.record_success()
+
+
+def record_failure(breaker):
+    if breaker is not None:
+        breaker.record_failure()
+
+
+def reset_breakers():
+    with _executor_lock:
+        _breakers.clear()
+
+
+def get_executor():
+    """
+    Return the thread pool shared by all callbacks, sized by
+    ``MAMA_CAS_ATTRIBUTE_WORKERS`` when first used.
+    """
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            workers = getattr(settings, 'MAMA_CAS_ATTRIBUTE_WORKERS', 0)
+            _executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='mama_cas_callbacks')
+    return _executor
+
+
+def get_refresh_executor():
+    global _refresh_executor
+    with _executor_lock:
+        if _refresh_executor is None:
+            _refresh_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix='mama_cas_attributes')
+    return _refresh_executor
+
+
+def call(callback, user, service):
+    """Call a callback, running it to completion if it is a coroutine."""
+    result = callback(user, service)
+    if inspect.isawaitable(result):
+        loop = asyncio.new_event_loop()
+        try:
+            result = loop.run_until_complete(result)
+        finally:
+            loop.close()
+    return result
+
+
+def call_in_thread(callback, user, service):
+    # Worker threads outlive requests, so their connections are reused
+    # between calls, and only closed once unusable or past CONN_MAX_AGE
+    close_old_connections()
+    try:
+        return call(callback, user, service)
+    finally:
+        close_old_connections()
+
+
+def compute(user, service, callback, key, timeout):
+    """Run a callback and cache the result along with when it started."""
+    computed = time.time()
+    value = call(callback, user, service)
+    get_cache().set(key, (computed, value), timeout)
+    return value
+
+
+def refresh(user, service, callback, key, timeout):
+    try:
+        compute(user, service, callback, key, timeout)
+    except Exception:
+        logger.exception("Error refreshing cached attributes for %s" % user)
+    finally:
+        with _refresh_lock:
+            _refreshing.discard(key)
+        # Connections opened by this thread are not closed by the
+        # request cycle
+        connections.close_all()
+
+
+def refresh_async(user, service, callback, key, timeout):
+    """Refresh a cached result in the background, unless already in progress."""
+    with _refresh_lock:
+        if key in _refreshing:
+            return
+        _refreshing.add(key)
+    get_refresh_executor().submit(refresh, user, service, callback, key, timeout)
+
+
+def handle_failure(user, path, callback, exc):
+    """
+    Apply a callback's failure policy to a timeout or unexpected
+    exception, returning the result to use in its place, or ``None`` to
+    omit it.
+    """
+    policy = get_failure_policy(callback)
+    if policy == 'fail':
+        raise exc
+    logger.warning("Attribute callback %s failed: %s" % (path, exc))
+    if policy == 'cached':
+        entry = get_cache().get(get_cache_key(user, path))
+        if entry is not None:
+            return entry[1]
+    return None
+
+
+def run_callbacks(user, service, callbacks):
+    """
+    Call each ``(path, callback)`` pair, returning a list of ``(started,
+    result, succeeded)`` triples in the same order, where a ``None``
+    result is to be omitted. With ``MAMA_CAS_ATTRIBUTE_WORKERS`` set,
+    callbacks run concurrently on a shared thread pool and each is
+    abandoned after its ``timeout``.
+    """
+    started = time.time()
+    start = time.monotonic()
+    workers = getattr(settings, 'MAMA_CAS_ATTRIBUTE_WORKERS', 0)
+    calls = []
+    for path, callback in callbacks:
+        breaker = get_breaker(path)
+        allowed = breaker is None or breaker.allow()
+        future = None
+        if allowed and workers:
+            future = get_executor().submit(call_in_thread, callback, user, service)
+        calls.append((path, callback, breaker, allowed, future))
+
+    results = []
+    for path, callback, breaker, allowed, future in calls:
+        if not allowed:
+            value = handle_failure(user, path, callback, InternalError('Attribute callback %s is unavailable' % path))
+            results.append((started, value, False))
+            continue
+        try:
+            if future is None:
+                value = call(callback, user, service)
+            else:
+                timeout = get_timeout(callback)
+                if timeout is not None:
+                    timeout = max(0, start + timeout - time.monotonic())
+                value = future.result(timeout=timeout)
+        except FutureTimeoutError:
+            future.cancel()
+            record_failure(breaker)
+            value = handle_failure(user, path, callback, InternalError('Attribute callback %s timed out' % path))
+            results.append((started, value, False))
+        except ValidationError:
+            # A callback rejecting the user is deliberate, not a failure
+            record_success(breaker)
+            raise
+        except Exception as e:
+            record_failure(breaker)
+            results.append((started, handle_failure(user, path, callback, e), False))
+        else:
+            record_success(breaker)
+            results.append((started, value, True))
+    return results
+
+
+def get_results(user, service, callbacks, ttl=None):
+    """
+    Return the result of each ``(path, callback)`` pair in order, with
+    omitted results as ``None``.
+
+    If ``ttl`` is provided, results are cached per user and callback for
+    ``ttl`` seconds. For a further ``MAMA_CAS_ATTRIBUTE_STALE_WINDOW``
+    seconds an expired result is still returned while it is refreshed in
+    the background. Callbacks with a false ``cacheable`` attribute are
+    always called.
+    """
+    results = [None] * len(callbacks)
+    pending = list(range(len(callbacks)))
+    keys = {}
+
+    if ttl:
+        cache = get_cache()
+        stale = getattr(settings, 'MAMA_CAS_ATTRIBUTE_STALE_WINDOW', 300)
+        keys = dict((i, get_cache_key(user, path)) for i, (path, callback) in enumerate(callbacks)
+                    if is_cacheable(callback))
+        changed_key = get_changed_key(user)
+        cached = cache.get_many([changed_key] + list(keys.values()))
+        changed = cached.get(changed_key, 0)
+
+        pending = []
+        for i, (path, callback) in enumerate(callbacks):
+            entry = cached.get(keys.get(i))
+            if entry is not None and entry[0] >= changed:
+                computed, value = entry
+                age = time.time() - computed
+                if age < ttl:
+                    results[i] = value
+                    continue
+                if age < ttl + stale:
+                    refresh_async(user, service, callback, keys[i], ttl + stale)
+                    results[i] = value
+                    continue
+            pending.append(i)
+
+    computed = run_callbacks(user, service, [callbacks[i] for i in pending])
+    for i, (started, value, succeeded) in zip(pending, computed):
+        results[i] = value
+        if succeeded and i in keys:
+            cache.set(keys[i], (started, value), ttl + stale)
+    return results
+
+
+def run_batch(users, service, path, callback, many):
+    """
+    Call a callback's batch form for the given users, returning a
+    dictionary of ``(started, result, succeeded)`` triples keyed by user
+    primary key. A failure applies the callback's failure policy to each
+    user.
+    """
+    started = time.time()
+    breaker = get_breaker(path)
+    if breaker is not None and not breaker.allow():
+        exc = InternalError('Attribute callback %s is unavailable' % path)
+        return dict((user.pk, (started, handle_failure(user, path, callback, exc), False)) for user in users)
+
+    workers = getattr(settings, 'MAMA_CAS_ATTRIBUTE_WORKERS', 0)
+    try:
+        if workers:
+            future = get_executor().submit(call_in_thread, many, users, service)
+            try:
+                values = future.result(timeout=get_timeout(callback))
+            except FutureTimeoutError:
+                future.cancel()
+                exc = InternalError('Attribute callback %s timed out' % path)
+                record_failure(breaker)
+                return dict((user.pk, (started, handle_failure(user, path, callback, exc), False)) for user in users)
+        else:
+            values = call(many, users, service)
+    except ValidationError:
+        record_success(breaker)
+        raise
+    except Exception as e:
+        record_failure(breaker)
+        return dict((user.pk, (started, handle_failure(user, path, callback, e), False)) for user in users)
+    record_success(breaker)
+    return dict((user.pk, (started, values.get(user.pk), True)) for user in users)
+
+
+def get_batch_results(users, service, path, callback, many, ttl=None):
+    """
+    Return a dictionary of the results of a callback's batch form keyed
+    by user primary key, only calling it for users without a cached
+    result.
+    """
+    results = {}
+    pending = list(users)
+    keys = {}
+
+    if ttl and is_cacheable(callback):
+        cache = get_cache()
+        stale = getattr(settings, 'MAMA_CAS_ATTRIBUTE_STALE_WINDOW', 300)
+        keys = dict((user.pk, get_cache_key(user, path)) for user in users)
+        changed_keys = dict((user.pk, get_changed_key(user)) for user in users)
+        cached = cache.get_many(list(changed_keys.values()) + list(keys.values()))
+
+        pending = []
+        for user in users:
+            entry = cached.get(keys[user.pk])
+            if entry is not None and entry[0] >= cached.get(changed_keys[user.pk], 0):
+                computed, value = entry
+                age = time.time() - computed
+                if age < ttl:
+                    results[user.pk] = value
+                    continue
+                if age < ttl + stale:
+                    refresh_async(user, service, callback, keys[user.pk], ttl + stale)
+                    results[user.pk] = value
+                    continue
+            pending.append(user)
+
+    if pending:
+        computed = run_batch(pending, service, path, callback, many)
+        entries = {}
+        for pk, (started, value, succeeded) in computed.items():
+            results[pk] = value
+            if succeeded and pk in keys:
+                entries[keys[pk]] = (started, value)
+        if entries:
+            cache.set_many(entries, ttl + stale)
+    return results
+
+
+def get_results_many(users, service, callbacks, ttl=None):
+    """
+    Return a dictionary mapping each user's primary key to the results
+    of each ``(path, callback)`` pair, as returned by ``get_results()``.
+    Callbacks with a batch form are called once for all users, while the
+    remaining callbacks are called for each user.
+    """
+    users = list(dict((user.pk, user) for user in users).values())
+    batched = len(users) > 1
+    single = [i for i, (path, callback) in enumerate(callbacks) if not batched or get_batch(callback) is None]
+
+    results = {}
+    for user in users:
+        results[user.pk] = [None] * len(callbacks)
+        for i, value in zip(single, get_results(user, service, [callbacks[i] for i in single], ttl)):
+            results[user.pk][i] = value
+
+    if batched:
+        for i, (path, callback) in enumerate(callbacks):
+            many = get_batch(callback)
+            if many is None:
+                continue
+            for pk, value in get_batch_results(users, service, path, callback, many, ttl).items():
+                results[pk][i] = value
+    return results
+
+
+def record_service(user, service):
+    """
+    Record a service the user has been issued a ticket for, keeping the
+    ``MAMA_CAS_ATTRIBUTE_PREFETCH_SERVICES`` most recent.
+    """
+    limit = getattr(settings, 'MAMA_CAS_ATTRIBUTE_PREFETCH_SERVICES', 0)
+    if not limit or not service:
+        return
+    service = str(service)
+    cache = get_cache()
+    key = get_recent_key(user)
+    recent = [s for s in cache.get(key, []) if s != service]
+    cache.set(key, [service] + recent[:limit - 1], None)
+
+
+def prefetch_attributes(user, service=None):
+    """
+    Warm the attribute cache for a user who has just started a single
+    sign-on session, in the background. The union of the callbacks of
+    the current service and the user's recent services is computed,
+    with each callback called once.
+    """
+    if not getattr(settings, 'MAMA_CAS_ATTRIBUTE_PREFETCH_SERVICES', 0):
+        return
+    record_service(user, service)
+    get_refresh_executor().submit(prefetch, user, get_cache().get(get_recent_key(user), []))
+
+
+def prefetch(user, services):
+    """
+    Cache the result of each callback configured for the given services
+    with an ``ATTRIBUTE_TTL``, unless a fresh result is already cached.
+    """
+    try:
+        stale = getattr(settings, 'MAMA_CAS_ATTRIBUTE_STALE_WINDOW', 300)
+        callbacks = {}
+        for service in services:
+            context = get_service_context(service)
+            ttl = context.attribute_ttl
+            if not ttl:
+                continue
+            for path, callback in context.pipeline:
+                if path in callbacks:
+                    callbacks[path] = (callbacks[path][0], callback, max(callbacks[path][2], ttl))
+                else:
+                    callbacks[path] = (service, callback, ttl)
+
+        cache = get_cache()
+        keys = dict((path, get_cache_key(user, path)) for path in callbacks)
+        cached = cache.get_many([get_changed_key(user)] + list(keys.values()))
+        changed = cached.get(get_changed_key(user), 0)
+        for path, (service, callback, ttl) in callbacks.items():
+            entry = cached.get(keys[path])
+            if not is_cacheable(callback):
+                continue
+            if entry is not None and entry[0] >= changed and time.time() - entry[0] < ttl:
+                continue
+            try:
+                compute(user, service, callback, keys[path], ttl + stale)
+            except Exception:
+                logger.exception("Error prefetching attributes from %s for %s" % (path, user))
+    finally:
+        connections.close_all()
@@ -1,3 +1,12 @@
+from functools import lru_cache
+
+from django.conf import settings
+from django.contrib.auth.models import Group
+from django.contrib.auth.models import Permission
+
+from mama_cas.utils import get_cache
+
+
 def user_name_attributes(user, service):
     """Return all available user name related fields and methods."""
     attributes = {}
@@ -7,14 +16,116 @@ def user_name_attributes(user, service):
     return attributes
 
 
+user_name_attributes.provides = ('username', 'full_name', 'short_name')
+user_name_attributes.user_fields = ('first_name', 'last_name')
+
+
+@lru_cache(maxsize=None)
+def get_model_fields(model, ignore_fields=('id', 'password')):
+    """Return the names of a model's fields, less those to ignore."""
+    return tuple(field.name for field in model._meta.fields if field.name not in ignore_fields)
+
+
 def user_model_attributes(user, service):
     """
     Return all fields on the user object that are not in the list
     of fields to ignore.
     """
-    ignore_fields = ['id', 'password']
-    attributes = {}
-    for field in user._meta.fields:
-        if field.name not in ignore_fields:
-            attributes[field.name] = getattr(user, field.name)
-    return attributes
+    return dict((name, getattr(user, name)) for name in get_model_fields(type(user)))
+
+
+def get_groups_key(pk):
+    return 'mama_cas:groups:%s' % pk
+
+
+def get_permissions_key(pk):
+    return 'mama_cas:permissions:%s' % pk
+
+
+def get_cached(pks, get_key, fetch):
+    """
+    Return a dictionary of cached values keyed by user primary key.
+    Missing values are fetched together with ``fetch(pks)`` and cached
+    for ``MAMA_CAS_GROUP_CACHE_TIMEOUT`` seconds.
+    """
+    timeout = getattr(settings, 'MAMA_CAS_GROUP_CACHE_TIMEOUT', 300)
+    if not timeout:
+        return fetch(pks)
+    cache = get_cache()
+    keys = dict((pk, get_key(pk)) for pk in pks)
+    cached = cache.get_many(list(keys.values()))
+    values = dict((pk, cached[key]) for pk, key in keys.items() if key in cached)
+    missing = [pk for pk in pks if pk not in values]
+    if missing:
+        fetched = fetch(missing)
+        cache.set_many(dict((keys[pk], value) for pk, value in fetched.items()), timeout)
+        values.update(fetched)
+    return values
+
+
+def fetch_group_names(pks):
+    groups = dict((pk, []) for pk in pks)
+    for pk, name in Group.objects.filter(user__in=pks).order_by('name').values_list('user', 'name'):
+        groups[pk].append(name)
+    return groups
+
+
+def fetch_permission_names(pks):
+    permissions = dict((pk, []) for pk in pks)
+    fields = ('content_type__app_label', 'codename')
+    granted = Permission.objects.filter(user__in=pks).order_by().values_list('user', *fields)
+    inherited = Permission.objects.filter(group__user__in=pks).order_by().values_list('group__user', *fields)
+    for pk, app_label, codename in granted.union(inherited):
+        permissions[pk].append('%s.%s' % (app_label, codename))
+    return dict((pk, sorted(names)) for pk, names in permissions.items())
+
+
+def get_group_names(user):
+    """Return the sorted names of the groups a user belongs to."""
+    return get_cached([user.pk], get_groups_key, fetch_group_names)[user.pk]
+
+
+def get_permission_names(user):
+    """
+    Return the sorted names, in ``app_label.codename`` form, of the
+    permissions granted to a user directly or through their groups.
+    """
+    return get_cached([user.pk], get_permissions_key, fetch_permission_names)[user.pk]
+
+
+def invalidate_groups(pks):
+    """Discard the cached groups and permissions of the given users."""
+    keys = []
+    for pk in pks:
+        keys.extend([get_groups_key(pk), get_permissions_key(pk)])
+    get_cache().delete_many(keys)
+
+
+def user_group_attributes(user, service):
+    """Return the names of the user's groups."""
+    return {'groups': get_group_names(user)}
+
+
+def user_group_attributes_many(users, service):
+    groups = get_cached([user.pk for user in users], get_groups_key, fetch_group_names)
+    return dict((pk, {'groups': names}) for pk, names in groups.items())
+
+
+user_group_attributes.provides = ('groups',)
+user_group_attributes.user_fields = ()
+user_group_attributes.many = user_group_attributes_many
+
+
+def user_permission_attributes(user, service):
+    """Return the names of the user's permissions."""
+    return {'permissions': get_permission_names(user)}
+
+
+def user_permission_attributes_many(users, service):
+    permissions = get_cached([user.pk for user in users], get_permissions_key, fetch_permission_names)
+    return dict((pk, {'permissions': names}) for pk, names in permissions.items())
+
+
+user_permission_attributes.provides = ('permissions',)
+user_permission_attributes.user_fields = ()
+user_permission_attributes.many = user_permission_attributes_many
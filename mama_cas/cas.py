@@ -1,15 +1,24 @@
+from collections import OrderedDict
+from collections.abc import Mapping
 import logging
 
 from django.contrib import messages
 from django.contrib.auth import logout
-from django.utils.module_loading import import_string
 from django.utils.translation import gettext_lazy as _
 
+from mama_cas.attributes import get_results
+from mama_cas.attributes import get_results_many
 from mama_cas.exceptions import InvalidTicketSpec
+from mama_cas.exceptions import ValidationError
 from mama_cas.models import ServiceTicket
 from mama_cas.models import ProxyTicket
 from mama_cas.models import ProxyGrantingTicket
-from mama_cas.services import get_callbacks
+from mama_cas.services import get_attribute_ttl
+from mama_cas.services import get_pipeline
+from mama_cas.services import get_release
+from mama_cas.services import get_service_context
+from mama_cas.services import get_user_fields
+from mama_cas.services import ServiceContext
 
 logger = logging.getLogger(__name__)
 
@@ -17,8 +26,9 @@ logger = logging.getLogger(__name__)
 def validate_service_ticket(service, ticket, pgturl=None, renew=False, require_https=False):
     """
     Validate a service ticket string. Return a triplet containing a
-    ``ServiceTicket`` and an optional ``ProxyGrantingTicket``, or a
-    ``ValidationError`` if ticket validation failed.
+    ``ServiceTicket``, its ``LazyAttributes`` and an optional
+    ``ProxyGrantingTicket``, or a ``ValidationError`` if ticket
+    validation failed.
     """
     logger.debug("Service validation request received for %s" % ticket)
 
@@ -26,28 +36,95 @@ def validate_service_ticket(service, ticket, pgturl=None, renew=False, require_h
     if ticket and ticket.startswith(ProxyTicket.TICKET_PREFIX):
         raise InvalidTicketSpec('Proxy tickets cannot be validated with /serviceValidate')
 
-    st = ServiceTicket.objects.validate_ticket(ticket, service, renew=renew, require_https=require_https)
-    attributes = get_attributes(st.user, st.service)
+    service = get_service_context(service)
+    user_fields = get_user_fields(service) if service else None
+    st = ServiceTicket.objects.validate_ticket(ticket, service, renew=renew, require_https=require_https,
+                                               user_fields=user_fields)
+    attributes = LazyAttributes(st.user, service.get_context(st.service))
 
     if pgturl is not None:
+        # A failing callback must not leave a proxy-granting ticket behind
+        attributes.resolve()
         logger.debug("Proxy-granting ticket request received for %s" % pgturl)
         pgt = ProxyGrantingTicket.objects.create_ticket(service, pgturl, user=st.user, granted_by_st=st)
     else:
         pgt = None
+
+    ServiceTicket.objects.discard_ticket(st)
     return st, attributes, pgt
 
 
+def validate_service_tickets(items, renew=False):
+    """
+    Validate a sequence of ``(ticket, service)`` pairs with the same
+    results as calling ``validate_service_ticket()`` for each in turn.
+    The tickets are fetched and consumed together, and attributes are
+    resolved together for each service. Return a list containing, for
+    each pair in order, either a ``ServiceTicket`` and attributes pair
+    or the ``ValidationError`` raised.
+    """
+    logger.debug("Batch service validation request received for %d tickets" % len(items))
+
+    results = [None] * len(items)
+    pending = []
+    for i, (ticket, service) in enumerate(items):
+        if ticket and ticket.startswith(ProxyTicket.TICKET_PREFIX):
+            results[i] = InvalidTicketSpec('Proxy tickets cannot be validated with /serviceValidate')
+        else:
+            pending.append((i, ticket, get_service_context(service)))
+
+    user_fields = set()
+    for i, ticket, service in pending:
+        fields = get_user_fields(service) if service else None
+        if fields is None:
+            user_fields = None
+            break
+        user_fields.update(fields)
+
+    tickets = ServiceTicket.objects.validate_tickets(
+        [(ticket, service) for i, ticket, service in pending], renew=renew, user_fields=user_fields)
+
+    validated = OrderedDict()
+    for (i, ticket, service), st in zip(pending, tickets):
+        if isinstance(st, ValidationError):
+            results[i] = st
+            continue
+        ServiceTicket.objects.discard_ticket(st)
+        if st.service not in validated:
+            validated[st.service] = (service.get_context(st.service), [])
+        validated[st.service][1].append((i, st))
+
+    for context, sts in validated.values():
+        try:
+            attributes = get_attributes_many([st.user for i, st in sts], context)
+        except ValidationError:
+            # Resolve each user separately so only failing users fail
+            attributes = {}
+            for i, st in sts:
+                try:
+                    attributes[st.user.pk] = get_attributes(st.user, context)
+                except ValidationError as e:
+                    attributes[st.user.pk] = e
+        for i, st in sts:
+            result = attributes[st.user.pk]
+            results[i] = result if isinstance(result, ValidationError) else (st, result)
+    return results
+
+
 def validate_proxy_ticket(service, ticket, pgturl=None):
     """
     Validate a proxy ticket string. Return a 4-tuple containing a
-    ``ProxyTicket``, an optional ``ProxyGrantingTicket`` and a list
+    ``ProxyTicket``, its ``LazyAttributes``, an optional
+    ``ProxyGrantingTicket`` and a list
     of proxies through which authentication proceeded, or a
     ``ValidationError`` if ticket validation failed.
     """
     logger.debug("Proxy validation request received for %s" % ticket)
 
-    pt = ProxyTicket.objects.validate_ticket(ticket, service)
-    attributes = get_attributes(pt.user, pt.service)
+    service = get_service_context(service)
+    user_fields = get_user_fields(service) if service else None
+    pt = ProxyTicket.objects.validate_ticket(ticket, service, user_fields=user_fields)
+    attributes = LazyAttributes(pt.user, service.get_context(pt.service))
 
     # Build a list of all services that proxied authentication,
     # in reverse order of which they were traversed
@@ -58,10 +135,13 @@ def validate_proxy_ticket(service, ticket, pgturl=None):
         prior_pt = prior_pt.granted_by_pgt.granted_by_pt
 
     if pgturl is not None:
+        attributes.resolve()
         logger.debug("Proxy-granting ticket request received for %s" % pgturl)
         pgt = ProxyGrantingTicket.objects.create_ticket(service, pgturl, user=pt.user, granted_by_pt=pt)
     else:
         pgt = None
+
+    ProxyTicket.objects.discard_ticket(pt)
     return pt, attributes, pgt, proxies
 
 
@@ -73,23 +153,99 @@ def validate_proxy_granting_ticket(pgt, target_service):
     """
     logger.debug("Proxy ticket request received for %s using %s" % (target_service, pgt))
 
+    target_service = get_service_context(target_service)
     pgt = ProxyGrantingTicket.objects.validate_ticket(pgt, target_service)
     pt = ProxyTicket.objects.create_ticket(service=target_service, user=pgt.user, granted_by_pgt=pgt)
+    pgt.touch()
     return pt
 
 
 def get_attributes(user, service):
     """
     Return a dictionary of user attributes from the set of configured
-    callback functions.
+    callback functions. The service may be a service identifier or a
+    ``ServiceContext``; callbacks always receive the identifier. If the
+    service sets ``ATTRIBUTE_TTL``, callback results are cached, and if
+    it sets ``RELEASE``, only the listed attributes are returned.
+    """
+    if isinstance(service, ServiceContext):
+        context, service = service, service.service
+    else:
+        context = get_service_context(service)
+
+    results = get_results(user, service, get_pipeline(context), get_attribute_ttl(context))
+    return merge_results(results, get_release(context))
+
+
+def get_attributes_many(users, service):
+    """
+    Return a dictionary mapping each user's primary key to the
+    dictionary of attributes ``get_attributes()`` would return for them.
+    Callbacks with a batch form, declared with a ``many`` attribute, are
+    called once for all of the users.
+    """
+    if isinstance(service, ServiceContext):
+        context, service = service, service.service
+    else:
+        context = get_service_context(service)
+
+    results = get_results_many(users, service, get_pipeline(context), get_attribute_ttl(context))
+    release = get_release(context)
+    return dict((pk, merge_results(user_results, release)) for pk, user_results in results.items())
+
+
+def merge_results(results, release=None):
+    """
+    Merge callback results in order, omitting ``None`` results and,
+    if a release allowlist is given, any attributes not listed.
     """
     attributes = {}
-    for path in get_callbacks(service):
-        callback = import_string(path)
-        attributes.update(callback(user, service))
+    for result in results:
+        if result is not None:
+            attributes.update(result)
+    if release is not None:
+        attributes = dict((name, value) for name, value in attributes.items() if name in release)
     return attributes
 
 
+class LazyAttributes(Mapping):
+    """
+    A read-only mapping of user attributes, returned from ticket
+    validation, that runs the configured callbacks only when it is first
+    accessed. Responses that do not release attributes, such as CAS 1.0
+    validation, never pay for the callbacks. A ``ValidationError`` raised
+    by a callback is raised on first access.
+    """
+    def __init__(self, user, service):
+        self.user = user
+        self.service = service
+        self._attributes = None
+
+    def __repr__(self):
+        if self._attributes is None:
+            return '<LazyAttributes: unresolved>'
+        return '<LazyAttributes: %r>' % self._attributes
+
+    @property
+    def resolved(self):
+        return self._attributes is not None
+
+    def resolve(self):
+        """Run the callbacks, if they have not yet run, and return the attributes."""
+        if self._attributes is None:
+            self._attributes = get_attributes(self.user, self.service)
+        return self._attributes
+
+    def __getitem__(self, key):
+        return self.resolve()[key]
+
+    def __iter__(self):
+        return iter(self.resolve())
+
+    def __len__(self):
+        return len(self.resolve())
+
+
 def logout_user(request):
     """End a single sign-on session for the current user."""
     logger.debug("Logout request received for %s" % request.user)
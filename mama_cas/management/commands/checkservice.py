@@ -1,4 +1,15 @@
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import csv
+from itertools import islice
+import json
+import os
+import sys
+import time
+
+import django
 from django.core.management.base import BaseCommand
+from django.core.management.base import CommandError
 
 from mama_cas.services import get_backend_path
 from mama_cas.services import get_callbacks
@@ -6,27 +17,95 @@ from mama_cas.services import get_logout_url
 from mama_cas.services import logout_allowed
 from mama_cas.services import proxy_allowed
 from mama_cas.services import proxy_callback_allowed
+from mama_cas.services import registry
 from mama_cas.services import service_allowed
+from mama_cas.services.lint import describe
+from mama_cas.services.lint import ServiceLinter
+
+
+FIELDS = ('service', 'valid', 'backend', 'proxy_allowed', 'logout_allowed', 'logout_url', 'callbacks')
+
+
+def check_service(service):
+    """
+    Return a row describing the configuration of a service identifier,
+    and the time in seconds it took to resolve.
+    """
+    start = time.perf_counter()
+    valid = bool(service_allowed(service))
+    row = dict.fromkeys(FIELDS)
+    row.update({'service': service, 'valid': valid})
+    if valid:
+        row.update({
+            'backend': get_backend_path(service),
+            'proxy_allowed': bool(proxy_allowed(service)),
+            'logout_allowed': bool(logout_allowed(service)),
+            'logout_url': get_logout_url(service),
+            'callbacks': get_callbacks(service),
+        })
+    return row, time.perf_counter() - start
+
+
+def check_services(services):
+    return [check_service(service) for service in services]
+
+
+def init_worker():
+    # Processes that are spawned rather than forked start unconfigured
+    django.setup()
 
 
 class Command(BaseCommand):
     help = 'Check validity and display configuration of a service identifier'
+    stealth_options = ('stdin',)
+    chunk_size = 500
 
     def add_arguments(self, parser):
         parser.add_argument(
-            'service',
+            'service', nargs='?',
             help='Service identifier (e.g. https://example.com)',
         )
         parser.add_argument(
             'pgturl', nargs='?',
             help='Proxy callback identifier (e.g. https://proxy.example.com)',
         )
+        parser.add_argument(
+            '--lint', action='store_true',
+            help='Analyze all configured services for problems and slow patterns',
+        )
+        parser.add_argument(
+            '--threshold', type=float, default=0.1,
+            help='Time in seconds a pattern may take to match adversarial input when linting',
+        )
+        parser.add_argument(
+            '--file',
+            help='Check service identifiers read one per line from a file, or "-" for stdin',
+        )
+        parser.add_argument(
+            '--format', choices=('csv', 'jsonl'), default='csv',
+            help='Output format for results when checking a file',
+        )
+        parser.add_argument(
+            '--workers', type=int, default=os.cpu_count() or 1,
+            help='Number of processes used to check large files',
+        )
+        parser.add_argument(
+            '--pool-threshold', type=int, default=10000,
+            help='Minimum number of service identifiers before checking in a process pool',
+        )
 
     def handle(self, **options):
         self.service = options['service']
         self.pgturl = options['pgturl']
         self.verbosity = options['verbosity']
 
+        if options['lint']:
+            return self.lint(options['threshold'])
+        if options['file']:
+            return self.bulk(options)
+        if not self.service:
+            raise CommandError('A service identifier is required unless --lint or --file is given.')
+
         if service_allowed(self.service):
             try:
                 self.stdout.write(self.style.SUCCESS("Valid service: %s" % self.service))
@@ -45,5 +124,114 @@ class Command(BaseCommand):
         else:
             self.stdout.write(self.style.ERROR("Invalid service: %s" % self.service))
 
+    def lint(self, threshold):
+        problems = 0
+        for backend in registry.backends:
+            backend_path = '%s.%s' % (backend.__module__, backend.__class__.__name__)
+            try:
+                services = backend.get_service_config().services
+            except AttributeError:
+                self.stdout.write("Skipping %s: service configuration is not available" % backend_path)
+                continue
+
+            self.stdout.write("Checking %d services from %s" % (len(services), backend_path))
+            linter = ServiceLinter(services)
+            findings = linter.find_overlaps() + linter.find_backtracking(threshold)
+            for index, kind, message in sorted(findings):
+                style = self.style.ERROR if kind in ('shadowed', 'backtracking') else self.style.WARNING
+                self.stdout.write(style("  [%d] %s: %s" % (index, describe(services[index]), message)))
+            problems += len(findings)
+
+            if self.verbosity >= 1:
+                costs = linter.match_costs()
+                if self.verbosity < 2:
+                    costs = costs[:10]
+                if costs:
+                    self.stdout.write("  Pattern match cost:")
+                for index, key, cost in costs:
+                    self.format_output('[%d] %s' % (index, key), '%.2f us' % (cost * 1e6))
+
+        if problems:
+            self.stdout.write(self.style.ERROR("Found %d problems" % problems))
+        else:
+            self.stdout.write("No problems found")
+
+    def bulk(self, options):
+        if options['file'] == '-':
+            lines = options.get('stdin') or sys.stdin
+            self.bulk_check(lines, options)
+        else:
+            with open(options['file']) as lines:
+                self.bulk_check(lines, options)
+
+    def bulk_check(self, lines, options):
+        services = (line.strip() for line in lines)
+        services = (service for service in services if service)
+        chunks = iter(lambda: list(islice(services, self.chunk_size)), [])
+
+        # Only start a pool once the input is known to be large enough
+        # to repay the cost of starting the workers
+        head = []
+        for chunk in chunks:
+            head.append(chunk)
+            if sum(len(c) for c in head) >= options['pool_threshold']:
+                break
+
+        if options['format'] == 'csv':
+            writer = csv.writer(self.stdout, lineterminator='\n')
+            writer.writerow(FIELDS)
+            write = self.write_csv_row
+        else:
+            writer = None
+            write = self.write_json_row
+
+        timings = []
+        start = time.perf_counter()
+        for rows in self.iter_results(head, chunks, options):
+            for row, elapsed in rows:
+                write(writer, row)
+                timings.append(elapsed)
+        elapsed = time.perf_counter() - start
+        self.write_timings(timings, elapsed)
+
+    def iter_results(self, head, chunks, options):
+        workers = options['workers']
+        if workers < 2 or sum(len(c) for c in head) < options['pool_threshold']:
+            for chunk in head:
+                yield check_services(chunk)
+            for chunk in chunks:
+                yield check_services(chunk)
+            return
+
+        # Keep a bounded number of chunks in flight, so results are
+        # streamed in input order without reading all of the input
+        with ProcessPoolExecutor(max_workers=workers, initializer=init_worker) as executor:
+            pending = deque()
+            for chunk in head:
+                pending.append(executor.submit(check_services, chunk))
+            for chunk in chunks:
+                while len(pending) >= workers * 2:
+                    yield pending.popleft().result()
+                pending.append(executor.submit(check_services, chunk))
+            while pending:
+                yield pending.popleft().result()
+
+    def write_csv_row(self, writer, row):
+        callbacks = row.get('callbacks')
+        if callbacks is not None:
+            row = dict(row, callbacks=' '.join(callbacks))
+        writer.writerow([row.get(field, '') for field in FIELDS])
+
+    def write_json_row(self, writer, row):
+        self.stdout.write(json.dumps(row))
+
+    def write_timings(self, timings, elapsed):
+        if not timings or self.verbosity < 1:
+            return
+        timings.sort()
+        self.stderr.write("Checked %d services in %.2fs: %.0f lookups/sec, p50 %.1f us, p99 %.1f us" % (
+            len(timings), elapsed, len(timings) / elapsed if elapsed else 0,
+            timings[len(timings) // 2] * 1e6, timings[int(len(timings) * 0.99)] * 1e6))
+
     def format_output(self, label, text):
         self.stdout.write("  %s: %s" % (self.style.MIGRATE_LABEL(label), text))
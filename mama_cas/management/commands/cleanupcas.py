@@ -15,7 +15,10 @@ class Command(BaseCommand):
     These tickets are not deleted at the moment of invalidation so
     appropriate error messages can be returned if an invalid ticket is
     validated. However, this command should be run periodically to
-    prevent storage or performance problems.
+    prevent storage or performance problems. Alternatively, setting
+    ``MAMA_CAS_DELETE_CONSUMED_TICKETS`` deletes service and proxy
+    tickets as they are consumed, recording a short-lived tombstone in
+    the cache in their place.
 
     This command calls ``delete_invalid_tickets()`` for each applicable
     model, which deletes all invalid tickets of that type that are not
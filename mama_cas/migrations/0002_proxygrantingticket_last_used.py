@@ -0,0 +1,19 @@
+# Generated by Django 3.2.25 on 2026-10-19 10:03
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mama_cas', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='proxygrantingticket',
+            name='last_used',
+            field=models.DateTimeField(default=django.utils.timezone.now, verbose_name='last used'),
+        ),
+    ]
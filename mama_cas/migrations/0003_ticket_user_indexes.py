@@ -0,0 +1,25 @@
+# Generated by Django 3.2.25 on 2026-10-19 10:04
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mama_cas', '0002_proxygrantingticket_last_used'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='proxygrantingticket',
+            index=models.Index(fields=['user', 'consumed', 'expires'], name='mama_cas_pr_user_id_94b8cb_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='proxyticket',
+            index=models.Index(fields=['user', 'consumed', 'expires'], name='mama_cas_pr_user_id_ff7dc4_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='serviceticket',
+            index=models.Index(fields=['user', 'consumed', 'expires'], name='mama_cas_se_user_id_9f43bd_idx'),
+        ),
+    ]
@@ -0,0 +1,35 @@
+# Generated by Django 3.2.25 on 2026-10-19 10:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mama_cas', '0003_ticket_user_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ServiceDefinition',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('position', models.IntegerField(default=0, verbose_name='position')),
+                ('service', models.CharField(blank=True, max_length=255, verbose_name='service pattern')),
+                ('url', models.CharField(blank=True, max_length=255, verbose_name='URL')),
+                ('host', models.CharField(blank=True, max_length=255, verbose_name='host')),
+                ('scheme', models.CharField(blank=True, max_length=16, verbose_name='scheme')),
+                ('path', models.CharField(blank=True, max_length=255, verbose_name='path prefix')),
+                ('callbacks', models.TextField(blank=True, verbose_name='callbacks')),
+                ('logout_allow', models.BooleanField(default=False, verbose_name='logout allowed')),
+                ('logout_url', models.CharField(blank=True, max_length=255, verbose_name='logout URL')),
+                ('proxy_allow', models.BooleanField(default=False, verbose_name='proxy allowed')),
+                ('proxy_pattern', models.CharField(blank=True, max_length=255, verbose_name='proxy pattern')),
+            ],
+            options={
+                'verbose_name': 'service definition',
+                'verbose_name_plural': 'service definitions',
+                'ordering': ['position', 'pk'],
+            },
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 3.2.25 on 2026-10-19 10:19
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mama_cas', '0004_servicedefinition'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='servicedefinition',
+            name='attribute_ttl',
+            field=models.PositiveIntegerField(blank=True, null=True, verbose_name='attribute cache TTL'),
+        ),
+    ]
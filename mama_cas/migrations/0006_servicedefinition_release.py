@@ -0,0 +1,18 @@
+# Generated by Django 3.2.25 on 2026-10-19 10:24
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mama_cas', '0005_servicedefinition_attribute_ttl'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='servicedefinition',
+            name='release',
+            field=models.TextField(blank=True, verbose_name='released attributes'),
+        ),
+    ]
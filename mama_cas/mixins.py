@@ -1,10 +1,21 @@
+import hashlib
+import logging
+
+from django.conf import settings
+from django.http import HttpResponse
 from django.utils.decorators import method_decorator
+from django.utils.encoding import force_bytes
 from django.views.decorators.cache import never_cache
 from django.views.decorators.csrf import csrf_protect
 
+from mama_cas.exceptions import ValidationError
+from mama_cas.utils import get_cache
 from mama_cas.utils import redirect
 
 
+logger = logging.getLogger(__name__)
+
+
 class NeverCacheMixin(object):
     """View mixin for disabling caching."""
     @method_decorator(never_cache)
@@ -31,12 +42,71 @@ class CasResponseMixin(object):
     """
     View mixin for building CAS XML responses. Expects the view to
     implement ``get_context_data()`` and define ``response_class``.
+
+    (2.5.1) If the view also defines ``json_response_class``, a JSON
+    response is built instead when the ``format`` parameter is ``JSON``.
+
+    As attributes are resolved while the response is rendered, a
+    ``ValidationError`` raised by an attribute callback is rendered as
+    a validation failure.
     """
     content_type = 'text/xml'
+    json_content_type = 'application/json'
+    json_response_class = None
 
     def get(self, request, *args, **kwargs):
         context = self.get_context_data(**kwargs)
         return self.render_to_response(context)
 
+    def is_json(self):
+        return self.json_response_class is not None and self.request.GET.get('format', '').upper() == 'JSON'
+
+    def get_content_type(self):
+        return self.json_content_type if self.is_json() else self.content_type
+
+    def get_response_class(self):
+        return self.json_response_class if self.is_json() else self.response_class
+
+    def render_to_response(self, context):
+        response_class = self.get_response_class()
+        content_type = self.get_content_type()
+        try:
+            return response_class(context, content_type=content_type)
+        except ValidationError as e:
+            logger.warning("%s %s" % (e.code, e))
+            context.update({'ticket': None, 'error': e})
+            return response_class(context, content_type=content_type)
+
+
+class ValidationReplayMixin(object):
+    """
+    View mixin for replaying a successful validation response to a
+    client that retries the identical request, such as after a network
+    timeout. Responses are cached for ``MAMA_CAS_VALIDATION_REPLAY_WINDOW``
+    seconds, keyed by the full request path and bound to the address of
+    the original requester. Expects to be combined with
+    ``CasResponseMixin``.
+    """
+    replay_key = None
+
+    def get(self, request, *args, **kwargs):
+        window = getattr(settings, 'MAMA_CAS_VALIDATION_REPLAY_WINDOW', 0)
+        if window:
+            self.replay_key = self.get_replay_key()
+            content = get_cache().get(self.replay_key)
+            if content is not None:
+                logger.debug("Replaying validation response for %s" % request.path)
+                return HttpResponse(content, content_type=self.get_content_type())
+        return super(ValidationReplayMixin, self).get(request, *args, **kwargs)
+
+    def get_replay_key(self):
+        requester = self.request.META.get('REMOTE_ADDR', '')
+        digest = hashlib.sha256(force_bytes("%s|%s" % (requester, self.request.get_full_path()))).hexdigest()
+        return 'mama_cas:replay:%s' % digest
+
     def render_to_response(self, context):
-        return self.response_class(context, content_type=self.content_type)
+        response = super(ValidationReplayMixin, self).render_to_response(context)
+        if self.replay_key and context.get('ticket'):
+            window = getattr(settings, 'MAMA_CAS_VALIDATION_REPLAY_WINDOW', 0)
+            get_cache().set(self.replay_key, response.content, window)
+        return response
@@ -1,18 +1,30 @@
 from datetime import timedelta
+import hashlib
 import logging
 import os
 import re
 import time
 
 from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.contrib.auth.models import Group
+from django.core.exceptions import ValidationError as DjangoValidationError
 from django.db import models
 from django.db.models import Q
+from django.db.models.signals import m2m_changed
+from django.db.models.signals import post_delete
+from django.db.models.signals import post_save
+from django.db.models.signals import pre_delete
+from django.dispatch import receiver
 from django.utils.crypto import get_random_string
+from django.utils.encoding import force_bytes
 from django.utils.timezone import now
 from django.utils.translation import gettext_lazy as _
 
 import requests
 
+from mama_cas.attributes import invalidate_attributes
+from mama_cas.callbacks import invalidate_groups
 from mama_cas.compat import Session
 from mama_cas.exceptions import InvalidProxyCallback
 from mama_cas.exceptions import InvalidRequest
@@ -21,13 +33,17 @@ from mama_cas.exceptions import InvalidTicket
 from mama_cas.exceptions import UnauthorizedServiceProxy
 from mama_cas.exceptions import ValidationError
 from mama_cas.request import SingleSignOutRequest
+from mama_cas.signals import tickets_evicted
 from mama_cas.services import get_logout_url
+from mama_cas.services import get_service_context
 from mama_cas.services import logout_allowed
 from mama_cas.services import service_allowed
+from mama_cas.services.backends import update_services_version
 from mama_cas.services import proxy_allowed
 from mama_cas.services import proxy_callback_allowed
 from mama_cas.utils import add_query_params
 from mama_cas.utils import clean_service_url
+from mama_cas.utils import get_cache
 from mama_cas.utils import is_scheme_https
 from mama_cas.utils import match_service
 
@@ -50,8 +66,46 @@ class TicketManager(models.Manager):
             kwargs['expires'] = expires
         t = self.create(ticket=ticket, **kwargs)
         logger.debug("Created %s %s" % (t.name, t.ticket))
+        self.evict_tickets(t.user)
         return t
 
+    def evict_tickets(self, user):
+        """
+        Consume the oldest valid ``Ticket``s for a specified user that
+        exceed the limit configured for this ticket type in
+        ``MAMA_CAS_MAX_LIVE_TICKETS``. Return the number of tickets
+        that were evicted.
+        """
+        limits = getattr(settings, 'MAMA_CAS_MAX_LIVE_TICKETS', {})
+        limit = limits.get(self.model.TICKET_PREFIX)
+        if not limit:
+            return 0
+
+        live = self.filter(user=user, consumed__isnull=True, expires__gt=now())
+        evicted = list(live.order_by('-pk').values_list('pk', flat=True)[limit:])
+        if not evicted:
+            return 0
+
+        count = self.filter(pk__in=evicted).update(consumed=now())
+        logger.info("Evicted %d %s for %s" % (count, self.model._meta.verbose_name_plural, user))
+        tickets_evicted.send(sender=self.model, user=user, count=count)
+        return count
+
+    def with_user_fields(self, user_fields=None):
+        """
+        Return a queryset loading each ticket's user with only the given
+        fields, its primary key and its username field.
+        """
+        queryset = self.get_queryset()
+        if user_fields is None:
+            return queryset
+        user_model = self.model._meta.get_field('user').related_model
+        required = set(user_fields)
+        required.update((user_model._meta.pk.name, user_model.USERNAME_FIELD))
+        deferred = ['user__%s' % field.name for field in user_model._meta.concrete_fields
+                    if field.name not in required]
+        return queryset.select_related('user').defer(*deferred)
+
     def create_ticket_str(self, prefix=None):
         """
         Generate a sufficiently opaque ticket string to ensure the ticket is
@@ -62,7 +116,7 @@ class TicketManager(models.Manager):
         return "%s-%d-%s" % (prefix, int(time.time()),
                              get_random_string(length=self.model.TICKET_RAND_LEN))
 
-    def validate_ticket(self, ticket, service, renew=False, require_https=False):
+    def validate_ticket(self, ticket, service, renew=False, require_https=False, user_fields=None):
         """
         Given a ticket string and service identifier, validate the
         corresponding ``Ticket``. If validation succeeds, return the
@@ -74,6 +128,10 @@ class TicketManager(models.Manager):
 
         If ``require_https`` is ``True``, ``ServiceTicket`` validation
         will only succeed if the service URL scheme is HTTPS.
+
+        If ``user_fields`` is provided, the ticket's user is loaded along
+        with the ticket, with only those fields, its primary key and its
+        username field. Other fields are loaded on first access.
         """
         if not ticket:
             raise InvalidRequest("No ticket string provided")
@@ -82,42 +140,98 @@ class TicketManager(models.Manager):
             raise InvalidTicket("Ticket string %s is invalid" % ticket)
 
         try:
-            t = self.get(ticket=ticket)
+            t = self.with_user_fields(user_fields).get(ticket=ticket)
         except self.model.DoesNotExist:
+            if get_cache().get(self.get_tombstone_key(ticket)):
+                raise InvalidTicket("%s %s has already been used" %
+                                    (self.model._meta.verbose_name, ticket))
             raise InvalidTicket("Ticket %s does not exist" % ticket)
 
         if t.is_consumed():
             raise InvalidTicket("%s %s has already been used" %
                                 (t.name, ticket))
-        if t.is_expired():
-            raise InvalidTicket("%s %s has expired" % (t.name, ticket))
 
-        if not service:
-            raise InvalidRequest("No service identifier provided")
+        self.check_ticket(t, service, renew=renew, require_https=require_https)
+        return t
 
-        if require_https and not is_scheme_https(service):
-            raise InvalidService("Service %s is not HTTPS" % service)
+    def check_ticket(self, t, service, renew=False, require_https=False):
+        """
+        Check a fetched and newly consumed ``Ticket`` against the service
+        and validation options, as described for ``validate_ticket()``.
+        If a check fails, the ticket is discarded and an appropriate
+        error is raised.
+        """
+        ticket = t.ticket
+        try:
+            if t.is_expired():
+                raise InvalidTicket("%s %s has expired" % (t.name, ticket))
 
-        if not service_allowed(service):
-            raise InvalidService("Service %s is not a valid %s URL" %
-                                 (service, t.name))
+            if not service:
+                raise InvalidRequest("No service identifier provided")
 
-        try:
-            if not match_service(t.service, service):
-                raise InvalidService("%s %s for service %s is invalid for "
-                        "service %s" % (t.name, ticket, t.service, service))
-        except AttributeError:
-            pass
+            if require_https and not is_scheme_https(service):
+                raise InvalidService("Service %s is not HTTPS" % service)
+
+            if not service_allowed(service):
+                raise InvalidService("Service %s is not a valid %s URL" %
+                                     (service, t.name))
+
+            try:
+                if not match_service(t.service, service):
+                    raise InvalidService("%s %s for service %s is invalid for "
+                            "service %s" % (t.name, ticket, t.service, service))
+            except AttributeError:
+                pass
+
+            try:
+                if renew and not t.is_primary():
+                    raise InvalidTicket("%s %s was not issued via primary "
+                                        "credentials" % (t.name, ticket))
+            except AttributeError:
+                pass
+        except ValidationError:
+            self.discard_ticket(t)
+            raise
 
+        logger.debug("Validated %s %s" % (t.name, ticket))
+
+    def get_tombstone_key(self, ticket):
+        """
+        Return the cache key used to record that a ticket string was
+        consumed and deleted. The ticket string is hashed so live
+        credentials are never written to the cache.
+        """
+        digest = hashlib.sha256(force_bytes(ticket)).hexdigest()
+        return 'mama_cas:tombstone:%s' % digest
+
+    def discard_ticket(self, ticket):
+        """
+        When ``MAMA_CAS_DELETE_CONSUMED_TICKETS`` is enabled, delete a
+        consumed ``Ticket`` and record a tombstone in the cache so a
+        repeated validation attempt still reports the ticket as used.
+        Tickets that are unconsumed or still referenced by other
+        ``Ticket``s are left in place.
+        """
+        if not getattr(settings, 'MAMA_CAS_DELETE_CONSUMED_TICKETS', False):
+            return
+        if ticket.consumed is None:
+            return
+
+        get_cache().set(self.get_tombstone_key(ticket.ticket), 'consumed',
+                        self.model.TICKET_TOMBSTONE_EXPIRE)
         try:
-            if renew and not t.is_primary():
-                raise InvalidTicket("%s %s was not issued via primary "
-                                    "credentials" % (t.name, ticket))
-        except AttributeError:
+            ticket.delete()
+        except models.ProtectedError:
             pass
+        else:
+            logger.debug("Deleted consumed %s %s" % (ticket.name, ticket.ticket))
 
-        logger.debug("Validated %s %s" % (t.name, ticket))
-        return t
+    def get_invalid_filter(self):
+        """
+        Return a ``Q`` object matching ``Ticket``s that are no longer
+        valid for authentication.
+        """
+        return Q(consumed__isnull=False) | Q(expires__lte=now())
 
     def delete_invalid_tickets(self):
         """
@@ -128,8 +242,7 @@ class TicketManager(models.Manager):
         A custom management command is provided that executes this method
         on all applicable models by running ``manage.py cleanupcas``.
         """
-        for ticket in self.filter(Q(consumed__isnull=False)
-                                  | Q(expires__lte=now())).order_by('-expires'):
+        for ticket in self.filter(self.get_invalid_filter()).order_by('-expires'):
             try:
                 ticket.delete()
             except models.ProtectedError:
@@ -154,6 +267,7 @@ class Ticket(models.Model):
     TICKET_EXPIRE = getattr(settings, 'MAMA_CAS_TICKET_EXPIRE', 90)
     TICKET_RAND_LEN = getattr(settings, 'MAMA_CAS_TICKET_RAND_LEN', 32)
     TICKET_RE = re.compile("^[A-Z]{2,3}-[0-9]{10,}-[a-zA-Z0-9]{%d}$" % TICKET_RAND_LEN)
+    TICKET_TOMBSTONE_EXPIRE = getattr(settings, 'MAMA_CAS_TICKET_TOMBSTONE_EXPIRE', 3600)
 
     ticket = models.CharField(_('ticket'), max_length=255, unique=True)
     user = models.ForeignKey(settings.AUTH_USER_MODEL, verbose_name=_('user'),
@@ -200,6 +314,78 @@ class Ticket(models.Model):
 
 
 class ServiceTicketManager(TicketManager):
+    def validate_tickets(self, items, renew=False, require_https=False, user_fields=None):
+        """
+        Validate a sequence of ``(ticket, service)`` pairs with the same
+        results as calling ``validate_ticket()`` for each in turn, but
+        fetching and consuming all of the tickets together. Return a list
+        containing, for each pair in order, the validated ``Ticket`` or
+        the ``ValidationError`` raised.
+        """
+        results = [None] * len(items)
+        candidates = set()
+        for i, (ticket, service) in enumerate(items):
+            if not ticket:
+                results[i] = InvalidRequest("No ticket string provided")
+            elif not self.model.TICKET_RE.match(ticket):
+                results[i] = InvalidTicket("Ticket string %s is invalid" % ticket)
+            else:
+                candidates.add(ticket)
+
+        tickets = {}
+        fresh = set()
+        tombstones = {}
+        if candidates:
+            # Users are always loaded along with the tickets, so releasing
+            # attributes does not query each user in turn
+            queryset = self.with_user_fields(user_fields).select_related('user')
+            tickets = dict((t.ticket, t) for t in queryset.filter(ticket__in=candidates))
+            unconsumed = [ticket for ticket, t in tickets.items() if t.consumed is None]
+            if unconsumed:
+                consumed = now()
+                self.filter(ticket__in=unconsumed, consumed__isnull=True).update(consumed=consumed)
+                # Only tickets consumed here are fresh; any others were
+                # consumed concurrently since being fetched
+                fresh = set(self.filter(ticket__in=unconsumed, consumed=consumed).values_list('ticket', flat=True))
+                for ticket in fresh:
+                    tickets[ticket].consumed = consumed
+            missing = [self.get_tombstone_key(ticket) for ticket in candidates if ticket not in tickets]
+            if missing:
+                tombstones = get_cache().get_many(missing)
+
+        for i, (ticket, service) in enumerate(items):
+            if results[i] is not None:
+                continue
+            t = tickets.get(ticket)
+            try:
+                if t is None:
+                    if self.get_tombstone_key(ticket) in tombstones:
+                        raise InvalidTicket("%s %s has already been used" %
+                                            (self.model._meta.verbose_name, ticket))
+                    raise InvalidTicket("Ticket %s does not exist" % ticket)
+
+                if ticket not in fresh:
+                    raise InvalidTicket("%s %s has already been used" %
+                                        (t.name, ticket))
+                # A repeated ticket is only valid the first time
+                fresh.discard(ticket)
+
+                self.check_ticket(t, service, renew=renew, require_https=require_https)
+                results[i] = t
+            except ValidationError as e:
+                results[i] = e
+        return results
+
+    def discard_ticket(self, ticket):
+        """
+        Consumed ``ServiceTicket``s for services with single logout
+        enabled are retained, as they are needed to send logout
+        requests when the user's session ends.
+        """
+        if logout_allowed(ticket.service):
+            return
+        super(ServiceTicketManager, self).discard_ticket(ticket)
+
     def request_sign_out(self, user):
         """
         Send a single logout request to each service accessed by a
@@ -236,6 +422,7 @@ class ServiceTicket(Ticket):
     class Meta:
         verbose_name = _('service ticket')
         verbose_name_plural = _('service tickets')
+        indexes = [models.Index(fields=['user', 'consumed', 'expires'])]
 
     def is_primary(self):
         """
@@ -252,9 +439,10 @@ class ServiceTicket(Ticket):
         Send a POST request to the ``ServiceTicket``s logout URL to
         request sign-out.
         """
-        if logout_allowed(self.service):
+        service = get_service_context(self.service)
+        if logout_allowed(service):
             request = SingleSignOutRequest(context={'ticket': self})
-            url = get_logout_url(self.service) or self.service
+            url = get_logout_url(service) or self.service
             session.post(url, data={'logoutRequest': request.render_content()})
             logger.info("Single sign-out request sent to %s" % url)
 
@@ -276,6 +464,7 @@ class ProxyTicket(Ticket):
     class Meta:
         verbose_name = _('proxy ticket')
         verbose_name_plural = _('proxy tickets')
+        indexes = [models.Index(fields=['user', 'consumed', 'expires'])]
 
 
 class ProxyGrantingTicketManager(TicketManager):
@@ -298,6 +487,16 @@ class ProxyGrantingTicketManager(TicketManager):
             # previously generated ticket strings
             return super(ProxyGrantingTicketManager, self).create_ticket(ticket=pgtid, iou=pgtiou, **kwargs)
 
+    def get_invalid_filter(self):
+        """
+        In addition to consumed or expired tickets, match
+        ``ProxyGrantingTicket``s that have exceeded the idle timeout.
+        """
+        q = super(ProxyGrantingTicketManager, self).get_invalid_filter()
+        if self.model.TICKET_IDLE_EXPIRE:
+            q |= Q(last_used__lte=now() - timedelta(seconds=self.model.TICKET_IDLE_EXPIRE))
+        return q
+
     def validate_callback(self, service, pgturl, pgtid, pgtiou):
         """Verify the provided proxy callback URL."""
         if not proxy_allowed(service):
@@ -341,8 +540,11 @@ class ProxyGrantingTicket(Ticket):
     TICKET_PREFIX = 'PGT'
     IOU_PREFIX = 'PGTIOU'
     TICKET_EXPIRE = getattr(settings, 'SESSION_COOKIE_AGE')
+    TICKET_IDLE_EXPIRE = getattr(settings, 'MAMA_CAS_PGT_IDLE_EXPIRE', None)
+    TOUCH_INTERVAL = getattr(settings, 'MAMA_CAS_PGT_TOUCH_INTERVAL', 60)
 
     iou = models.CharField(_('iou'), max_length=255, unique=True)
+    last_used = models.DateTimeField(_('last used'), default=now)
     granted_by_st = models.ForeignKey(ServiceTicket, null=True, blank=True,
                                       on_delete=models.PROTECT,
                                       verbose_name=_('granted by service ticket'))
@@ -355,7 +557,180 @@ class ProxyGrantingTicket(Ticket):
     class Meta:
         verbose_name = _('proxy-granting ticket')
         verbose_name_plural = _('proxy-granting tickets')
+        indexes = [models.Index(fields=['user', 'consumed', 'expires'])]
 
     def is_consumed(self):
         """Check a ``ProxyGrantingTicket``s consumed state."""
         return self.consumed is not None
+
+    def is_expired(self):
+        """
+        Check a ``ProxyGrantingTicket``s expired state. In addition to
+        the absolute expiry, the ticket expires once it has not been
+        used for ``TICKET_IDLE_EXPIRE`` seconds, if configured.
+        """
+        if super(ProxyGrantingTicket, self).is_expired():
+            return True
+        if self.TICKET_IDLE_EXPIRE:
+            return self.last_used + timedelta(seconds=self.TICKET_IDLE_EXPIRE) <= now()
+        return False
+
+    def touch(self):
+        """
+        Record that the ``ProxyGrantingTicket`` was used. To avoid a
+        write on every proxy request, the timestamp is only updated
+        once ``TOUCH_INTERVAL`` seconds have passed since it was last
+        recorded.
+        """
+        current = now()
+        if self.last_used > current - timedelta(seconds=self.TOUCH_INTERVAL):
+            return
+        self.last_used = current
+        self.__class__.objects.filter(pk=self.pk).update(last_used=current)
+
+
+class ServiceDefinition(models.Model):
+    """
+    A ``ServiceDefinition`` configures an allowed service for use with
+    ``DatabaseBackend``. Each definition corresponds to an entry in
+    ``MAMA_CAS_SERVICES``, and definitions are matched in order of
+    ``position``.
+    """
+    position = models.IntegerField(_('position'), default=0)
+    service = models.CharField(_('service pattern'), max_length=255, blank=True)
+    url = models.CharField(_('URL'), max_length=255, blank=True)
+    host = models.CharField(_('host'), max_length=255, blank=True)
+    scheme = models.CharField(_('scheme'), max_length=16, blank=True)
+    path = models.CharField(_('path prefix'), max_length=255, blank=True)
+    callbacks = models.TextField(_('callbacks'), blank=True)
+    logout_allow = models.BooleanField(_('logout allowed'), default=False)
+    logout_url = models.CharField(_('logout URL'), max_length=255, blank=True)
+    proxy_allow = models.BooleanField(_('proxy allowed'), default=False)
+    proxy_pattern = models.CharField(_('proxy pattern'), max_length=255, blank=True)
+    attribute_ttl = models.PositiveIntegerField(_('attribute cache TTL'), null=True, blank=True)
+    release = models.TextField(_('released attributes'), blank=True)
+
+    class Meta:
+        verbose_name = _('service definition')
+        verbose_name_plural = _('service definitions')
+        ordering = ['position', 'pk']
+
+    def __str__(self):
+        return self.service or self.url or self.host
+
+    def clean(self):
+        """
+        Require exactly one of a service pattern, URL or host, and valid
+        regular expressions, as an invalid definition would fail every
+        service lookup once loaded.
+        """
+        matches = [name for name in ('service', 'url', 'host') if getattr(self, name)]
+        if len(matches) != 1:
+            raise DjangoValidationError(_('Exactly one of a service pattern, URL or host is required.'))
+        errors = {}
+        for name in ('service', 'proxy_pattern'):
+            try:
+                re.compile(getattr(self, name))
+            except re.error as e:
+                errors[name] = _('Invalid regular expression: %s') % e
+        if errors:
+            raise DjangoValidationError(errors)
+
+    def to_config(self):
+        """
+        Return the definition as a ``MAMA_CAS_SERVICES`` dictionary.
+        Callbacks and released attributes are stored one per line, and
+        all attributes are released if none are listed.
+        """
+        config = {
+            'CALLBACKS': self.callbacks.split(),
+            'LOGOUT_ALLOW': self.logout_allow,
+            'LOGOUT_URL': self.logout_url or None,
+            'PROXY_ALLOW': self.proxy_allow,
+        }
+        if self.proxy_pattern:
+            config['PROXY_PATTERN'] = self.proxy_pattern
+        if self.attribute_ttl is not None:
+            config['ATTRIBUTE_TTL'] = self.attribute_ttl
+        if self.release.strip():
+            config['RELEASE'] = self.release.split()
+        if self.service:
+            config['SERVICE'] = self.service
+        elif self.url:
+            config['URL'] = self.url
+        elif self.host:
+            config['HOST'] = self.host
+            if self.scheme:
+                config['SCHEME'] = self.scheme
+            if self.path:
+                config['PATH'] = self.path
+        return config
+
+
+@receiver(post_save, sender=ServiceDefinition)
+@receiver(post_delete, sender=ServiceDefinition)
+def service_definition_changed(sender, **kwargs):
+    update_services_version()
+
+
+@receiver(post_save, sender=settings.AUTH_USER_MODEL)
+def user_changed(sender, instance, update_fields=None, **kwargs):
+    # Logging in only updates last_login, which would otherwise
+    # invalidate cached attributes on every login
+    if update_fields and set(update_fields) == {'last_login'}:
+        return
+    invalidate_attributes(instance)
+
+
+def invalidate_users(pks):
+    """Invalidate the cached groups, permissions and attributes of users."""
+    pks = list(pks)
+    if not pks:
+        return
+    invalidate_groups(pks)
+    user_model = get_user_model()
+    invalidate_attributes(*[user_model(pk=pk) for pk in pks])
+
+
+def get_group_members(groups):
+    return get_user_model().objects.filter(groups__in=groups).values_list('pk', flat=True).distinct()
+
+
+def user_groups_changed(sender, instance, action, reverse, pk_set=None, **kwargs):
+    if not reverse:
+        if action in ('post_add', 'post_remove', 'post_clear'):
+            invalidate_users([instance.pk])
+    elif action in ('post_add', 'post_remove'):
+        invalidate_users(pk_set)
+    elif action == 'pre_clear':
+        # The members are unknown once the relation is cleared
+        invalidate_users(instance.user_set.values_list('pk', flat=True))
+
+
+def connect_user_signals(user_model):
+    """
+    Invalidate cached groups and permissions when the user model's
+    ``groups`` or ``user_permissions`` relations change. Custom user
+    models without these relations are skipped.
+    """
+    for field in user_model._meta.many_to_many:
+        if field.name in ('groups', 'user_permissions'):
+            m2m_changed.connect(user_groups_changed, sender=field.remote_field.through,
+                                dispatch_uid='mama_cas_user_%s' % field.name)
+
+
+@receiver(m2m_changed, sender=Group.permissions.through)
+def group_permissions_changed(sender, instance, action, reverse, pk_set=None, **kwargs):
+    if not reverse:
+        if action in ('post_add', 'post_remove', 'post_clear'):
+            invalidate_users(get_group_members([instance.pk]))
+    elif action in ('post_add', 'post_remove'):
+        invalidate_users(get_group_members(pk_set))
+    elif action == 'pre_clear':
+        invalidate_users(get_group_members(instance.group_set.all()))
+
+
+@receiver(post_save, sender=Group)
+@receiver(pre_delete, sender=Group)
+def group_changed(sender, instance, **kwargs):
+    invalidate_users(get_group_members([instance.pk]))
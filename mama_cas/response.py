@@ -1,4 +1,5 @@
 import datetime
+import json
 
 from django.http import HttpResponse
 from django.utils.crypto import get_random_string
@@ -7,15 +8,55 @@ from django.utils.encoding import force_str
 from .compat import etree
 
 
+def escape_text(text):
+    """Escape character data as ``ElementTree`` serializes it."""
+    if '&' in text:
+        text = text.replace('&', '&amp;')
+    if '<' in text:
+        text = text.replace('<', '&lt;')
+    if '>' in text:
+        text = text.replace('>', '&gt;')
+    return text
+
+
+def escape_attribute(text):
+    """Escape an attribute value as ``ElementTree`` serializes it."""
+    text = escape_text(text)
+    if '"' in text:
+        text = text.replace('"', '&quot;')
+    if '\r' in text:
+        text = text.replace('\r', '&#13;')
+    if '\n' in text:
+        text = text.replace('\n', '&#10;')
+    if '\t' in text:
+        text = text.replace('\t', '&#09;')
+    return text
+
+
+def write_element(parts, tag, text):
+    """
+    Append an element with escaped text to a list of fragments. As with
+    ``ElementTree``, an element without text is written self-closing.
+    """
+    if text:
+        parts.extend(('<', tag, '>', escape_text(text), '</', tag, '>'))
+    else:
+        parts.extend(('<', tag, ' />'))
+
+
 class CasResponseBase(HttpResponse):
     """
-    Base class for CAS 2.0 XML format responses.
+    Base class for CAS 2.0 XML format responses. Each subclass's
+    namespace is registered with ``ElementTree`` when it is defined.
     """
     prefix = 'cas'
     uri = 'http://www.yale.edu/tp/cas'
 
+    def __init_subclass__(cls, **kwargs):
+        super(CasResponseBase, cls).__init_subclass__(**kwargs)
+        etree.register_namespace(cls.prefix, cls.uri)
+
     def __init__(self, context, **kwargs):
-        etree.register_namespace(self.prefix, self.uri)
         content = self.render_content(context)
         super(CasResponseBase, self).__init__(content, **kwargs)
 
@@ -27,7 +68,34 @@ class CasResponseBase(HttpResponse):
         return etree.QName(self.uri, tag)
 
 
-class ValidationResponse(CasResponseBase):
+class ServiceResponseBase(CasResponseBase):
+    """
+    Base class for responses written directly as text, rather than
+    built as an ``ElementTree``, with output identical to serializing
+    the equivalent tree. Subclasses implement ``render_parts()`` to
+    append fragments within the ``serviceResponse`` element.
+    """
+    def render_content(self, context):
+        ns = self.prefix + ':'
+        parts = []
+        self.render_parts(parts, ns, context)
+        root = '<%sserviceResponse xmlns:%s="%s"' % (ns, self.prefix, escape_attribute(self.uri))
+        if parts:
+            content = '%s>%s</%sserviceResponse>' % (root, ''.join(parts), ns)
+        else:
+            content = root + ' />'
+        return content.encode('utf-8', 'xmlcharrefreplace')
+
+    def render_failure(self, parts, tag, error):
+        parts.extend(('<', tag, ' code="', escape_attribute(error.code), '"'))
+        text = str(error)
+        if text:
+            parts.extend(('>', escape_text(text), '</', tag, '>'))
+        else:
+            parts.append(' />')
+
+
+class ValidationResponse(ServiceResponseBase):
     """
     (2.6.2) Render an XML format CAS service response for a
     ticket validation success or failure.
@@ -53,45 +121,44 @@ class ValidationResponse(CasResponseBase):
         </cas:authenticationFailure>
     </cas:serviceResponse>
     """
-    def render_content(self, context):
+    def render_parts(self, parts, ns, context):
         ticket = context.get('ticket')
         error = context.get('error')
         attributes = context.get('attributes')
         pgt = context.get('pgt')
         proxies = context.get('proxies')
 
-        service_response = etree.Element(self.ns('serviceResponse'))
         if ticket:
-            auth_success = etree.SubElement(service_response, self.ns('authenticationSuccess'))
-            user = etree.SubElement(auth_success, self.ns('user'))
-            user.text = ticket.user.get_username()
+            parts.extend(('<', ns, 'authenticationSuccess>'))
+            write_element(parts, ns + 'user', ticket.user.get_username())
             if attributes:
-                attribute_set = etree.SubElement(auth_success, self.ns('attributes'))
+                values = []
                 for name, value in attributes.items():
+                    tag = '%s%s' % (ns, name)
                     if isinstance(value, list):
                         for v in value:
-                            attr = etree.SubElement(attribute_set, self.ns(name))
-                            attr.text = force_str(v)
+                            write_element(values, tag, force_str(v))
                     else:
-                        attr = etree.SubElement(attribute_set, self.ns(name))
-                        attr.text = force_str(value)
+                        write_element(values, tag, force_str(value))
+                if values:
+                    parts.extend(('<', ns, 'attributes>'))
+                    parts.extend(values)
+                    parts.extend(('</', ns, 'attributes>'))
+                else:
+                    parts.extend(('<', ns, 'attributes />'))
             if pgt:
-                proxy_granting_ticket = etree.SubElement(auth_success, self.ns('proxyGrantingTicket'))
-                proxy_granting_ticket.text = pgt.iou
+                write_element(parts, ns + 'proxyGrantingTicket', pgt.iou)
             if proxies:
-                proxy_list = etree.SubElement(auth_success, self.ns('proxies'))
+                parts.extend(('<', ns, 'proxies>'))
                 for p in proxies:
-                    proxy = etree.SubElement(proxy_list, self.ns('proxy'))
-                    proxy.text = p
+                    write_element(parts, ns + 'proxy', p)
+                parts.extend(('</', ns, 'proxies>'))
+            parts.extend(('</', ns, 'authenticationSuccess>'))
         elif error:  # pragma: no branch
-            auth_failure = etree.SubElement(service_response, self.ns('authenticationFailure'))
-            auth_failure.set('code', error.code)
-            auth_failure.text = str(error)
-
-        return etree.tostring(service_response, encoding='UTF-8')
+            self.render_failure(parts, ns + 'authenticationFailure', error)
 
 
-class ProxyResponse(CasResponseBase):
+class ProxyResponse(ServiceResponseBase):
     """
     (2.7.2) Render an XML format CAS service response for a proxy
     request success or failure.
@@ -112,21 +179,16 @@ class ProxyResponse(CasResponseBase):
         </cas:proxyFailure>
     </cas:serviceResponse>
     """
-    def render_content(self, context):
+    def render_parts(self, parts, ns, context):
         ticket = context.get('ticket')
         error = context.get('error')
 
-        service_response = etree.Element(self.ns('serviceResponse'))
         if ticket:
-            proxy_success = etree.SubElement(service_response, self.ns('proxySuccess'))
-            proxy_ticket = etree.SubElement(proxy_success, self.ns('proxyTicket'))
-            proxy_ticket.text = ticket.ticket
+            parts.extend(('<', ns, 'proxySuccess>'))
+            write_element(parts, ns + 'proxyTicket', ticket.ticket)
+            parts.extend(('</', ns, 'proxySuccess>'))
         elif error:  # pragma: no branch
-            proxy_failure = etree.SubElement(service_response, self.ns('proxyFailure'))
-            proxy_failure.set('code', error.code)
-            proxy_failure.text = str(error)
-
-        return etree.tostring(service_response, encoding='UTF-8')
+            self.render_failure(parts, ns + 'proxyFailure', error)
 
 
 class SamlValidationResponse(CasResponseBase):
@@ -269,3 +331,115 @@ class SamlValidationResponse(CasResponseBase):
         method = etree.SubElement(subject_confirmation, 'ConfirmationMethod')
         method.text = self.confirmation_method
         return subject
+
+
+class JsonResponseBase(HttpResponse):
+    """
+    Base class for CAS 3.0 JSON format responses. Static parts of each
+    response are precomputed, so only values are encoded per response.
+    """
+    def __init__(self, context, **kwargs):
+        kwargs.setdefault('content_type', 'application/json')
+        content = self.render_content(context)
+        super(JsonResponseBase, self).__init__(content, **kwargs)
+
+    def dumps(self, value):
+        return json.dumps(value, default=force_str)
+
+    def render_failure(self, prefix, error):
+        return '%s{"code":%s,"description":%s}}}' % (prefix, self.dumps(error.code), self.dumps(str(error)))
+
+
+class JsonValidationResponse(JsonResponseBase):
+    """
+    (2.5.2) Render a JSON format CAS service response for a ticket
+    validation success or failure. Attribute values are always rendered
+    as lists.
+
+    On validation success:
+
+    {"serviceResponse": {"authenticationSuccess": {
+        "user": "username",
+        "proxyGrantingTicket": "PGTIOU-84678-8a9d...",
+        "proxies": ["https://proxy2/pgtUrl", "https://proxy1/pgtUrl"],
+        "attributes": {"email": ["ellen@example.com"]}
+    }}}
+
+    On validation failure:
+
+    {"serviceResponse": {"authenticationFailure": {
+        "code": "INVALID_TICKET",
+        "description": "Ticket ST-1856339-aA5Yuvrxzpv8Tau1cYQ7 not recognized"
+    }}}
+    """
+    success_prefix = '{"serviceResponse":{"authenticationSuccess":{"user":'
+    success_suffix = '}}}'
+    failure_prefix = '{"serviceResponse":{"authenticationFailure":'
+
+    def render_content(self, context):
+        ticket = context.get('ticket')
+        error = context.get('error')
+        attributes = context.get('attributes')
+        pgt = context.get('pgt')
+        proxies = context.get('proxies')
+
+        if not ticket:
+            return self.render_failure(self.failure_prefix, error)
+
+        parts = [self.success_prefix, self.dumps(ticket.user.get_username())]
+        if attributes:
+            attributes = dict((name, value if isinstance(value, list) else [value])
+                              for name, value in attributes.items())
+            parts.extend([',"attributes":', self.dumps(attributes)])
+        if pgt:
+            parts.extend([',"proxyGrantingTicket":', self.dumps(pgt.iou)])
+        if proxies:
+            parts.extend([',"proxies":', self.dumps(proxies)])
+        parts.append(self.success_suffix)
+        return ''.join(parts)
+
+
+class JsonProxyResponse(JsonResponseBase):
+    """
+    (2.7.2) Render a JSON format CAS service response for a proxy
+    request success or failure.
+
+    On request success:
+
+    {"serviceResponse": {"proxySuccess": {"proxyTicket": "PT-1856392-b98xZrQN4p90ASrw96c8"}}}
+
+    On request failure:
+
+    {"serviceResponse": {"proxyFailure": {
+        "code": "INVALID_REQUEST",
+        "description": "'pgt' and 'targetService' parameters are both required"
+    }}}
+    """
+    success_prefix = '{"serviceResponse":{"proxySuccess":{"proxyTicket":'
+    failure_prefix = '{"serviceResponse":{"proxyFailure":'
+
+    def render_content(self, context):
+        ticket = context.get('ticket')
+        error = context.get('error')
+
+        if not ticket:
+            return self.render_failure(self.failure_prefix, error)
+        return '%s%s}}}' % (self.success_prefix, self.dumps(ticket.ticket))
+
+
+class BatchValidationResponse(JsonValidationResponse):
+    """
+    Render a JSON response to a batch validation request, containing a
+    CAS 3.0 JSON format service response for each ticket in order.
+
+    {"results": [
+        {"serviceResponse": {"authenticationSuccess": {"user": "username"}}},
+        {"serviceResponse": {"authenticationFailure": {
+            "code": "INVALID_TICKET",
+            "description": "Ticket ST-1856339-aA5Yuvrxzpv8Tau1cYQ7 does not exist"
+        }}}
+    ]}
+    """
+    def render_content(self, contexts):
+        render = super(BatchValidationResponse, self).render_content
+        return '{"results":[%s]}' % ','.join(render(context) for context in contexts)
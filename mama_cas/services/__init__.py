@@ -1,21 +1,179 @@
+from collections import namedtuple
+from collections import OrderedDict
 import re
+import threading
 import warnings
 
 from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from django.utils.functional import cached_property
 from django.utils.module_loading import import_string
 
+from mama_cas.services.backends import services as settings_services
+
+
+CacheInfo = namedtuple('CacheInfo', ['hits', 'misses', 'evictions', 'maxsize', 'currsize'])
+
+
+class ServiceCache(object):
+    """
+    A bounded, thread-safe LRU cache of ``ServiceContext``s keyed by
+    service identifier, so frequently seen services are resolved against
+    the backends once rather than on every request.
+    """
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._contexts = OrderedDict()
+
+    def get(self, service):
+        with self._lock:
+            try:
+                context = self._contexts[service]
+            except KeyError:
+                self.misses += 1
+            else:
+                self._contexts.move_to_end(service)
+                self.hits += 1
+                return context
+
+        context = ServiceContext(service)
+        with self._lock:
+            self._contexts[service] = context
+            while len(self._contexts) > self.maxsize:
+                self._contexts.popitem(last=False)
+                self.evictions += 1
+        return context
+
+    def clear(self):
+        with self._lock:
+            self._contexts.clear()
+
+    def info(self):
+        return CacheInfo(self.hits, self.misses, self.evictions, self.maxsize, len(self._contexts))
+
+
+def is_cacheable_backend(backend):
+    """
+    Return whether a backend's results may be cached. This must be
+    declared by the backend's own class, so subclasses overriding its
+    methods with other logic are not cached without opting in.
+    """
+    return type(backend).__dict__.get('cacheable', False)
+
+
+class BackendRegistry(object):
+    """
+    Resolve the configured service backends, along with the deprecated
+    service settings, once and share them between requests. The
+    registry is reloaded on the next access after ``reset()`` is called,
+    which happens automatically when a relevant setting changes.
+
+    If every backend's own class declares itself ``cacheable``, resolved
+    services are also kept in a ``ServiceCache`` of ``MAMA_CAS_SERVICE_CACHE_SIZE``
+    entries, which is discarded along with the rest of the registry.
+    """
+    settings = (
+        'MAMA_CAS_SERVICE_BACKENDS',
+        'MAMA_CAS_SERVICES',
+        'MAMA_CAS_VALID_SERVICES',
+        'MAMA_CAS_ATTRIBUTE_CALLBACKS',
+        'MAMA_CAS_SERVICE_CACHE_SIZE',
+        'MAMA_CAS_ENABLE_SINGLE_SIGN_OUT',
+    )
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._state = None
+
+    def _get_state(self):
+        state = self._state
+        if state is None:
+            with self._lock:
+                if self._state is None:
+                    self._state = self.load()
+                state = self._state
+        return state
+
+    def load(self):
+        backend_paths = getattr(
+            settings, 'MAMA_CAS_SERVICE_BACKENDS',
+            ['mama_cas.services.backends.SettingsBackend']
+        )
+        backends = tuple(import_string(backend_path)() for backend_path in backend_paths)
+
+        callbacks = tuple(getattr(settings, 'MAMA_CAS_ATTRIBUTE_CALLBACKS', []))
+        if callbacks:
+            warnings.warn(
+                'The MAMA_CAS_ATTRIBUTE_CALLBACKS setting is deprecated. Service callbacks '
+                'should be configured using MAMA_CAS_SERVICES.', DeprecationWarning)
+
+        valid_services = getattr(settings, 'MAMA_CAS_VALID_SERVICES', ())
+        if valid_services:
+            warnings.warn(
+                'The MAMA_CAS_VALID_SERVICES setting is deprecated. Services '
+                'should be configured using MAMA_CAS_SERVICES.', DeprecationWarning)
+        valid_services = tuple(re.compile(s) for s in valid_services)
+
+        cache = None
+        cache_size = getattr(settings, 'MAMA_CAS_SERVICE_CACHE_SIZE', 1024)
+        if cache_size and all(is_cacheable_backend(backend) for backend in backends):
+            cache = ServiceCache(cache_size)
+
+        return backends, callbacks, valid_services, cache
+
+    def reset(self):
+        with self._lock:
+            self._state = None
+        settings_services.reset()
+
+    @property
+    def backends(self):
+        return self._get_state()[0]
+
+    @property
+    def callbacks(self):
+        """Callbacks configured with ``MAMA_CAS_ATTRIBUTE_CALLBACKS``."""
+        return self._get_state()[1]
+
+    @property
+    def valid_services(self):
+        """Compiled patterns from ``MAMA_CAS_VALID_SERVICES``."""
+        return self._get_state()[2]
+
+    @property
+    def cache(self):
+        """The ``ServiceCache``, or ``None`` if caching is disabled."""
+        return self._get_state()[3]
+
+    def cache_info(self):
+        """
+        Return the hits, misses, evictions, maximum and current size of
+        the service cache, or ``None`` if caching is disabled.
+        """
+        cache = self.cache
+        if cache is None:
+            return None
+        return cache.info()
+
+
+registry = BackendRegistry()
+
+
+@receiver(setting_changed)
+def reset_registry(setting, **kwargs):
+    """Reload service configuration when a relevant setting changes."""
+    if setting in BackendRegistry.settings:
+        registry.reset()
+
 
 def _get_backends():
     """Retrieve the list of configured service backends."""
-    backends = []
-    backend_paths = getattr(
-        settings, 'MAMA_CAS_SERVICE_BACKENDS',
-        ['mama_cas.services.backends.SettingsBackend']
-    )
-    for backend_path in backend_paths:
-        backend = import_string(backend_path)()
-        backends.append(backend)
-    return backends
+    return registry.backends
 
 
 def _is_allowed(attr, *args):
@@ -36,24 +194,21 @@ def _is_allowed(attr, *args):
 
 def _is_valid_service_url(url):
     """Access services list from ``MAMA_CAS_VALID_SERVICES``."""
-    valid_services = getattr(settings, 'MAMA_CAS_VALID_SERVICES', ())
+    valid_services = registry.valid_services
     if not valid_services:
         return True
-    warnings.warn(
-        'The MAMA_CAS_VALID_SERVICES setting is deprecated. Services '
-        'should be configured using MAMA_CAS_SERVICES.', DeprecationWarning)
-    for service in [re.compile(s) for s in valid_services]:
+    for service in valid_services:
         if service.match(url):
             return True
     return False
 
 
-def get_backend_path(service):
-    """Return the dotted path of the matching backend."""
+def _get_backend(service):
+    """Return the first backend allowing the service, if any."""
     for backend in _get_backends():
         try:
             if backend.service_allowed(service):
-                return "%s.%s" % (backend.__class__.__module__, backend.__class__.__name__)
+                return backend
         except AttributeError:
             raise NotImplementedError("%s.%s.service_allowed() not implemented" % (
                 backend.__class__.__module__, backend.__class__.__name__)
@@ -61,14 +216,15 @@ def get_backend_path(service):
     return None
 
 
-def get_callbacks(service):
-    """Get configured callbacks list for a given service identifier."""
-    callbacks = list(getattr(settings, 'MAMA_CAS_ATTRIBUTE_CALLBACKS', []))
-    if callbacks:
-        warnings.warn(
-            'The MAMA_CAS_ATTRIBUTE_CALLBACKS setting is deprecated. Service callbacks '
-            'should be configured using MAMA_CAS_SERVICES.', DeprecationWarning)
+def _get_backend_path(service):
+    backend = _get_backend(service)
+    if backend is None:
+        return None
+    return "%s.%s" % (backend.__class__.__module__, backend.__class__.__name__)
+
 
+def _get_callbacks(service):
+    callbacks = list(registry.callbacks)
     for backend in _get_backends():
         try:
             callbacks.extend(backend.get_callbacks(service))
@@ -79,8 +235,65 @@ def get_callbacks(service):
     return callbacks
 
 
-def get_logout_url(service):
-    """Get the configured logout URL for a given service identifier, if any."""
+def _get_optional(attr, service, default=None):
+    """
+    Return the result of an optional method of the first backend
+    allowing the service, so backends written before it was added keep
+    working.
+    """
+    method = getattr(_get_backend(service), attr, None)
+    if method is None:
+        return default
+    return method(service)
+
+
+def _get_attribute_ttl(service):
+    return _get_optional('get_attribute_ttl', service)
+
+
+def _get_release(service):
+    release = _get_optional('get_release', service)
+    if release is None:
+        return None
+    return frozenset(release)
+
+
+def _get_pipeline(callbacks, release):
+    """
+    Resolve callback paths to callables, each called at most once. A
+    repeated callback keeps its last position so its results take the
+    same precedence. With a release allowlist, callbacks that cannot
+    provide a released attribute are dropped.
+    """
+    from mama_cas.attributes import is_released
+    pipeline = []
+    seen = set()
+    for path in reversed(callbacks):
+        if path in seen:
+            continue
+        seen.add(path)
+        callback = import_string(path)
+        if release is None or is_released(callback, release):
+            pipeline.append((path, callback))
+    pipeline.reverse()
+    return tuple(pipeline)
+
+
+def _get_user_fields(pipeline):
+    """
+    Return the user fields required by every callback in a pipeline,
+    or ``None`` if any callback does not declare ``user_fields``.
+    """
+    fields = set()
+    for path, callback in pipeline:
+        user_fields = getattr(callback, 'user_fields', None)
+        if user_fields is None:
+            return None
+        fields.update(user_fields)
+    return frozenset(fields)
+
+
+def _get_logout_url(service):
     for backend in _get_backends():
         try:
             return backend.get_logout_url(service)
@@ -91,8 +304,7 @@ def get_logout_url(service):
     return None
 
 
-def logout_allowed(service):
-    """Check if a given service identifier should be sent a logout request."""
+def _logout_allowed(service):
     if hasattr(settings, 'MAMA_CAS_SERVICES'):
         return _is_allowed('logout_allowed', service)
 
@@ -103,20 +315,207 @@ def logout_allowed(service):
     return getattr(settings, 'MAMA_CAS_ENABLE_SINGLE_SIGN_OUT', False)
 
 
-def proxy_allowed(service):
-    """Check if a given service identifier is allowed to proxy requests."""
+def _proxy_allowed(service):
     return _is_allowed('proxy_allowed', service)
 
 
-def proxy_callback_allowed(service, pgturl):
-    """Check if a given proxy callback is allowed for the given service identifier."""
+def _proxy_callback_allowed(service, pgturl):
     if hasattr(settings, 'MAMA_CAS_SERVICES'):
         return _is_allowed('proxy_callback_allowed', service, pgturl)
     return _is_valid_service_url(service)
 
 
-def service_allowed(service):
-    """Check if a given service identifier is authorized."""
+def _service_allowed(service):
     if hasattr(settings, 'MAMA_CAS_SERVICES'):
         return _is_allowed('service_allowed', service)
     return _is_valid_service_url(service)
+
+
+class ServiceContext(object):
+    """
+    The resolved configuration of a single service identifier. Each
+    lookup against the service backends, other than proxy callback
+    checks, is performed at most once, and its ``ServiceURL`` is retained,
+    so a context can be passed in place of the service identifier while
+    handling a request to avoid resolving the same service repeatedly.
+    The service query functions in this module accept either a context
+    or a service identifier.
+    """
+    def __init__(self, service):
+        self.service = service
+
+    def __str__(self):
+        return self.service
+
+    def __repr__(self):
+        return '<ServiceContext: %s>' % self.service
+
+    def get_context(self, service):
+        """
+        Return this context if it is for the given service identifier,
+        or the context for that identifier otherwise.
+        """
+        if service == self.service:
+            return self
+        return get_service_context(service)
+
+    @cached_property
+    def url(self):
+        from mama_cas.utils import get_service_url
+        return get_service_url(self.service)
+
+    @cached_property
+    def allowed(self):
+        return _service_allowed(self.service)
+
+    @cached_property
+    def attribute_ttl(self):
+        return _get_attribute_ttl(self.service)
+
+    @cached_property
+    def release(self):
+        return _get_release(self.service)
+
+    @cached_property
+    def backend_path(self):
+        return _get_backend_path(self.service)
+
+    @cached_property
+    def callbacks(self):
+        return tuple(_get_callbacks(self.service))
+
+    @cached_property
+    def pipeline(self):
+        """The resolved ``(path, callback)`` pairs to call for attributes."""
+        return _get_pipeline(self.callbacks, self.release)
+
+    @cached_property
+    def user_fields(self):
+        return _get_user_fields(self.pipeline)
+
+    @cached_property
+    def logout_allowed(self):
+        return _logout_allowed(self.service)
+
+    @cached_property
+    def logout_url(self):
+        return _get_logout_url(self.service)
+
+    @cached_property
+    def proxy_allowed(self):
+        return _proxy_allowed(self.service)
+
+    def proxy_callback_allowed(self, pgturl):
+        # Not retained, as callback URLs are supplied by the client
+        return _proxy_callback_allowed(self.service, pgturl)
+
+
+def get_service_context(service):
+    """
+    Return a ``ServiceContext`` for a service identifier, from the
+    service cache if enabled. A context or an empty identifier is
+    returned unchanged.
+    """
+    if not service or isinstance(service, ServiceContext):
+        return service
+    cache = registry.cache
+    if cache is None:
+        return ServiceContext(service)
+    return cache.get(service)
+
+
+def get_attribute_ttl(service):
+    """Get the number of seconds attributes are cached for a given service identifier, if any."""
+    context = get_service_context(service)
+    if context:
+        return context.attribute_ttl
+    return _get_attribute_ttl(service)
+
+
+def get_release(service):
+    """
+    Get the set of attribute names released to a given service
+    identifier, or ``None`` if all attributes are released.
+    """
+    context = get_service_context(service)
+    if context:
+        return context.release
+    return _get_release(service)
+
+
+def get_backend_path(service):
+    """Return the dotted path of the matching backend."""
+    context = get_service_context(service)
+    if context:
+        return context.backend_path
+    return _get_backend_path(service)
+
+
+def get_callbacks(service):
+    """Get configured callbacks list for a given service identifier."""
+    context = get_service_context(service)
+    if context:
+        return list(context.callbacks)
+    return _get_callbacks(service)
+
+
+def get_pipeline(service):
+    """
+    Get the resolved ``(path, callback)`` pairs to call for a given
+    service identifier's attributes.
+    """
+    context = get_service_context(service)
+    if context:
+        return context.pipeline
+    return _get_pipeline(_get_callbacks(service), _get_release(service))
+
+
+def get_user_fields(service):
+    """
+    Get the user fields read by the attribute callbacks for a given
+    service identifier, or ``None`` if they are not all declared.
+    """
+    context = get_service_context(service)
+    if context:
+        return context.user_fields
+    return _get_user_fields(get_pipeline(service))
+
+
+def get_logout_url(service):
+    """Get the configured logout URL for a given service identifier, if any."""
+    context = get_service_context(service)
+    if context:
+        return context.logout_url
+    return _get_logout_url(service)
+
+
+def logout_allowed(service):
+    """Check if a given service identifier should be sent a logout request."""
+    context = get_service_context(service)
+    if context:
+        return context.logout_allowed
+    return _logout_allowed(service)
+
+
+def proxy_allowed(service):
+    """Check if a given service identifier is allowed to proxy requests."""
+    context = get_service_context(service)
+    if context:
+        return context.proxy_allowed
+    return _proxy_allowed(service)
+
+
+def proxy_callback_allowed(service, pgturl):
+    """Check if a given proxy callback is allowed for the given service identifier."""
+    context = get_service_context(service)
+    if context:
+        return context.proxy_callback_allowed(pgturl)
+    return _proxy_callback_allowed(service, pgturl)
+
+
+def service_allowed(service):
+    """Check if a given service identifier is authorized."""
+    context = get_service_context(service)
+    if context:
+        return context.allowed
+    return _service_allowed(service)
@@ -1,58 +1,253 @@
+from collections import namedtuple
+import json
+import logging
+import os
 import re
+import threading
+import time
+from urllib.parse import urlparse
+import uuid
+
+try:
+    from re import _parser as sre_parse
+except ImportError:  # Python < 3.11
+    import sre_parse
 
 from django.conf import settings
 from django.core.exceptions import ImproperlyConfigured
 from django.utils.functional import cached_property
 
 
+logger = logging.getLogger(__name__)
+
+
+class HostTrie(object):
+    """
+    A trie of host name labels stored in reverse order, so that all
+    wildcard host patterns (e.g. ``*.example.com``) matching a given host
+    are found by walking its labels once, regardless of how many
+    patterns are configured.
+    """
+    def __init__(self):
+        self.root = {}
+
+    def add(self, domain, value):
+        node = self.root
+        for label in reversed(domain.split('.')):
+            node = node.setdefault(label, {})
+        node.setdefault(None, []).append(value)
+
+    def find(self, host):
+        """
+        Return the values of all wildcard domains matching the host. A
+        wildcard only matches hosts with at least one additional label.
+        """
+        values = []
+        node = self.root
+        labels = host.split('.')
+        for depth, label in enumerate(reversed(labels), 1):
+            node = node.get(label)
+            if node is None:
+                break
+            if depth < len(labels):
+                values.extend(node.get(None, ()))
+        return values
+
+
+def literal_prefix(pattern):
+    """
+    Return the literal text that every match of a compiled regular
+    expression begins with, or an empty string if there is none.
+    """
+    if pattern.flags & re.IGNORECASE:
+        return ''
+    prefix = []
+    for op, av in sre_parse.parse(pattern.pattern, pattern.flags):
+        if op == sre_parse.LITERAL:
+            prefix.append(chr(av))
+        elif op == sre_parse.AT and av in (sre_parse.AT_BEGINNING, sre_parse.AT_BEGINNING_STRING):
+            continue
+        else:
+            break
+    return ''.join(prefix)
+
+
+class ServiceMatcher(object):
+    """
+    Match service identifiers against an ordered list of service
+    configurations, returning the first configuration that matches.
+
+    Structured configurations (``URL`` or ``HOST``) are indexed in hash
+    maps and a ``HostTrie``, so they are found without testing each one.
+    The ``SERVICE`` regular expressions are indexed by the literal text
+    each must begin with, so only patterns whose prefix matches the
+    identifier are tested, in order. Patterns without a literal prefix,
+    such as those beginning with a group or using case-insensitive
+    matching, are tested for every identifier. The result across both
+    kinds is the configuration listed first.
+    """
+    def __init__(self, services):
+        self.services = services
+        self.urls = {}
+        self.hosts = {}
+        self.wildcards = HostTrie()
+        self.regex_services = []
+        self.prefixes = {}
+
+        for i, service in enumerate(services):
+            if service['MATCH'] is not None:
+                self.regex_services.append((i, service))
+                prefix = literal_prefix(service['MATCH'])
+                self.prefixes.setdefault(len(prefix), {}).setdefault(prefix, []).append((i, service))
+            elif 'URL' in service:
+                parts = urlparse(service['URL'])
+                self.urls.setdefault((parts.scheme, parts.netloc, parts.path), i)
+            elif service['HOST'].startswith('*.'):
+                self.wildcards.add(service['HOST'][2:], (i, service))
+            else:
+                self.hosts.setdefault(service['HOST'], []).append((i, service))
+
+    def match(self, s):
+        index = self.match_structured(s)
+        regex_index = self.match_regex(s, index)
+        if regex_index is not None:
+            index = regex_index
+        if index is None:
+            return None
+        return self.services[index]
+
+    def match_structured(self, s):
+        """Return the index of the first matching structured service."""
+        if not (self.urls or self.hosts or self.wildcards.root):
+            return None
+        try:
+            parts = urlparse(s)
+            host = parts.hostname
+        except ValueError:
+            return None
+
+        candidates = []
+        index = self.urls.get((parts.scheme, parts.netloc, parts.path))
+        if index is not None:
+            candidates.append(index)
+        if host:
+            entries = self.hosts.get(host, []) + self.wildcards.find(host)
+            candidates.extend(i for i, service in entries if self.is_structured_match(service, parts))
+        if candidates:
+            return min(candidates)
+        return None
+
+    def is_structured_match(self, service, parts):
+        scheme = service.get('SCHEME')
+        if scheme and scheme != parts.scheme:
+            return False
+        return parts.path.startswith(service.get('PATH', ''))
+
+    def get_regex_candidates(self, s):
+        """
+        Return the regular expression services whose literal prefix
+        matches ``s``, in configuration order.
+        """
+        candidates = []
+        for length, prefixes in self.prefixes.items():
+            candidates.extend(prefixes.get(s[:length], ()))
+        candidates.sort(key=lambda entry: entry[0])
+        return candidates
+
+    def match_regex(self, s, limit=None):
+        """
+        Return the index of the first matching regular expression
+        service, ignoring those listed at or after ``limit``.
+        """
+        for i, service in self.get_regex_candidates(s):
+            if limit is not None and i >= limit:
+                break
+            if service['MATCH'].match(s):
+                return i
+        return None
+
+
 class ServiceConfig(object):
     PROXY_ALLOW_DEFAULT = False
+    PROXY_PATTERN_DEFAULT = None
     CALLBACKS_DEFAULT = []
     LOGOUT_ALLOW_DEFAULT = False
     LOGOUT_URL_DEFAULT = None
+    ATTRIBUTE_TTL_DEFAULT = None
+    RELEASE_DEFAULT = None
+
+    def __init__(self, definitions=None):
+        # When no definitions are provided, MAMA_CAS_SERVICES is used
+        self.definitions = definitions
 
     @cached_property
     def services(self):
         services = []
 
-        for service in getattr(settings, 'MAMA_CAS_SERVICES', []):
+        definitions = self.definitions
+        if definitions is None:
+            definitions = getattr(settings, 'MAMA_CAS_SERVICES', [])
+
+        for service in definitions:
             service = service.copy()
-            try:
-                match = re.compile(service['SERVICE'])
-            except KeyError:
+            if 'SERVICE' in service:
+                service['MATCH'] = re.compile(service['SERVICE'])
+            elif 'URL' in service:
+                service['MATCH'] = None
+            elif 'HOST' in service:
+                service['MATCH'] = None
+                service['HOST'] = service['HOST'].lower()
+                if 'SCHEME' in service:
+                    service['SCHEME'] = service['SCHEME'].lower()
+            else:
                 raise ImproperlyConfigured(
-                    'Missing SERVICE key for service configuration. '
-                    'Check your MAMA_CAS_VALID_SERVICES setting.')
+                    'Missing SERVICE, URL or HOST key for service configuration. '
+                    'Check your MAMA_CAS_SERVICES setting.')
 
-            service['MATCH'] = match
             # TODO For transitional backwards compatibility, this defaults to True.
             service.setdefault('PROXY_ALLOW', True)
             service.setdefault('CALLBACKS', self.CALLBACKS_DEFAULT)
             service.setdefault('LOGOUT_ALLOW', self.LOGOUT_ALLOW_DEFAULT)
             service.setdefault('LOGOUT_URL', self.LOGOUT_URL_DEFAULT)
+            service.setdefault('ATTRIBUTE_TTL', self.ATTRIBUTE_TTL_DEFAULT)
+            service.setdefault('RELEASE', self.RELEASE_DEFAULT)
             try:
                 service['PROXY_PATTERN'] = re.compile(service['PROXY_PATTERN'])
             except KeyError:
-                pass
+                service['PROXY_PATTERN'] = self.PROXY_PATTERN_DEFAULT
             services.append(service)
 
         return services
 
+    @property
+    def matcher(self):
+        """
+        Return a ``ServiceMatcher`` for the current services, rebuilding
+        it whenever the cached services are reset.
+        """
+        services = self.services
+        matcher = self.__dict__.get('_matcher')
+        if matcher is None or matcher.services is not services:
+            matcher = self._matcher = ServiceMatcher(services)
+        return matcher
+
+    def reset(self):
+        """Discard the cached services so they are rebuilt on next access."""
+        self.__dict__.pop('services', None)
+        self.__dict__.pop('_matcher', None)
+
     def get_service(self, s):
-        for service in self.services:
-            if service['MATCH'].match(s):
-                return service
-        return {}
+        return self.matcher.match(s) or {}
 
     def get_config(self, service, setting):
         """
         Access the configuration for a given service and setting. If the
         service is not found, return a default value.
         """
-        try:
-            return self.get_service(service)[setting]
-        except KeyError:
-            return getattr(self, setting + '_DEFAULT')
+        service = self.get_service(service)
+        if service:
+            return service[setting]
+        return getattr(self, setting + '_DEFAULT')
 
     def is_valid(self, s):
         if not self.services:
@@ -64,25 +259,169 @@ services = ServiceConfig()
 
 
 class SettingsBackend(object):
+    # Results depend only on settings, so they may be cached
+    cacheable = True
+
+    def get_service_config(self):
+        return services
+
+    def get_attribute_ttl(self, service):
+        return self.get_service_config().get_config(service, 'ATTRIBUTE_TTL')
+
     def get_callbacks(self, service):
-        return services.get_config(service, 'CALLBACKS')
+        return self.get_service_config().get_config(service, 'CALLBACKS')
 
     def get_logout_url(self, service):
-        return services.get_config(service, 'LOGOUT_URL')
+        return self.get_service_config().get_config(service, 'LOGOUT_URL')
+
+    def get_release(self, service):
+        return self.get_service_config().get_config(service, 'RELEASE')
 
     def logout_allowed(self, service):
-        return services.get_config(service, 'LOGOUT_ALLOW')
+        return self.get_service_config().get_config(service, 'LOGOUT_ALLOW')
 
     def proxy_allowed(self, service):
-        return services.get_config(service, 'PROXY_ALLOW')
+        return self.get_service_config().get_config(service, 'PROXY_ALLOW')
 
     def proxy_callback_allowed(self, service, pgturl):
         try:
-            return services.get_config(service, 'PROXY_PATTERN').match(pgturl)
+            return self.get_service_config().get_config(service, 'PROXY_PATTERN').match(pgturl)
         except AttributeError:
             return False
 
     def service_allowed(self, service):
         if not service:
             return False
-        return services.is_valid(service)
+        return self.get_service_config().is_valid(service)
+
+
+SERVICES_VERSION_KEY = 'mama_cas:services:version'
+
+
+def get_services_version():
+    """Return the current version of the service definitions."""
+    from mama_cas.utils import get_cache
+    return get_cache().get(SERVICES_VERSION_KEY)
+
+
+def update_services_version():
+    """
+    Record that the service definitions have changed, so each process
+    reloads its snapshot on the next version check.
+    """
+    from mama_cas.utils import get_cache
+    get_cache().set(SERVICES_VERSION_KEY, uuid.uuid4().hex, None)
+
+
+ServiceSnapshot = namedtuple('ServiceSnapshot', ['version', 'checked', 'config'])
+
+
+class SnapshotBackend(SettingsBackend):
+    """
+    Base class for service backends that hold a compiled snapshot of
+    service definitions loaded from an external source. At most every
+    ``MAMA_CAS_SERVICE_RELOAD_INTERVAL`` seconds, the source's version is
+    compared to the snapshot, and a new snapshot is loaded and swapped in
+    if it has changed. Subclasses implement ``get_version()`` and
+    ``get_definitions()``.
+    """
+    # Definitions can change at any time, so results are not cacheable
+    cacheable = False
+
+    _snapshot = None
+    _lock = threading.Lock()
+
+    @classmethod
+    def reset(cls):
+        """Discard the snapshot so it is reloaded on next access."""
+        with cls._lock:
+            cls._snapshot = None
+
+    def get_version(self):
+        raise NotImplementedError
+
+    def get_definitions(self):
+        raise NotImplementedError
+
+    def get_service_config(self):
+        snapshot = self.__class__._snapshot
+        interval = getattr(settings, 'MAMA_CAS_SERVICE_RELOAD_INTERVAL', 5)
+        if snapshot is None or time.monotonic() - snapshot.checked >= interval:
+            snapshot = self.refresh(snapshot)
+        return snapshot.config
+
+    def refresh(self, snapshot):
+        with self._lock:
+            current = self.__class__._snapshot
+            if current is not None and current is not snapshot:
+                # Another thread refreshed the snapshot while this one
+                # waited for the lock
+                return current
+            snapshot = current
+            try:
+                version = self.get_version()
+                if snapshot is not None and snapshot.version == version:
+                    snapshot = snapshot._replace(checked=time.monotonic())
+                else:
+                    snapshot = ServiceSnapshot(version, time.monotonic(), self.load())
+            except Exception:
+                # Only the initial load fails; afterwards a broken source
+                # keeps the current snapshot until it is fixed
+                if snapshot is None:
+                    raise
+                logger.exception("Error reloading service definitions, keeping the current snapshot")
+                snapshot = snapshot._replace(checked=time.monotonic())
+            self.__class__._snapshot = snapshot
+        return snapshot
+
+    def load(self):
+        config = ServiceConfig(self.get_definitions())
+        # Compile the snapshot before it is swapped in
+        config.matcher
+        return config
+
+    def service_allowed(self, service):
+        # Unlike settings, no definitions does not allow every service
+        if not service:
+            return False
+        return bool(self.get_service_config().get_service(service))
+
+
+class DatabaseBackend(SnapshotBackend):
+    """
+    Service backend using the ``ServiceDefinition`` model. Resolving a
+    service does not query the database; a version counter in the cache,
+    updated whenever a definition is saved or deleted, determines when
+    the snapshot is reloaded.
+    """
+    def get_version(self):
+        return get_services_version()
+
+    def get_definitions(self):
+        from mama_cas.models import ServiceDefinition
+        return [d.to_config() for d in ServiceDefinition.objects.all()]
+
+
+class FileBackend(SnapshotBackend):
+    """
+    Service backend reading a JSON list of ``MAMA_CAS_SERVICES`` entries
+    from the file named by ``MAMA_CAS_SERVICES_FILE``. The snapshot is
+    reloaded when the file's modification time or size changes.
+    """
+    def get_path(self):
+        try:
+            return settings.MAMA_CAS_SERVICES_FILE
+        except AttributeError:
+            raise ImproperlyConfigured('FileBackend requires the MAMA_CAS_SERVICES_FILE setting.')
+
+    def get_version(self):
+        path = self.get_path()
+        try:
+            stat = os.stat(path)
+        except OSError as e:
+            raise ImproperlyConfigured('Unable to read MAMA_CAS_SERVICES_FILE %s: %s' % (path, e))
+        return path, stat.st_mtime_ns, stat.st_size
+
+    def get_definitions(self):
+        with open(self.get_path()) as f:
+            return json.load(f)
@@ -0,0 +1,365 @@
+"""
+Static and timing analysis of service configurations, used by the
+``checkservice`` management command to find entries that can never
+match, entries whose result depends on their order, and regular
+expressions that are slow or vulnerable to catastrophic backtracking.
+
+Overlaps are found by generating sample identifiers for each entry and
+testing which other entries also match them, so the results are a
+useful approximation rather than a proof.
+"""
+from collections import namedtuple
+import time
+from urllib.parse import urlparse
+
+try:
+    from re import _parser as sre_parse
+except ImportError:  # Python < 3.11
+    import sre_parse
+
+from mama_cas.services.backends import ServiceMatcher
+
+
+Finding = namedtuple('Finding', ['index', 'kind', 'message'])
+MatchCost = namedtuple('MatchCost', ['index', 'key', 'cost'])
+
+SAMPLE_LIMIT = 8
+ATTACK_LIMIT = 8
+# Characters that are unlikely to be accepted, used to force a failure
+# at the end of adversarial input
+ATTACK_SUFFIX = '\x00'
+
+REPEATS = tuple(op for op in (
+    sre_parse.MAX_REPEAT,
+    sre_parse.MIN_REPEAT,
+    getattr(sre_parse, 'POSSESSIVE_REPEAT', None),
+) if op is not None)
+ATOMIC_GROUP = getattr(sre_parse, 'ATOMIC_GROUP', None)
+
+CATEGORY_SAMPLES = {
+    sre_parse.CATEGORY_DIGIT: '0',
+    sre_parse.CATEGORY_NOT_DIGIT: 'a',
+    sre_parse.CATEGORY_SPACE: ' ',
+    sre_parse.CATEGORY_NOT_SPACE: 'a',
+    sre_parse.CATEGORY_WORD: 'a',
+    sre_parse.CATEGORY_NOT_WORD: '-',
+}
+CATEGORY_TESTS = {
+    sre_parse.CATEGORY_DIGIT: lambda c: c.isdigit(),
+    sre_parse.CATEGORY_NOT_DIGIT: lambda c: not c.isdigit(),
+    sre_parse.CATEGORY_SPACE: lambda c: c.isspace(),
+    sre_parse.CATEGORY_NOT_SPACE: lambda c: not c.isspace(),
+    sre_parse.CATEGORY_WORD: lambda c: c.isalnum() or c == '_',
+    sre_parse.CATEGORY_NOT_WORD: lambda c: not (c.isalnum() or c == '_'),
+}
+NEGATED_CANDIDATES = 'a0-_./:A '
+
+
+def in_set(c, items):
+    """Return whether character ``c`` is matched by a parsed ``IN`` set."""
+    negate = items and items[0][0] == sre_parse.NEGATE
+    for op, av in items:
+        if op == sre_parse.LITERAL and ord(c) == av:
+            break
+        if op == sre_parse.RANGE and av[0] <= ord(c) <= av[1]:
+            break
+        if op == sre_parse.CATEGORY and CATEGORY_TESTS.get(av, lambda c: False)(c):
+            break
+    else:
+        return bool(negate)
+    return not negate
+
+
+def set_sample(items):
+    if items and items[0][0] == sre_parse.NEGATE:
+        for c in NEGATED_CANDIDATES:
+            if in_set(c, items):
+                return c
+        return ''
+    op, av = items[0]
+    if op == sre_parse.LITERAL:
+        return chr(av)
+    if op == sre_parse.RANGE:
+        return chr(av[0])
+    if op == sre_parse.CATEGORY:
+        return CATEGORY_SAMPLES.get(av, 'a')
+    return 'a'
+
+
+def product(prefixes, options, limit):
+    return [prefix + option for prefix in prefixes for option in options][:limit]
+
+
+def sequence_samples(items, limit=SAMPLE_LIMIT):
+    """Return up to ``limit`` strings generated from a parsed sequence."""
+    samples = ['']
+    for item in items:
+        samples = product(samples, item_samples(item, limit), limit)
+    return samples
+
+
+def item_samples(item, limit):
+    op, av = item
+    if op == sre_parse.LITERAL:
+        return [chr(av)]
+    if op == sre_parse.NOT_LITERAL:
+        return ['b' if av == ord('a') else 'a']
+    if op == sre_parse.ANY:
+        return ['a']
+    if op == sre_parse.IN:
+        return [set_sample(av)]
+    if op == sre_parse.BRANCH:
+        samples = []
+        for branch in av[1]:
+            samples.extend(sequence_samples(branch, limit))
+        return samples[:limit]
+    if op == sre_parse.SUBPATTERN:
+        return sequence_samples(av[-1], limit)
+    if op == ATOMIC_GROUP:
+        return sequence_samples(av, limit)
+    if op in REPEATS:
+        low, high, body = av
+        body = sequence_samples(body, limit)
+        samples = [b * low for b in body]
+        if high == sre_parse.MAXREPEAT or high > low:
+            samples.extend(b * (low + 1) for b in body)
+        return samples[:limit]
+    if op == sre_parse.GROUPREF_EXISTS:
+        return sequence_samples(av[1], limit)
+    # Anchors, lookarounds and group references produce no text; any
+    # sample they invalidate is discarded later
+    return ['']
+
+
+def parse(pattern):
+    return sre_parse.parse(pattern.pattern, pattern.flags)
+
+
+def generate_samples(pattern, limit=SAMPLE_LIMIT):
+    """
+    Return strings matching a compiled regular expression, generated
+    from its parsed form. Strings that do not actually match, such as
+    those failing a lookahead, are discarded.
+    """
+    samples = []
+    for sample in sequence_samples(parse(pattern), limit):
+        if sample not in samples and pattern.match(sample):
+            samples.append(sample)
+    return samples
+
+
+def attack_inputs(pattern, limit=ATTACK_LIMIT):
+    """
+    Return ``(prefix, pump)`` pairs for each repetition in a compiled
+    regular expression, where ``prefix`` reaches the repetition and
+    ``pump`` is repeated to exercise it.
+    """
+    attacks = []
+
+    def walk(items, prefix):
+        for op, av in items:
+            if op in REPEATS:
+                low, high, body = av
+                if high == sre_parse.MAXREPEAT or high > 1:
+                    pump = next((s for s in sequence_samples(body) if s), '')
+                    if pump and (prefix, pump) not in attacks:
+                        attacks.append((prefix, pump))
+                walk(body, prefix)
+            elif op == sre_parse.SUBPATTERN:
+                walk(av[-1], prefix)
+            elif op == ATOMIC_GROUP:
+                walk(av, prefix)
+            elif op == sre_parse.BRANCH:
+                for branch in av[1]:
+                    walk(branch, prefix)
+            prefix += item_samples((op, av), 1)[0]
+
+    walk(parse(pattern), '')
+    return attacks[:limit]
+
+
+def has_nested_quantifier(pattern):
+    """
+    Return whether a compiled regular expression repeats a group that
+    itself contains an unbounded repetition, such as ``(a+)+``, which is
+    the most common cause of catastrophic backtracking.
+    """
+    def walk(items, depth):
+        for op, av in items:
+            if op in REPEATS:
+                low, high, body = av
+                unbounded = high == sre_parse.MAXREPEAT
+                if unbounded and depth:
+                    return True
+                if walk(body, depth + (1 if high == sre_parse.MAXREPEAT or high > 1 else 0)):
+                    return True
+            elif op == sre_parse.SUBPATTERN:
+                if walk(av[-1], depth):
+                    return True
+            elif op == ATOMIC_GROUP:
+                if walk(av, depth):
+                    return True
+            elif op == sre_parse.BRANCH:
+                if any(walk(branch, depth) for branch in av[1]):
+                    return True
+        return False
+
+    return walk(parse(pattern), 0)
+
+
+def time_match(pattern, s):
+    start = time.perf_counter()
+    pattern.match(s)
+    return time.perf_counter() - start
+
+
+def time_attack(pattern, prefix, pump, threshold, max_length=4096):
+    """
+    Time matching adversarial input of increasing length, returning the
+    length and time of the slowest attempt. Lengths grow one repetition
+    at a time while short, so that an exponential pattern stops shortly
+    after exceeding ``threshold``, then double up to ``max_length``.
+    """
+    length, elapsed = 0, 0.0
+    n = 1
+    while n <= max_length:
+        length = n
+        elapsed = time_match(pattern, prefix + pump * n + ATTACK_SUFFIX)
+        if elapsed > threshold:
+            break
+        n = n + 1 if n < 32 else n * 2
+    return length, elapsed
+
+
+def describe(service):
+    """Return a short description of a service configuration."""
+    if 'SERVICE' in service:
+        return service['SERVICE']
+    if 'URL' in service:
+        return service['URL']
+    return '%s://%s%s' % (service.get('SCHEME', '*'), service['HOST'], service.get('PATH', ''))
+
+
+class ServiceLinter(object):
+    """
+    Analyze an ordered list of service configurations, as returned by
+    ``ServiceConfig.services``.
+    """
+    def __init__(self, services):
+        self.services = services
+        self.matcher = ServiceMatcher(services)
+        self.flagged = None
+        self.urls = {}
+        for i, service in enumerate(services):
+            if service['MATCH'] is None and 'URL' in service:
+                parts = urlparse(service['URL'])
+                self.urls.setdefault((parts.scheme, parts.netloc, parts.path), []).append(i)
+
+    def get_samples(self, service):
+        if service['MATCH'] is not None:
+            return generate_samples(service['MATCH'])
+        if 'URL' in service:
+            return [service['URL']]
+        host = service['HOST']
+        if host.startswith('*.'):
+            host = 'www' + host[1:]
+        path = service.get('PATH', '/')
+        if not path.startswith('/'):
+            path = '/' + path
+        schemes = [service['SCHEME']] if 'SCHEME' in service else ['https', 'http']
+        return ['%s://%s%s' % (scheme, host, path) for scheme in schemes]
+
+    def match_all(self, s):
+        """Return the sorted indexes of every service matching ``s``."""
+        indexes = set()
+        try:
+            parts = urlparse(s)
+            host = parts.hostname
+        except ValueError:
+            parts = host = None
+        if parts is not None:
+            indexes.update(self.urls.get((parts.scheme, parts.netloc, parts.path), ()))
+            if host:
+                entries = self.matcher.hosts.get(host, []) + self.matcher.wildcards.find(host)
+                indexes.update(i for i, service in entries if self.matcher.is_structured_match(service, parts))
+        indexes.update(i for i, service in self.matcher.regex_services if service['MATCH'].match(s))
+        return sorted(indexes)
+
+    def find_overlaps(self):
+        """
+        Return findings for entries that are shadowed by earlier entries,
+        and so can never match, and for pairs of entries that match some
+        of the same identifiers, so their order decides the result.
+        """
+        findings = []
+        overlaps = {}
+        for j, service in enumerate(self.services):
+            samples = [(s, self.match_all(s)) for s in self.get_samples(service)]
+            samples = [(s, matches) for s, matches in samples if j in matches]
+            if not samples:
+                continue
+            for s, matches in samples:
+                for i in matches:
+                    if i != j:
+                        overlaps.setdefault((min(i, j), max(i, j)), s)
+            if all(matches[0] < j for s, matches in samples):
+                shadowing = sorted(set(matches[0] for s, matches in samples))
+                findings.append(Finding(j, 'shadowed', 'appears unreachable, matched first by %s' % (
+                    ', '.join('[%d]' % i for i in shadowing))))
+        shadowed = set(finding.index for finding in findings)
+        for (i, j), s in sorted(overlaps.items()):
+            if j not in shadowed:
+                findings.append(Finding(j, 'overlap', 'overlaps with [%d], e.g. %s' % (i, s)))
+        return sorted(findings)
+
+    def get_patterns(self):
+        for i, service in enumerate(self.services):
+            if service['MATCH'] is not None:
+                yield i, 'SERVICE', service['MATCH']
+            if service.get('PROXY_PATTERN') is not None:
+                yield i, 'PROXY_PATTERN', service['PROXY_PATTERN']
+
+    def find_backtracking(self, threshold=0.1):
+        """
+        Return findings for regular expressions with nested quantifiers,
+        or that take longer than ``threshold`` seconds to match
+        adversarial input.
+        """
+        findings = []
+        flagged = set()
+        for i, key, pattern in self.get_patterns():
+            if has_nested_quantifier(pattern):
+                findings.append(Finding(i, 'nested-quantifier', '%s has a nested quantifier' % key))
+                flagged.add((i, key))
+            for prefix, pump in attack_inputs(pattern):
+                length, elapsed = time_attack(pattern, prefix, pump, threshold)
+                if elapsed > threshold:
+                    findings.append(Finding(i, 'backtracking', '%s took %.3fs on %r' % (
+                        key, elapsed, prefix + pump * length + ATTACK_SUFFIX)))
+                    flagged.add((i, key))
+                    break
+        self.flagged = flagged
+        return findings
+
+    def match_costs(self, number=100):
+        """
+        Return the mean time, in seconds, to test each regular expression
+        against its own samples and a non-matching identifier, most
+        expensive first. Patterns flagged by ``find_backtracking()``, which
+        is run first if needed, are skipped, as the non-matching
+        identifier may never finish matching.
+        """
+        if self.flagged is None:
+            self.find_backtracking()
+        costs = []
+        miss = 'https://unmatched.invalid/' + 'a' * 64
+        for i, key, pattern in self.get_patterns():
+            if (i, key) in self.flagged:
+                continue
+            inputs = generate_samples(pattern) + [miss]
+            start = time.perf_counter()
+            for _ in range(number):
+                for s in inputs:
+                    pattern.match(s)
+            costs.append(MatchCost(i, key, (time.perf_counter() - start) / (number * len(inputs))))
+        return sorted(costs, key=lambda cost: cost.cost, reverse=True)
@@ -0,0 +1,7 @@
+from django.dispatch import Signal
+
+
+# Sent when valid tickets are consumed because a user exceeded the
+# configured live ticket limit. Receives the ticket model as the sender,
+# along with the ``user`` and the ``count`` of evicted tickets.
+tickets_evicted = Signal()
@@ -30,5 +30,10 @@ class CustomTestServiceBackend(SettingsBackend):
         return super(CustomTestServiceBackend, self).service_allowed(service)
 
 
+class CustomTestUncacheableServiceBackend(CustomTestServiceBackend):
+    """Service backend whose results may not be cached."""
+    cacheable = False
+
+
 class CustomTestInvalidServiceBackend(object):
     pass
@@ -1,6 +1,68 @@
+import threading
+import time
+
 from mama_cas.exceptions import InternalError
 
 
 def raise_exception(user, service):
     """Raise an exception for testing purposes."""
     raise InternalError('Error in attribute callback')
+
+
+def static_attributes(user, service):
+    """Return a fixed attribute for testing purposes."""
+    return {'group': 'staff'}
+
+
+def slow_attributes(user, service):
+    """Return an attribute after a delay for testing purposes."""
+    time.sleep(0.2)
+    return {'group': 'slow'}
+
+
+async def async_attributes(user, service):
+    """Return an attribute from a coroutine for testing purposes."""
+    return {'group': 'async'}
+
+
+def slow_other_attributes(user, service):
+    """Return another attribute after a delay for testing purposes."""
+    time.sleep(0.2)
+    return {'other': 'slow'}
+
+
+barrier = threading.Barrier(2, timeout=5)
+
+
+def barrier_attributes(user, service):
+    """Return an attribute once another callback is running for testing purposes."""
+    barrier.wait()
+    return {'group': 'barrier'}
+
+
+def barrier_other_attributes(user, service):
+    """Return another attribute once another callback is running for testing purposes."""
+    barrier.wait()
+    return {'other': 'barrier'}
+
+
+released = threading.Event()
+
+
+def blocked_attributes(user, service):
+    """Return an attribute once released for testing purposes."""
+    released.wait(5)
+    return {'group': 'blocked'}
+
+
+def batch_attributes(user, service):
+    """Return an attribute for a single user for testing purposes."""
+    return {'batch': 'single'}
+
+
+def batch_attributes_many(users, service):
+    """Return an attribute for each of several users for testing purposes."""
+    return dict((user.pk, {'batch': 'many'}) for user in users)
+
+
+batch_attributes.many = batch_attributes_many
@@ -0,0 +1,395 @@
+import time
+from unittest.mock import patch
+
+from django.contrib.auth import get_user_model
+from django.contrib.auth.models import Group
+from django.db.models.signals import m2m_changed
+from django.test import TestCase
+from django.test.utils import override_settings
+
+from .callbacks import barrier
+from .callbacks import batch_attributes_many
+from .callbacks import released
+from .factories import UserFactory
+from mama_cas.attributes import get_cache_key
+from mama_cas.attributes import get_changed_key
+from mama_cas.attributes import get_recent_key
+from mama_cas.attributes import prefetch_attributes
+from mama_cas.attributes import record_service
+from mama_cas.attributes import reset_breakers
+from mama_cas.cas import get_attributes
+from mama_cas.cas import get_attributes_many
+from mama_cas.exceptions import InternalError
+from mama_cas.exceptions import InvalidTicket
+from mama_cas.models import connect_user_signals
+from mama_cas.services import registry
+from mama_cas.utils import get_cache
+
+
+CALLBACK = 'mama_cas.tests.callbacks.static_attributes'
+SLOW_CALLBACK = 'mama_cas.tests.callbacks.slow_attributes'
+BARRIER_CALLBACK = 'mama_cas.tests.callbacks.barrier_attributes'
+BLOCKED_CALLBACK = 'mama_cas.tests.callbacks.blocked_attributes'
+BATCH_CALLBACK = 'mama_cas.tests.callbacks.batch_attributes'
+
+
+@override_settings(MAMA_CAS_SERVICES=[{
+    'SERVICE': r'https?://www\.example\.com',
+    'CALLBACKS': [CALLBACK],
+    'ATTRIBUTE_TTL': 60,
+}], MAMA_CAS_ATTRIBUTE_STALE_WINDOW=60)
+class AttributeCacheTests(TestCase):
+    service = 'https://www.example.com/'
+
+    def setUp(self):
+        self.user = UserFactory()
+        get_cache().clear()
+        registry.reset()
+
+    def test_cached(self):
+        """
+        When ``ATTRIBUTE_TTL`` is set, callback results should be
+        cached.
+        """
+        with patch(CALLBACK, return_value={'group': 'staff'}) as callback:
+            self.assertEqual(get_attributes(self.user, self.service), {'group': 'staff'})
+            self.assertEqual(get_attributes(self.user, self.service), {'group': 'staff'})
+        self.assertEqual(callback.call_count, 1)
+
+    @override_settings(MAMA_CAS_SERVICES=[{'SERVICE': r'https?://www\.example\.com', 'CALLBACKS': [CALLBACK]}])
+    def test_not_cached(self):
+        """
+        When ``ATTRIBUTE_TTL`` is not set, callbacks should be called
+        on every request.
+        """
+        with patch(CALLBACK, return_value={'group': 'staff'}) as callback:
+            get_attributes(self.user, self.service)
+            get_attributes(self.user, self.service)
+        self.assertEqual(callback.call_count, 2)
+
+    def test_cacheable_opt_out(self):
+        """
+        Callbacks with a false ``cacheable`` attribute should not be
+        cached.
+        """
+        with patch(CALLBACK, return_value={'group': 'staff'}, cacheable=False) as callback:
+            get_attributes(self.user, self.service)
+            get_attributes(self.user, self.service)
+        self.assertEqual(callback.call_count, 2)
+
+    def test_user_changed(self):
+        """
+        Saving the user should invalidate cached attributes, unless only
+        ``last_login`` changed.
+        """
+        with patch(CALLBACK, return_value={'group': 'staff'}) as callback:
+            get_attributes(self.user, self.service)
+            self.user.save(update_fields=['last_login'])
+            get_attributes(self.user, self.service)
+            self.assertEqual(callback.call_count, 1)
+            self.user.save()
+            get_attributes(self.user, self.service)
+        self.assertEqual(callback.call_count, 2)
+
+    def test_groups_changed(self):
+        """
+        Changing the user's group membership should invalidate cached
+        attributes.
+        """
+        group = Group.objects.create(name='staff')
+        with patch(CALLBACK, return_value={'group': 'staff'}) as callback:
+            get_attributes(self.user, self.service)
+            self.user.groups.add(group)
+            get_attributes(self.user, self.service)
+        self.assertEqual(callback.call_count, 2)
+
+    def test_user_signals_skipped(self):
+        """
+        User models without group or permission relations should not
+        have handlers connected for them.
+        """
+        receivers = len(m2m_changed.receivers)
+        connect_user_signals(Group)
+        self.assertEqual(len(m2m_changed.receivers), receivers)
+        self.assertTrue(m2m_changed.has_listeners(get_user_model().groups.through))
+        self.assertTrue(m2m_changed.has_listeners(get_user_model().user_permissions.through))
+
+    def test_stale(self):
+        """
+        An expired result within the stale window should be returned
+        while it is refreshed in the background.
+        """
+        key = get_cache_key(self.user, CALLBACK)
+        get_cache().set(key, (time.time() - 90, {'group': 'stale'}))
+        with patch('mama_cas.attributes.refresh_async') as refresh_async:
+            with patch(CALLBACK, return_value={'group': 'staff'}) as callback:
+                self.assertEqual(get_attributes(self.user, self.service), {'group': 'stale'})
+        self.assertFalse(callback.called)
+        self.assertTrue(refresh_async.called)
+
+    def test_expired(self):
+        """
+        A result older than the stale window should be recomputed.
+        """
+        key = get_cache_key(self.user, CALLBACK)
+        get_cache().set(key, (time.time() - 150, {'group': 'stale'}))
+        with patch(CALLBACK, return_value={'group': 'staff'}):
+            self.assertEqual(get_attributes(self.user, self.service), {'group': 'staff'})
+
+
+@override_settings(MAMA_CAS_ATTRIBUTE_WORKERS=4)
+class AttributeCallbackTests(TestCase):
+    service = 'https://www.example.com/'
+
+    def setUp(self):
+        self.user = UserFactory()
+        get_cache().clear()
+        registry.reset()
+        reset_breakers()
+
+    def services(self, *callbacks, **kwargs):
+        config = {'SERVICE': r'https?://www\.example\.com', 'CALLBACKS': list(callbacks)}
+        config.update(kwargs)
+        return override_settings(MAMA_CAS_SERVICES=[config])
+
+    def test_parallel(self):
+        """
+        Callbacks should run concurrently.
+        """
+        # Each callback waits for the other, so neither returns if they
+        # are called in turn
+        barrier.reset()
+        with self.services(BARRIER_CALLBACK, 'mama_cas.tests.callbacks.barrier_other_attributes'):
+            self.assertEqual(get_attributes(self.user, self.service), {'group': 'barrier', 'other': 'barrier'})
+
+    def test_precedence(self):
+        """
+        Results should be merged in the order the callbacks are listed.
+        """
+        with self.services(SLOW_CALLBACK, CALLBACK):
+            self.assertEqual(get_attributes(self.user, self.service), {'group': 'staff'})
+        with self.services(CALLBACK, SLOW_CALLBACK):
+            self.assertEqual(get_attributes(self.user, self.service), {'group': 'slow'})
+
+    def test_coroutine(self):
+        """
+        Coroutine callbacks should be awaited.
+        """
+        with self.services('mama_cas.tests.callbacks.async_attributes'):
+            self.assertEqual(get_attributes(self.user, self.service), {'group': 'async'})
+
+    @override_settings(MAMA_CAS_ATTRIBUTE_TIMEOUT=0.05, MAMA_CAS_ATTRIBUTE_FAILURE_POLICY='omit')
+    def test_timeout_omit(self):
+        """
+        With the ``omit`` policy, a callback exceeding its deadline
+        should be omitted.
+        """
+        # The blocked callback cannot return until it is released
+        released.clear()
+        try:
+            with self.services(CALLBACK, BLOCKED_CALLBACK):
+                self.assertEqual(get_attributes(self.user, self.service), {'group': 'staff'})
+        finally:
+            released.set()
+
+    @override_settings(MAMA_CAS_ATTRIBUTE_TIMEOUT=0.05)
+    def test_timeout_fail(self):
+        """
+        With the default ``fail`` policy, a callback exceeding its
+        deadline should raise ``InternalError``.
+        """
+        with self.services(SLOW_CALLBACK):
+            with self.assertRaises(InternalError):
+                get_attributes(self.user, self.service)
+
+    @override_settings(MAMA_CAS_ATTRIBUTE_FAILURE_POLICY='cached')
+    def test_failure_cached(self):
+        """
+        With the ``cached`` policy, a failing callback should be replaced
+        by its last cached result.
+        """
+        with self.services(CALLBACK, ATTRIBUTE_TTL=60):
+            get_attributes(self.user, self.service)
+            get_cache().set(get_changed_key(self.user), time.time(), None)
+            with patch(CALLBACK, autospec=True, side_effect=ConnectionError('Directory unavailable')):
+                self.assertEqual(get_attributes(self.user, self.service), {'group': 'staff'})
+
+    @override_settings(MAMA_CAS_ATTRIBUTE_FAILURE_POLICY='omit', MAMA_CAS_ATTRIBUTE_BREAKER_THRESHOLD=2)
+    def test_circuit_breaker(self):
+        """
+        After repeated failures, a callback should not be called until
+        the breaker resets.
+        """
+        with self.services(CALLBACK):
+            with patch(CALLBACK, autospec=True, side_effect=ConnectionError('Directory unavailable')) as callback:
+                for _ in range(3):
+                    self.assertEqual(get_attributes(self.user, self.service), {})
+            self.assertEqual(callback.call_count, 2)
+            registry.reset()
+            with override_settings(MAMA_CAS_ATTRIBUTE_BREAKER_RESET=0):
+                self.assertEqual(get_attributes(self.user, self.service), {'group': 'staff'})
+
+    @override_settings(MAMA_CAS_ATTRIBUTE_FAILURE_POLICY='omit', MAMA_CAS_ATTRIBUTE_BREAKER_THRESHOLD=2)
+    def test_validation_error(self):
+        """
+        A ``ValidationError`` raised by a callback should reject the
+        user regardless of the failure policy, without opening the
+        breaker.
+        """
+        with self.services(CALLBACK):
+            with patch(CALLBACK, autospec=True, side_effect=InvalidTicket('Account disabled')) as callback:
+                for _ in range(3):
+                    with self.assertRaises(InvalidTicket):
+                        get_attributes(self.user, self.service)
+            self.assertEqual(callback.call_count, 3)
+            registry.reset()
+            self.assertEqual(get_attributes(self.user, self.service), {'group': 'staff'})
+
+    @override_settings(
+        MAMA_CAS_ATTRIBUTE_WORKERS=0,
+        MAMA_CAS_ATTRIBUTE_FAILURE_POLICY='omit',
+        MAMA_CAS_ATTRIBUTE_BREAKER_THRESHOLD=2,
+    )
+    def test_circuit_breaker_no_workers(self):
+        """
+        Without a thread pool, callbacks should be called regardless of
+        previous failures.
+        """
+        with self.services(CALLBACK):
+            with patch(CALLBACK, autospec=True, side_effect=ConnectionError('Directory unavailable')) as callback:
+                for _ in range(3):
+                    self.assertEqual(get_attributes(self.user, self.service), {})
+            self.assertEqual(callback.call_count, 3)
+
+
+@override_settings(MAMA_CAS_SERVICES=[
+    {'SERVICE': r'https?://www\.example\.com', 'CALLBACKS': [CALLBACK], 'ATTRIBUTE_TTL': 60},
+    {'SERVICE': r'https?://www\.example\.org', 'CALLBACKS': [CALLBACK, SLOW_CALLBACK], 'ATTRIBUTE_TTL': 60},
+    {'SERVICE': r'https?://www\.example\.net', 'CALLBACKS': ['mama_cas.tests.callbacks.slow_other_attributes']},
+], MAMA_CAS_ATTRIBUTE_PREFETCH_SERVICES=2)
+class AttributePrefetchTests(TestCase):
+    def setUp(self):
+        self.user = UserFactory()
+        get_cache().clear()
+        registry.reset()
+
+    def test_record_service(self):
+        """
+        The most recent services should be recorded for the user.
+        """
+        for service in ('https://www.example.com/', 'https://www.example.org/', 'https://www.example.com/'):
+            record_service(self.user, service)
+        self.assertEqual(get_cache().get(get_recent_key(self.user)),
+                         ['https://www.example.com/', 'https://www.example.org/'])
+
+    @override_settings(MAMA_CAS_ATTRIBUTE_PREFETCH_SERVICES=3)
+    def test_prefetch(self):
+        """
+        Callbacks for the current and recent services should each be
+        called once in the background and cached.
+        """
+        record_service(self.user, 'https://www.example.org/')
+        record_service(self.user, 'https://www.example.net/')
+        with patch('mama_cas.attributes.get_refresh_executor') as executor:
+            executor.return_value.submit.side_effect = lambda fn, *args: fn(*args)
+            with patch(CALLBACK, return_value={'group': 'staff'}) as callback:
+                prefetch_attributes(self.user, 'https://www.example.com/')
+            self.assertEqual(callback.call_count, 1)
+        registry.reset()
+        with patch(CALLBACK) as callback:
+            with patch(SLOW_CALLBACK) as slow_callback:
+                self.assertEqual(get_attributes(self.user, 'https://www.example.org/'), {'group': 'slow'})
+        self.assertFalse(callback.called)
+        self.assertFalse(slow_callback.called)
+
+    @override_settings(MAMA_CAS_ATTRIBUTE_PREFETCH_SERVICES=0)
+    def test_prefetch_disabled(self):
+        with patch('mama_cas.attributes.get_refresh_executor') as executor:
+            prefetch_attributes(self.user, 'https://www.example.com/')
+        self.assertFalse(executor.called)
+
+
+@override_settings(MAMA_CAS_SERVICES=[{
+    'SERVICE': r'https?://www\.example\.com',
+    'CALLBACKS': ['mama_cas.callbacks.user_name_attributes', 'mama_cas.callbacks.user_model_attributes'],
+    'RELEASE': ['username', 'email'],
+}, {
+    'SERVICE': r'https?://www\.example\.org',
+    'CALLBACKS': ['mama_cas.callbacks.user_name_attributes', CALLBACK],
+    'RELEASE': ['group'],
+}])
+class AttributeReleaseTests(TestCase):
+    def setUp(self):
+        self.user = UserFactory()
+        registry.reset()
+
+    def test_release(self):
+        """
+        Only attributes listed in ``RELEASE`` should be returned.
+        """
+        self.assertEqual(get_attributes(self.user, 'https://www.example.com/'),
+                         {'username': 'ellen', 'email': self.user.email})
+
+    def test_release_skips_callbacks(self):
+        """
+        Callbacks declaring they provide no released attributes should
+        not be called.
+        """
+        with patch('mama_cas.callbacks.user_name_attributes') as callback:
+            callback.provides = ('username', 'full_name', 'short_name')
+            self.assertEqual(get_attributes(self.user, 'https://www.example.org/'), {'group': 'staff'})
+        self.assertFalse(callback.called)
+
+
+@override_settings(MAMA_CAS_SERVICES=[{
+    'SERVICE': r'https?://www\.example\.com',
+    'CALLBACKS': [CALLBACK, BATCH_CALLBACK],
+}, {
+    'SERVICE': r'https?://www\.example\.org',
+    'CALLBACKS': [BATCH_CALLBACK],
+    'ATTRIBUTE_TTL': 60,
+}])
+class AttributeBatchTests(TestCase):
+    def setUp(self):
+        self.users = [UserFactory(), UserFactory(first_name='Dave')]
+        get_cache().clear()
+        registry.reset()
+        reset_breakers()
+
+    def test_get_attributes_many(self):
+        """
+        Callbacks with a batch form should be called once for all users,
+        and other callbacks once for each user.
+        """
+        with patch(BATCH_CALLBACK + '.many', wraps=batch_attributes_many) as many:
+            attributes = get_attributes_many(self.users, 'https://www.example.com/')
+        self.assertEqual(many.call_count, 1)
+        self.assertEqual(attributes, dict((user.pk, {'group': 'staff', 'batch': 'many'}) for user in self.users))
+
+    def test_get_attributes_single(self):
+        """A single user should use the per-user form."""
+        attributes = get_attributes_many(self.users[:1], 'https://www.example.com/')
+        self.assertEqual(attributes, {self.users[0].pk: {'group': 'staff', 'batch': 'single'}})
+
+    def test_batch_cached(self):
+        """
+        The batch form should only be called for users without a cached
+        result.
+        """
+        get_attributes(self.users[0], 'https://www.example.org/')
+        with patch(BATCH_CALLBACK + '.many', wraps=batch_attributes_many) as many:
+            attributes = get_attributes_many(self.users, 'https://www.example.org/')
+            self.assertEqual(many.call_args[0][0], self.users[1:])
+            get_attributes_many(self.users, 'https://www.example.org/')
+        self.assertEqual(many.call_count, 1)
+        self.assertEqual(attributes, {self.users[0].pk: {'batch': 'single'}, self.users[1].pk: {'batch': 'many'}})
+
+    @override_settings(MAMA_CAS_ATTRIBUTE_FAILURE_POLICY='omit')
+    def test_batch_failure(self):
+        """
+        A failing batch form should apply the failure policy to each
+        user.
+        """
+        with patch(BATCH_CALLBACK + '.many', side_effect=ConnectionError('Directory unavailable')):
+            attributes = get_attributes_many(self.users, 'https://www.example.com/')
+        self.assertEqual(attributes, dict((user.pk, {'group': 'staff'}) for user in self.users))
@@ -1,8 +1,17 @@
+from django.contrib.auth.models import Group
+from django.contrib.auth.models import Permission
 from django.test import TestCase
+from django.test.utils import override_settings
 
 from .factories import UserFactory
+from mama_cas.callbacks import get_model_fields
+from mama_cas.callbacks import user_group_attributes
+from mama_cas.callbacks import user_group_attributes_many
 from mama_cas.callbacks import user_model_attributes
 from mama_cas.callbacks import user_name_attributes
+from mama_cas.callbacks import user_permission_attributes
+from mama_cas.callbacks import user_permission_attributes_many
+from mama_cas.utils import get_cache
 
 
 class CallbacksTests(TestCase):
@@ -27,3 +36,114 @@ class CallbacksTests(TestCase):
         attributes = user_model_attributes(self.user, 'http://www.example.com/')
         self.assertIn('username', attributes)
         self.assertEqual(attributes['username'], 'ellen')
+
+    def test_get_model_fields(self):
+        """
+        The field names should exclude ignored fields and be computed
+        once per model.
+        """
+        fields = get_model_fields(type(self.user))
+        self.assertIn('username', fields)
+        self.assertNotIn('password', fields)
+        self.assertIs(get_model_fields(type(self.user)), fields)
+
+
+class GroupCallbacksTests(TestCase):
+    def setUp(self):
+        self.user = UserFactory()
+        self.staff = Group.objects.create(name='staff')
+        self.admins = Group.objects.create(name='admins')
+        self.user.groups.add(self.staff, self.admins)
+        self.permission = Permission.objects.get(codename='add_group')
+        self.staff.permissions.add(self.permission)
+        self.user.user_permissions.add(Permission.objects.get(codename='view_group'))
+        get_cache().clear()
+
+    def test_user_group_attributes(self):
+        """
+        The callback should return the sorted group names in a single
+        query, and cache them.
+        """
+        with self.assertNumQueries(1):
+            attributes = user_group_attributes(self.user, 'http://www.example.com/')
+        self.assertEqual(attributes, {'groups': ['admins', 'staff']})
+        with self.assertNumQueries(0):
+            user_group_attributes(self.user, 'http://www.example.com/')
+
+    def test_user_permission_attributes(self):
+        """
+        The callback should return permissions granted directly and
+        through groups in a single query.
+        """
+        with self.assertNumQueries(1):
+            attributes = user_permission_attributes(self.user, 'http://www.example.com/')
+        self.assertEqual(attributes, {'permissions': ['auth.add_group', 'auth.view_group']})
+
+    def test_user_group_attributes_many(self):
+        """
+        The batch form should return the groups of several users in a
+        single query.
+        """
+        other = UserFactory(first_name='Dave')
+        other.groups.add(self.staff)
+        get_cache().clear()
+        with self.assertNumQueries(1):
+            attributes = user_group_attributes_many([self.user, other], 'http://www.example.com/')
+        self.assertEqual(attributes, {
+            self.user.pk: {'groups': ['admins', 'staff']},
+            other.pk: {'groups': ['staff']},
+        })
+
+    def test_user_permission_attributes_many(self):
+        """
+        The batch form should return the permissions of several users in
+        a single query.
+        """
+        other = UserFactory(first_name='Dave')
+        with self.assertNumQueries(1):
+            attributes = user_permission_attributes_many([self.user, other], 'http://www.example.com/')
+        self.assertEqual(attributes, {
+            self.user.pk: {'permissions': ['auth.add_group', 'auth.view_group']},
+            other.pk: {'permissions': []},
+        })
+
+    @override_settings(MAMA_CAS_GROUP_CACHE_TIMEOUT=0)
+    def test_group_cache_disabled(self):
+        """When the cache timeout is zero, groups should not be cached."""
+        user_group_attributes(self.user, 'http://www.example.com/')
+        with self.assertNumQueries(1):
+            user_group_attributes(self.user, 'http://www.example.com/')
+
+    def test_group_membership_changed(self):
+        """
+        Changing group membership from either side should invalidate
+        the cached groups.
+        """
+        user_group_attributes(self.user, 'http://www.example.com/')
+        self.user.groups.remove(self.admins)
+        self.assertEqual(user_group_attributes(self.user, 'http://www.example.com/'), {'groups': ['staff']})
+        self.admins.user_set.add(self.user)
+        self.assertEqual(user_group_attributes(self.user, 'http://www.example.com/'),
+                         {'groups': ['admins', 'staff']})
+        self.staff.user_set.clear()
+        self.assertEqual(user_group_attributes(self.user, 'http://www.example.com/'), {'groups': ['admins']})
+
+    def test_group_changed(self):
+        """Renaming or deleting a group should invalidate its members' groups."""
+        user_group_attributes(self.user, 'http://www.example.com/')
+        self.staff.name = 'employees'
+        self.staff.save()
+        self.assertEqual(user_group_attributes(self.user, 'http://www.example.com/'),
+                         {'groups': ['admins', 'employees']})
+        self.admins.delete()
+        self.assertEqual(user_group_attributes(self.user, 'http://www.example.com/'), {'groups': ['employees']})
+
+    def test_group_permissions_changed(self):
+        """
+        Changing a group's permissions should invalidate its members'
+        permissions.
+        """
+        user_permission_attributes(self.user, 'http://www.example.com/')
+        self.staff.permissions.remove(self.permission)
+        self.assertEqual(user_permission_attributes(self.user, 'http://www.example.com/'),
+                         {'permissions': ['auth.view_group']})
@@ -1,7 +1,11 @@
 from io import StringIO
+import json
+import os
+import tempfile
 
 from django.core import management
 from django.test import TestCase
+from django.test.utils import override_settings
 
 from .factories import ProxyGrantingTicketFactory
 from .factories import ProxyTicketFactory
@@ -54,3 +58,66 @@ class ManagementCommandTests(TestCase):
         output = StringIO()
         management.call_command('checkservice', 'https://example.org', no_color=True, stdout=output)
         self.assertIn('Invalid service', output.getvalue())
+
+    @override_settings(MAMA_CAS_SERVICES=[
+        {'HOST': 'www.example.com'},
+        {'SERVICE': r'^https?://www\.example\.com/app'},
+        {'SERVICE': r'^https://([a-z]+\.)?example\.org'},
+        {'URL': 'https://example.org/login'},
+        {'SERVICE': r'^https://www\.example\.net/(a+)+$'},
+        {'SERVICE': r'^https://[^/]+/(.*)*x'},
+    ])
+    def test_checkservice_management_command_lint(self):
+        """
+        The ``checkservice`` management command should report shadowed,
+        overlapping and backtracking service patterns when linting.
+        """
+        output = StringIO()
+        management.call_command('checkservice', lint=True, threshold=0.01, no_color=True, stdout=output)
+        output = output.getvalue()
+        self.assertIn('[1] ^https?://www\\.example\\.com/app: appears unreachable, matched first by [0]', output)
+        self.assertIn('[3] https://example.org/login: appears unreachable, matched first by [2]', output)
+        self.assertIn('SERVICE has a nested quantifier', output)
+        self.assertIn('SERVICE took', output)
+        self.assertIn('Pattern match cost', output)
+
+    def test_checkservice_management_command_lint_clean(self):
+        output = StringIO()
+        management.call_command('checkservice', lint=True, no_color=True, stdout=output)
+        self.assertIn('No problems found', output.getvalue())
+
+    def test_checkservice_management_command_file(self):
+        """
+        The ``checkservice`` management command should check each service
+        in a file, writing a CSV row for each.
+        """
+        fd, path = tempfile.mkstemp()
+        with os.fdopen(fd, 'w') as f:
+            f.write('https://www.example.com\n\nhttps://example.org\n')
+        output = StringIO()
+        try:
+            management.call_command('checkservice', file=path, no_color=True, stdout=output, stderr=StringIO())
+        finally:
+            os.remove(path)
+        lines = output.getvalue().splitlines()
+        self.assertEqual(len(lines), 3)
+        self.assertEqual(lines[0], 'service,valid,backend,proxy_allowed,logout_allowed,logout_url,callbacks')
+        self.assertTrue(lines[1].startswith('https://www.example.com,True,'))
+        self.assertEqual(lines[2], 'https://example.org,False,,,,,')
+
+    def test_checkservice_management_command_stdin_pool(self):
+        """
+        The ``checkservice`` management command should check services
+        from stdin in a process pool, writing JSON lines in input order.
+        """
+        services = ['https://www.example.com', 'https://example.org'] * 5
+        output = StringIO()
+        errors = StringIO()
+        management.call_command(
+            'checkservice', file='-', format='jsonl', workers=2, pool_threshold=1,
+            stdin=StringIO('\n'.join(services)), no_color=True, stdout=output, stderr=errors)
+        rows = [json.loads(line) for line in output.getvalue().splitlines()]
+        self.assertEqual([row['service'] for row in rows], services)
+        self.assertEqual([row['valid'] for row in rows], [True, False] * 5)
+        self.assertIn('Checked 10 services', errors.getvalue())
+        self.assertIn('lookups/sec', errors.getvalue())
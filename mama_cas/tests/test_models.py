@@ -70,6 +70,29 @@ class TicketManagerTests(TestCase):
         st = ServiceTicket.objects.create_ticket(expires=expires, user=self.user)
         self.assertEqual(st.expires, expires)
 
+    @override_settings(MAMA_CAS_MAX_LIVE_TICKETS={'ST': 2})
+    def test_create_ticket_max_live(self):
+        """
+        When a user exceeds the live ticket limit, the oldest valid
+        tickets ought to be consumed.
+        """
+        st1 = ServiceTicket.objects.create_ticket(user=self.user)
+        st2 = ServiceTicket.objects.create_ticket(user=self.user)
+        st3 = ServiceTicket.objects.create_ticket(user=self.user)
+        self.assertIsNotNone(ServiceTicket.objects.get(pk=st1.pk).consumed)
+        self.assertIsNone(ServiceTicket.objects.get(pk=st2.pk).consumed)
+        self.assertIsNone(ServiceTicket.objects.get(pk=st3.pk).consumed)
+
+    @override_settings(MAMA_CAS_MAX_LIVE_TICKETS={'ST': 1})
+    def test_evict_tickets_signal(self):
+        """
+        Evicting tickets should send the ``tickets_evicted`` signal.
+        """
+        ServiceTicket.objects.create_ticket(user=self.user)
+        with patch('mama_cas.models.tickets_evicted.send') as mock:
+            ServiceTicket.objects.create_ticket(user=self.user)
+            mock.assert_called_once_with(sender=ServiceTicket, user=self.user, count=1)
+
     def test_create_ticket_str(self):
         """
         A ticket string should be created with the appropriate model
@@ -96,6 +119,19 @@ class TicketManagerTests(TestCase):
         self.assertEqual(ticket, st)
         self.assertTrue(ticket.is_consumed())
 
+    def test_validate_ticket_user_fields(self):
+        """
+        When ``user_fields`` is provided, the user ought to be loaded
+        with the ticket and only the required fields.
+        """
+        st = ServiceTicketFactory()
+        ticket = ServiceTicket.objects.validate_ticket(st.ticket, self.url, user_fields=['first_name'])
+        with self.assertNumQueries(0):
+            self.assertEqual(ticket.user.get_username(), 'ellen')
+            self.assertEqual(ticket.user.first_name, 'Ellen')
+        self.assertIn('email', ticket.user.get_deferred_fields())
+        self.assertNotIn('first_name', ticket.user.get_deferred_fields())
+
     def test_validate_ticket_no_ticket(self):
         """
         The validation process ought to fail when no ticket string is
@@ -192,6 +228,52 @@ class TicketManagerTests(TestCase):
             ServiceTicket.objects.validate_ticket(st.ticket, self.url,
                                                   renew=True)
 
+    @override_settings(MAMA_CAS_DELETE_CONSUMED_TICKETS=True)
+    def test_validate_ticket_delete_consumed(self):
+        """
+        When consumed tickets are deleted, a repeated validation ought
+        to fail with the same error as a retained consumed ticket.
+        """
+        service = 'http://example.com'
+        st = ServiceTicketFactory(service=service)
+        ticket = ServiceTicket.objects.validate_ticket(st.ticket, service)
+        ServiceTicket.objects.discard_ticket(ticket)
+        self.assertFalse(ServiceTicket.objects.filter(ticket=st.ticket).exists())
+        with self.assertRaisesRegex(InvalidTicket, 'has already been used'):
+            ServiceTicket.objects.validate_ticket(st.ticket, service)
+
+    @override_settings(MAMA_CAS_DELETE_CONSUMED_TICKETS=True)
+    def test_validate_ticket_delete_consumed_invalid_service(self):
+        """
+        When consumed tickets are deleted, a ticket consumed by a
+        failed validation ought to be deleted.
+        """
+        st = ServiceTicketFactory(service='http://example.com')
+        with self.assertRaises(InvalidService):
+            ServiceTicket.objects.validate_ticket(st.ticket, 'http://www.example.org')
+        self.assertFalse(ServiceTicket.objects.filter(ticket=st.ticket).exists())
+
+    @override_settings(MAMA_CAS_DELETE_CONSUMED_TICKETS=True)
+    def test_discard_ticket_retained(self):
+        """
+        Tickets needed for single logout or referenced by other
+        tickets should not be deleted.
+        """
+        logout = ServiceTicketFactory(consume=True)
+        referenced = ServiceTicketFactory(service='http://example.com', consume=True)
+        ProxyGrantingTicketFactory(granted_by_st=referenced)
+        ServiceTicket.objects.discard_ticket(logout)
+        ServiceTicket.objects.discard_ticket(referenced)
+        self.assertEqual(ServiceTicket.objects.count(), 2)
+
+    def test_discard_ticket_disabled(self):
+        """
+        Consumed tickets should not be deleted unless enabled.
+        """
+        st = ServiceTicketFactory(service='http://example.com', consume=True)
+        ServiceTicket.objects.discard_ticket(st)
+        self.assertTrue(ServiceTicket.objects.filter(ticket=st.ticket).exists())
+
     def test_delete_invalid_tickets(self):
         """
         Expired or consumed tickets should be deleted. Invalid tickets
@@ -291,6 +373,74 @@ class ServiceTicketManagerTests(TestCase):
             ServiceTicket.objects.request_sign_out(self.user)
             self.assertEqual(mock.call_count, 2)
 
+    def test_validate_tickets(self):
+        """
+        Validating several tickets should return the validated ticket
+        or the error for each, in order, consuming the tickets.
+        """
+        st = ServiceTicketFactory()
+        consumed = ServiceTicketFactory(consume=True)
+        missing = ServiceTicket.objects.create_ticket_str()
+        url = 'http://www.example.com/'
+        with self.assertNumQueries(3):
+            results = ServiceTicket.objects.validate_tickets([
+                (st.ticket, url), (consumed.ticket, url), (missing, url), ('invalid', url), (None, url),
+            ])
+        self.assertEqual(results[0], st)
+        self.assertTrue(ServiceTicket.objects.get(pk=st.pk).is_consumed())
+        self.assertIsInstance(results[1], InvalidTicket)
+        self.assertIsInstance(results[2], InvalidTicket)
+        self.assertIsInstance(results[3], InvalidTicket)
+        self.assertIsInstance(results[4], InvalidRequest)
+
+    def test_validate_tickets_users(self):
+        """
+        The users of validated tickets should be loaded with the tickets,
+        whether or not the user fields are known.
+        """
+        for user_fields in (None, ('first_name',)):
+            sts = [ServiceTicketFactory() for _ in range(3)]
+            usernames = [st.user.get_username() for st in sts]
+            results = ServiceTicket.objects.validate_tickets(
+                [(st.ticket, 'http://www.example.com/') for st in sts], user_fields=user_fields)
+            with self.assertNumQueries(0):
+                self.assertEqual([st.user.get_username() for st in results], usernames)
+
+    def test_validate_tickets_repeated(self):
+        """
+        A ticket repeated in a batch should only validate the first
+        time.
+        """
+        st = ServiceTicketFactory()
+        results = ServiceTicket.objects.validate_tickets([(st.ticket, 'http://www.example.com/')] * 2)
+        self.assertEqual(results[0], st)
+        self.assertIsInstance(results[1], InvalidTicket)
+
+    def test_validate_tickets_invalid_service(self):
+        """
+        A ticket failing a check should be consumed and reported without
+        affecting other tickets.
+        """
+        st1 = ServiceTicketFactory()
+        st2 = ServiceTicketFactory()
+        results = ServiceTicket.objects.validate_tickets([
+            (st1.ticket, 'http://www.example.org/'), (st2.ticket, 'http://www.example.com/'),
+        ])
+        self.assertIsInstance(results[0], InvalidService)
+        self.assertEqual(results[1], st2)
+        self.assertTrue(ServiceTicket.objects.get(pk=st1.pk).is_consumed())
+
+    @override_settings(MAMA_CAS_DELETE_CONSUMED_TICKETS=True)
+    def test_validate_tickets_tombstone(self):
+        """
+        A ticket deleted after it was consumed should be reported as
+        already used.
+        """
+        st = ServiceTicketFactory(service='http://example.com/')
+        ServiceTicket.objects.validate_ticket(st.ticket, 'http://example.com/')
+        results = ServiceTicket.objects.validate_tickets([(st.ticket, 'http://example.com/')])
+        self.assertIn('already been used', str(results[0]))
+
 
 class ServiceTicketTests(TestCase):
     """
@@ -550,6 +700,26 @@ class ProxyGrantingTicketManager(TestCase):
         with self.assertRaises(InvalidService):
             ProxyGrantingTicket.objects.validate_ticket(pgt.ticket, 'http://www.example.org')
 
+    @patch.object(ProxyGrantingTicket, 'TICKET_IDLE_EXPIRE', 60)
+    def test_validate_ticket_idle_ticket(self):
+        """
+        The validation process ought to fail when a ticket has not
+        been used within the idle timeout.
+        """
+        pgt = ProxyGrantingTicketFactory(last_used=now() - timedelta(seconds=120))
+        with self.assertRaises(InvalidTicket):
+            ProxyGrantingTicket.objects.validate_ticket(pgt.ticket, 'https://www.example.com')
+
+    @patch.object(ProxyGrantingTicket, 'TICKET_IDLE_EXPIRE', 60)
+    def test_delete_invalid_tickets_idle(self):
+        """
+        Tickets that have exceeded the idle timeout should be deleted.
+        """
+        pgt = ProxyGrantingTicketFactory(last_used=now() - timedelta(seconds=120))
+        ProxyGrantingTicket.objects.delete_invalid_tickets()
+        self.assertFalse(ProxyGrantingTicket.objects.filter(pk=pgt.pk).exists())
+        self.assertTrue(ProxyGrantingTicket.objects.filter(pk=self.pt.granted_by_pgt.pk).exists())
+
 
 class ProxyGrantingTicketTests(TestCase):
     """
@@ -562,3 +732,25 @@ class ProxyGrantingTicketTests(TestCase):
         """
         pgt = ProxyGrantingTicketFactory()
         self.assertTrue(pgt.ticket.startswith(pgt.TICKET_PREFIX))
+
+    def test_touch(self):
+        """
+        ``touch()`` should update the last used timestamp once the
+        touch interval has passed.
+        """
+        last_used = now() - timedelta(seconds=ProxyGrantingTicket.TOUCH_INTERVAL + 5)
+        pgt = ProxyGrantingTicketFactory(last_used=last_used)
+        pgt.touch()
+        pgt = ProxyGrantingTicket.objects.get(pk=pgt.pk)
+        self.assertTrue(pgt.last_used > last_used)
+
+    def test_touch_interval(self):
+        """
+        ``touch()`` should not update the last used timestamp within
+        the touch interval.
+        """
+        last_used = now() - timedelta(seconds=5)
+        pgt = ProxyGrantingTicketFactory(last_used=last_used)
+        pgt.touch()
+        pgt = ProxyGrantingTicket.objects.get(pk=pgt.pk)
+        self.assertEqual(pgt.last_used, last_used)
@@ -1,3 +1,6 @@
+from datetime import date
+import json
+
 from django.test import TestCase
 
 from .factories import ProxyGrantingTicketFactory
@@ -5,6 +8,8 @@ from .factories import ProxyTicketFactory
 from .factories import ServiceTicketFactory
 from .utils import parse
 from mama_cas.exceptions import InvalidTicket
+from mama_cas.response import JsonProxyResponse
+from mama_cas.response import JsonValidationResponse
 from mama_cas.response import ValidationResponse
 from mama_cas.response import ProxyResponse
 from mama_cas.response import SamlValidationResponse
@@ -151,6 +156,31 @@ class ValidationResponseTests(TestCase):
         self.assertEqual(attributes[0].tag, 'unicode')
         self.assertEqual(attributes[0].text, 'тнє мαмαѕ & тнє ραραѕ')
 
+    def test_validation_response_escaping(self):
+        """
+        A ``ValidationResponse`` should escape values and write empty
+        values as self-closing elements, as ``ElementTree`` does.
+        """
+        attrs = {'escaped': 'a <b> & "c"', 'empty': ''}
+        resp = ValidationResponse(context={'ticket': self.st, 'error': None,
+                                           'attributes': attrs},
+                                  content_type='text/xml')
+        self.assertEqual(resp.content, b'<cas:serviceResponse xmlns:cas="http://www.yale.edu/tp/cas">'
+                                       b'<cas:authenticationSuccess><cas:user>ellen</cas:user><cas:attributes>'
+                                       b'<cas:escaped>a &lt;b&gt; &amp; "c"</cas:escaped><cas:empty />'
+                                       b'</cas:attributes></cas:authenticationSuccess></cas:serviceResponse>')
+
+    def test_validation_response_error_escaping(self):
+        """
+        A ``ValidationResponse`` failure should escape the error text.
+        """
+        error = InvalidTicket('Ticket <ST> & more')
+        resp = ValidationResponse(context={'ticket': None, 'error': error},
+                                  content_type='text/xml')
+        self.assertEqual(resp.content, b'<cas:serviceResponse xmlns:cas="http://www.yale.edu/tp/cas">'
+                                       b'<cas:authenticationFailure code="INVALID_TICKET">Ticket &lt;ST&gt; &amp; more'
+                                       b'</cas:authenticationFailure></cas:serviceResponse>')
+
 
 class ProxyResponseTests(TestCase):
     def setUp(self):
@@ -192,6 +222,70 @@ class ProxyResponseTests(TestCase):
         self.assertEqual(failure.text, 'Testing Error')
 
 
+class JsonValidationResponseTests(TestCase):
+    def setUp(self):
+        self.st = ServiceTicketFactory()
+        self.pgt = ProxyGrantingTicketFactory()
+
+    def test_json_validation_response_ticket(self):
+        """
+        When given a ticket, a ``JsonValidationResponse`` should return
+        an authentication success with the authenticated user, a
+        proxy-granting ticket and proxies.
+        """
+        proxy_list = ['https://proxy2/pgtUrl', 'https://proxy1/pgtUrl']
+        resp = JsonValidationResponse(context={'ticket': self.st, 'error': None, 'pgt': self.pgt,
+                                               'proxies': proxy_list})
+        self.assertEqual(resp.get('Content-Type'), 'application/json')
+        self.assertEqual(json.loads(resp.content), {'serviceResponse': {'authenticationSuccess': {
+            'user': 'ellen', 'proxyGrantingTicket': self.pgt.iou, 'proxies': proxy_list,
+        }}})
+
+    def test_json_validation_response_error(self):
+        """
+        When given an error, a ``JsonValidationResponse`` should return
+        an authentication failure with the error code and text.
+        """
+        resp = JsonValidationResponse(context={'ticket': None, 'error': InvalidTicket('Testing "Error"')})
+        self.assertEqual(json.loads(resp.content), {'serviceResponse': {'authenticationFailure': {
+            'code': 'INVALID_TICKET', 'description': 'Testing "Error"',
+        }}})
+
+    def test_json_validation_response_attributes(self):
+        """
+        A ``JsonValidationResponse`` should render each attribute as a
+        list of values, converting values JSON cannot represent to
+        strings.
+        """
+        attrs = {'givenName': 'Ellen', 'groups': ['group1', 'group2'], 'active': True,
+                 'joined': date(2020, 1, 1), 'name': '\u00c9llen'}
+        resp = JsonValidationResponse(context={'ticket': self.st, 'error': None, 'attributes': attrs})
+        attributes = json.loads(resp.content)['serviceResponse']['authenticationSuccess']['attributes']
+        self.assertEqual(attributes, {'givenName': ['Ellen'], 'groups': ['group1', 'group2'], 'active': [True],
+                                      'joined': ['2020-01-01'], 'name': ['\u00c9llen']})
+
+
+class JsonProxyResponseTests(TestCase):
+    def test_json_proxy_response_ticket(self):
+        """
+        When given a ticket, a ``JsonProxyResponse`` should return a
+        proxy request success with the proxy ticket.
+        """
+        pt = ProxyTicketFactory()
+        resp = JsonProxyResponse(context={'ticket': pt, 'error': None})
+        self.assertEqual(json.loads(resp.content), {'serviceResponse': {'proxySuccess': {'proxyTicket': pt.ticket}}})
+
+    def test_json_proxy_response_error(self):
+        """
+        When given an error, a ``JsonProxyResponse`` should return a
+        proxy request failure with the error code and text.
+        """
+        resp = JsonProxyResponse(context={'ticket': None, 'error': InvalidTicket('Testing Error')})
+        self.assertEqual(json.loads(resp.content), {'serviceResponse': {'proxyFailure': {
+            'code': 'INVALID_TICKET', 'description': 'Testing Error',
+        }}})
+
+
 class SamlValidationResponseTests(TestCase):
     def setUp(self):
         self.st = ServiceTicketFactory(consume=True)
@@ -1,16 +1,44 @@
+import json
+import os
+import re
+import tempfile
+import warnings
+from unittest.mock import Mock
+from unittest.mock import patch
+
 from django.conf import settings
 from django.core.exceptions import ImproperlyConfigured
+from django.core.exceptions import ValidationError as DjangoValidationError
+from django.db import DatabaseError
 from django.test import TestCase
 from django.test.utils import modify_settings
 from django.test.utils import override_settings
 
+from mama_cas.callbacks import user_model_attributes
+from mama_cas.callbacks import user_name_attributes
+from mama_cas.services import get_attribute_ttl
 from mama_cas.services import get_callbacks
 from mama_cas.services import get_logout_url
+from mama_cas.services import get_pipeline
+from mama_cas.services import get_release
+from mama_cas.services import get_user_fields
 from mama_cas.services import logout_allowed
 from mama_cas.services import proxy_allowed
 from mama_cas.services import proxy_callback_allowed
+from mama_cas.services import get_service_context
+from mama_cas.services import registry
+from mama_cas.services import ServiceContext
 from mama_cas.services import service_allowed
+from mama_cas.models import ServiceDefinition
+from mama_cas.services.backends import DatabaseBackend
+from mama_cas.services.backends import FileBackend
+from mama_cas.services.backends import literal_prefix
+from mama_cas.services.backends import ServiceMatcher
 from mama_cas.services.backends import services as cached_services
+from mama_cas.services.backends import ServiceConfig
+from mama_cas.services.lint import generate_samples
+from mama_cas.services.lint import has_nested_quantifier
+from mama_cas.services.lint import ServiceLinter
 
 
 class ServicesTests(TestCase):
@@ -30,6 +58,33 @@ class ServicesTests(TestCase):
         self.assertEqual(get_callbacks('http://www.example.com'), ['mama_cas.callbacks.user_name_attributes'])
         self.assertEqual(get_callbacks('http://example.org'), [])
 
+    @override_settings(MAMA_CAS_SERVICES=[{
+        'SERVICE': r'http://www\.example\.com',
+        'CALLBACKS': [
+            'mama_cas.callbacks.user_name_attributes',
+            'mama_cas.callbacks.user_model_attributes',
+            'mama_cas.callbacks.user_name_attributes',
+        ],
+    }])
+    def test_get_pipeline(self):
+        """
+        ``get_pipeline()`` should return the resolved callbacks, each
+        once in the position of its last occurrence.
+        """
+        self.assertEqual(get_pipeline('http://www.example.com'), (
+            ('mama_cas.callbacks.user_model_attributes', user_model_attributes),
+            ('mama_cas.callbacks.user_name_attributes', user_name_attributes),
+        ))
+        self.assertIsNone(get_user_fields('http://www.example.com'))
+
+    def test_get_user_fields(self):
+        """
+        When every callback declares ``user_fields``, ``get_user_fields()``
+        should return their union.
+        """
+        self.assertEqual(get_user_fields('http://www.example.com'), {'first_name', 'last_name'})
+        self.assertEqual(get_user_fields('http://example.org'), set())
+
     def test_get_logout_url(self):
         """
         When a logout URL is configured, ``get_logout_url()`` should return
@@ -132,6 +187,117 @@ class ServicesTests(TestCase):
         self.assertTrue(service_allowed('http://www.example.com'))
         self.assertTrue(service_allowed('http://www.test.com'))
 
+    def test_service_context(self):
+        """
+        A ``ServiceContext`` should return the same results as the
+        service identifier, resolving each setting only once.
+        """
+        service = ServiceContext('http://www.example.com/path?query=1')
+        self.assertEqual(service.url.clean, 'http://www.example.com/path')
+        with patch('mama_cas.services._is_allowed', return_value=True) as mock:
+            self.assertTrue(service_allowed(service))
+            self.assertTrue(service_allowed(service))
+            self.assertTrue(proxy_allowed(service))
+            self.assertEqual(mock.call_count, 2)
+        self.assertEqual(get_callbacks(service), ['mama_cas.callbacks.user_name_attributes'])
+        self.assertEqual(get_logout_url(service), 'https://example.com/logout')
+        self.assertIs(get_service_context(service), service)
+        self.assertIsNone(get_service_context(None))
+
+    @override_settings(MAMA_CAS_SERVICE_CACHE_SIZE=2)
+    def test_service_cache(self):
+        """
+        Service contexts should be cached and reused, evicting the
+        least recently used context when full.
+        """
+        service = get_service_context('http://www.example.com')
+        self.assertIs(get_service_context('http://www.example.com'), service)
+        get_service_context('http://www.example.org')
+        get_service_context('http://example.com')
+        self.assertIsNot(get_service_context('http://www.example.org'), None)
+        info = registry.cache_info()
+        self.assertEqual((info.hits, info.misses, info.evictions, info.currsize), (2, 3, 1, 2))
+
+    def test_service_context_proxy_callback(self):
+        """
+        Proxy callback URLs should be checked on every call, so cached
+        contexts do not retain client supplied URLs.
+        """
+        service = get_service_context('http://www.example.com')
+        with patch('mama_cas.services._is_allowed', return_value=True) as mock:
+            self.assertTrue(proxy_callback_allowed(service, 'https://www.example.com/1'))
+            self.assertTrue(proxy_callback_allowed(service, 'https://www.example.com/1'))
+        self.assertEqual(mock.call_count, 2)
+        self.assertFalse(hasattr(service, '_proxy_callbacks'))
+
+    def test_service_context_get_context(self):
+        """
+        A context for a different service identifier should come from
+        the service cache.
+        """
+        service = get_service_context('http://www.example.com/?query=1')
+        self.assertIs(service.get_context('http://www.example.com/?query=1'), service)
+        self.assertIs(service.get_context('http://www.example.com/'), get_service_context('http://www.example.com/'))
+
+    @override_settings(
+        MAMA_CAS_SERVICE_BACKENDS=[
+            'mama_cas.tests.backends.CustomTestServiceBackend'
+        ]
+    )
+    def test_service_cache_subclass(self):
+        """
+        The service cache should be disabled for a backend inheriting
+        ``cacheable`` without declaring it.
+        """
+        self.assertIsNone(registry.cache_info())
+        self.assertTrue(service_allowed('http://www.test.com'))
+
+    @override_settings(
+        MAMA_CAS_SERVICE_BACKENDS=[
+            'mama_cas.tests.backends.CustomTestUncacheableServiceBackend'
+        ]
+    )
+    def test_service_cache_uncacheable(self):
+        """
+        The service cache should be disabled if any backend is not
+        cacheable.
+        """
+        self.assertIsNone(registry.cache_info())
+        self.assertIsNot(get_service_context('http://www.example.com'),
+                         get_service_context('http://www.example.com'))
+
+    def test_registry_backends_cached(self):
+        """
+        Service backends should be instantiated once and reused.
+        """
+        backends = registry.backends
+        service_allowed('http://www.example.com')
+        self.assertIs(registry.backends, backends)
+
+    def test_registry_setting_changed(self):
+        """
+        Changing a service setting should reload the service backends.
+        """
+        backends = registry.backends
+        with override_settings(MAMA_CAS_SERVICE_BACKENDS=['mama_cas.tests.backends.CustomTestServiceBackend']):
+            self.assertEqual(registry.backends[0].__class__.__name__, 'CustomTestServiceBackend')
+        self.assertIsNot(registry.backends, backends)
+        self.assertEqual(registry.backends[0].__class__.__name__, 'SettingsBackend')
+
+    def test_registry_single_sign_out_changed(self):
+        """
+        Changing the deprecated single sign-out setting should discard
+        cached service contexts.
+        """
+        with override_settings(MAMA_CAS_ENABLE_SINGLE_SIGN_OUT=False):
+            del settings.MAMA_CAS_SERVICES
+            registry.reset()
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore', DeprecationWarning)
+                self.assertFalse(logout_allowed('http://www.example.com'))
+                with override_settings(MAMA_CAS_ENABLE_SINGLE_SIGN_OUT=True):
+                    self.assertTrue(logout_allowed('http://www.example.com'))
+
     @override_settings(
         MAMA_CAS_SERVICE_BACKENDS=[
             'mama_cas.tests.backends.CustomTestInvalidServiceBackend'
@@ -157,3 +323,351 @@ class ServicesTests(TestCase):
 
         with self.assertRaises(NotImplementedError):
             proxy_allowed('http://www.example.com')
+
+
+class ServiceMatcherTests(TestCase):
+    def setUp(self):
+        self.tearDown()
+
+    def tearDown(self):
+        try:
+            del cached_services.services
+        except AttributeError:
+            pass
+
+    @override_settings(MAMA_CAS_SERVICES=[
+        {'SERVICE': r'https://(www)\.example\.com/app', 'LOGOUT_URL': 'first'},
+        {'SERVICE': r'https://www\.example\.com', 'LOGOUT_URL': 'second'},
+        {'SERVICE': r'https://(?P<host>.+)\.example\.com', 'LOGOUT_URL': 'third'},
+    ])
+    def test_match_order(self):
+        """
+        The first matching service should be returned, regardless of
+        any groups within the configured patterns.
+        """
+        self.assertEqual(cached_services.get_service('https://www.example.com/app')['LOGOUT_URL'], 'first')
+        self.assertEqual(cached_services.get_service('https://www.example.com/')['LOGOUT_URL'], 'second')
+        self.assertEqual(cached_services.get_service('https://sub.example.com/')['LOGOUT_URL'], 'third')
+        self.assertEqual(cached_services.get_service('https://www.example.org/'), {})
+
+    @override_settings(MAMA_CAS_SERVICES=[
+        {'SERVICE': r'https://(a)\1\.example\.com', 'LOGOUT_URL': 'first'},
+        {'SERVICE': r'(?i)https://www\.example\.com', 'LOGOUT_URL': 'second'},
+    ])
+    def test_match_fallback(self):
+        """
+        Patterns using backreferences or inline flags should still be
+        matched in order.
+        """
+        self.assertEqual(cached_services.get_service('https://aa.example.com')['LOGOUT_URL'], 'first')
+        self.assertEqual(cached_services.get_service('HTTPS://WWW.EXAMPLE.COM')['LOGOUT_URL'], 'second')
+        self.assertEqual(cached_services.get_service('https://a.example.com'), {})
+
+    def test_literal_prefix(self):
+        """
+        The literal prefix should end at the first non-literal element,
+        and be empty for case-insensitive patterns.
+        """
+        self.assertEqual(literal_prefix(re.compile(r'^https?://www\.example\.com')), 'http')
+        self.assertEqual(literal_prefix(re.compile(r'\Ahttps://www\.example\.com/.*')), 'https://www.example.com/')
+        self.assertEqual(literal_prefix(re.compile(r'.*\.example\.com')), '')
+        self.assertEqual(literal_prefix(re.compile(r'(?i)https://www\.example\.com')), '')
+
+    @override_settings(MAMA_CAS_SERVICES=[
+        {'SERVICE': r'^https://www\.example\.com/', 'LOGOUT_URL': 'www'},
+        {'SERVICE': r'https://(www|app)\.example\.com/', 'LOGOUT_URL': 'group'},
+        {'SERVICE': r'^https://www\.example\.org/', 'LOGOUT_URL': 'org'},
+    ])
+    def test_match_prefix(self):
+        """
+        Only patterns whose literal prefix matches the service should
+        be tested, with the first matching pattern returned.
+        """
+        matcher = cached_services.matcher
+        candidates = [service['LOGOUT_URL'] for i, service in matcher.get_regex_candidates('https://www.example.org/')]
+        self.assertEqual(candidates, ['group', 'org'])
+        self.assertEqual(cached_services.get_service('https://www.example.com/')['LOGOUT_URL'], 'www')
+        self.assertEqual(cached_services.get_service('https://app.example.com/')['LOGOUT_URL'], 'group')
+        self.assertEqual(cached_services.get_service('https://www.example.org/')['LOGOUT_URL'], 'org')
+        self.assertEqual(cached_services.get_service('http://www.example.com/'), {})
+
+    @override_settings(MAMA_CAS_SERVICES=[
+        {'URL': 'https://www.example.com/login', 'LOGOUT_URL': 'url'},
+        {'SERVICE': r'https://www\.example\.com/log', 'LOGOUT_URL': 'regex'},
+        {'HOST': '*.example.com', 'SCHEME': 'https', 'PATH': '/app', 'LOGOUT_URL': 'wildcard'},
+        {'HOST': 'Example.com', 'LOGOUT_URL': 'host'},
+        {'SERVICE': r'https?://.+\.example\.', 'LOGOUT_URL': 'fallback'},
+    ])
+    def test_match_structured(self):
+        """
+        Structured services should match exact URLs, hosts, wildcard
+        hosts and path prefixes, with the first listed service winning.
+        """
+        get_service = cached_services.get_service
+        self.assertEqual(get_service('https://www.example.com/login?next=/')['LOGOUT_URL'], 'url')
+        self.assertEqual(get_service('https://www.example.com/logout')['LOGOUT_URL'], 'regex')
+        self.assertEqual(get_service('https://a.b.example.com/app/x')['LOGOUT_URL'], 'wildcard')
+        self.assertEqual(get_service('http://a.example.com/app')['LOGOUT_URL'], 'fallback')
+        self.assertEqual(get_service('https://a.example.com/other')['LOGOUT_URL'], 'fallback')
+        self.assertEqual(get_service('http://example.com:8080/any')['LOGOUT_URL'], 'host')
+        self.assertEqual(get_service('https://example.org/app'), {})
+
+    @override_settings(MAMA_CAS_SERVICES=[
+        {'SERVICE': r'^https://www\.example\.org/', 'LOGOUT_URL': 'other'},
+        {'SERVICE': r'^https://www\.example\.com/a(dmin)?/', 'LOGOUT_URL': 'admin'},
+        {'HOST': 'www.example.com', 'LOGOUT_URL': 'host'},
+        {'SERVICE': r'.*', 'LOGOUT_URL': 'any'},
+    ])
+    def test_match_structured_skips_regex(self):
+        """
+        A structured match should only test earlier patterns whose
+        literal prefix matches the service.
+        """
+        matcher = cached_services.matcher
+        for i, service in matcher.regex_services:
+            service['MATCH'] = Mock(wraps=service['MATCH'])
+        self.assertEqual(cached_services.get_service('https://www.example.com/app')['LOGOUT_URL'], 'host')
+        called = [service['LOGOUT_URL'] for i, service in matcher.regex_services if service['MATCH'].match.called]
+        self.assertEqual(called, ['admin'])
+
+    def test_matcher_rebuilt(self):
+        """
+        The matcher should be rebuilt when the cached services are
+        reset.
+        """
+        matcher = cached_services.matcher
+        self.assertIsInstance(matcher, ServiceMatcher)
+        del cached_services.services
+        self.assertIsNot(cached_services.matcher, matcher)
+
+
+@override_settings(
+    MAMA_CAS_SERVICE_BACKENDS=['mama_cas.services.backends.DatabaseBackend'],
+    MAMA_CAS_SERVICE_RELOAD_INTERVAL=0,
+)
+class DatabaseBackendTests(TestCase):
+    def setUp(self):
+        DatabaseBackend.reset()
+        self.definition = ServiceDefinition.objects.create(
+            service=r'https?://www\.example\.com',
+            callbacks='mama_cas.callbacks.user_name_attributes',
+            logout_allow=True,
+            logout_url='https://www.example.com/logout',
+            proxy_allow=True,
+            proxy_pattern=r'https://proxy\.example\.com',
+        )
+        ServiceDefinition.objects.create(host='*.example.org', scheme='https', position=1)
+
+    def test_service_allowed(self):
+        """
+        Services should be allowed according to the definitions.
+        """
+        self.assertTrue(service_allowed('http://www.example.com'))
+        self.assertTrue(service_allowed('https://sub.example.org/path'))
+        self.assertFalse(service_allowed('http://sub.example.org/path'))
+        self.assertFalse(service_allowed('https://www.example.net'))
+
+    def test_definition_clean(self):
+        """
+        A definition should require exactly one of a service pattern,
+        URL or host, and valid regular expressions.
+        """
+        self.definition.full_clean()
+        for fields in ({'service': ''}, {'url': 'https://www.example.com/'}, {'proxy_pattern': '('},
+                       {'service': '[a-'}):
+            definition = ServiceDefinition.objects.get(pk=self.definition.pk)
+            for name, value in fields.items():
+                setattr(definition, name, value)
+            with self.assertRaises(DjangoValidationError):
+                definition.full_clean()
+        ServiceDefinition(host='www.example.net').full_clean()
+
+    def test_service_config(self):
+        """
+        Service settings should be read from the definitions.
+        """
+        self.assertEqual(get_callbacks('http://www.example.com'), ['mama_cas.callbacks.user_name_attributes'])
+        self.assertEqual(get_logout_url('http://www.example.com'), 'https://www.example.com/logout')
+        self.assertTrue(logout_allowed('http://www.example.com'))
+        self.assertTrue(proxy_allowed('http://www.example.com'))
+        self.assertTrue(proxy_callback_allowed('http://www.example.com', 'https://proxy.example.com'))
+        self.assertFalse(proxy_allowed('https://sub.example.org'))
+
+    @override_settings(
+        MAMA_CAS_SERVICE_BACKENDS=[
+            'mama_cas.services.backends.SettingsBackend',
+            'mama_cas.services.backends.DatabaseBackend',
+        ],
+        MAMA_CAS_SERVICES=[{'SERVICE': r'https://www\.example\.net', 'ATTRIBUTE_TTL': 60}],
+    )
+    def test_release_matching_backend(self):
+        """
+        The release allowlist and attribute TTL should be taken from
+        the backend allowing the service.
+        """
+        self.definition.release = 'username'
+        self.definition.attribute_ttl = 30
+        self.definition.save()
+        self.assertEqual(get_release('http://www.example.com'), frozenset(['username']))
+        self.assertEqual(get_attribute_ttl('http://www.example.com'), 30)
+        self.assertEqual(get_attribute_ttl('https://www.example.net'), 60)
+
+    def test_snapshot_reload_error(self):
+        """
+        A database error while reloading should keep the current
+        snapshot.
+        """
+        self.assertTrue(service_allowed('http://www.example.com'))
+        self.definition.delete()
+        with patch.object(DatabaseBackend, 'get_definitions', side_effect=DatabaseError):
+            with self.assertLogs('mama_cas.services.backends', 'ERROR'):
+                self.assertTrue(service_allowed('http://www.example.com'))
+        self.assertFalse(service_allowed('http://www.example.com'))
+
+    def test_snapshot_reload(self):
+        """
+        Changing a definition should load a new snapshot without
+        querying the database when nothing has changed.
+        """
+        self.assertTrue(service_allowed('http://www.example.com'))
+        with self.assertNumQueries(0):
+            self.assertTrue(service_allowed('http://www.example.com'))
+        self.definition.delete()
+        self.assertFalse(service_allowed('http://www.example.com'))
+
+
+@override_settings(
+    MAMA_CAS_SERVICE_BACKENDS=['mama_cas.services.backends.FileBackend'],
+    MAMA_CAS_SERVICE_RELOAD_INTERVAL=0,
+)
+class FileBackendTests(TestCase):
+    def setUp(self):
+        FileBackend.reset()
+        fd, self.path = tempfile.mkstemp(suffix='.json')
+        os.close(fd)
+        self.write([
+            {'SERVICE': r'https?://www\.example\.com', 'LOGOUT_ALLOW': True},
+            {'HOST': '*.example.org', 'SCHEME': 'https'},
+        ])
+        self.override = override_settings(MAMA_CAS_SERVICES_FILE=self.path)
+        self.override.enable()
+
+    def tearDown(self):
+        self.override.disable()
+        os.remove(self.path)
+        FileBackend.reset()
+
+    def write(self, definitions, mtime=None):
+        with open(self.path, 'w') as f:
+            json.dump(definitions, f)
+        if mtime is not None:
+            os.utime(self.path, (mtime, mtime))
+
+    def test_service_allowed(self):
+        """
+        Services should be allowed according to the file definitions.
+        """
+        self.assertTrue(service_allowed('http://www.example.com'))
+        self.assertTrue(logout_allowed('http://www.example.com'))
+        self.assertTrue(service_allowed('https://sub.example.org/path'))
+        self.assertFalse(service_allowed('http://sub.example.org/path'))
+
+    def test_snapshot_reload(self):
+        """
+        Modifying the file should load a new snapshot.
+        """
+        self.assertTrue(service_allowed('http://www.example.com'))
+        self.write([{'HOST': 'www.example.net'}], mtime=os.stat(self.path).st_mtime + 10)
+        self.assertFalse(service_allowed('http://www.example.com'))
+        self.assertTrue(service_allowed('http://www.example.net'))
+
+    @override_settings(MAMA_CAS_SERVICE_RELOAD_INTERVAL=60)
+    def test_snapshot_reload_interval(self):
+        """
+        The file should not be checked again until the reload interval
+        has elapsed.
+        """
+        self.assertTrue(service_allowed('http://www.example.com'))
+        self.write([{'HOST': 'www.example.net'}], mtime=os.stat(self.path).st_mtime + 10)
+        self.assertTrue(service_allowed('http://www.example.com'))
+
+    def test_snapshot_refresh_once(self):
+        """
+        Threads waiting to refresh the same snapshot should reuse the
+        snapshot loaded by the first.
+        """
+        backend = FileBackend()
+        backend.get_service_config()
+        snapshot = FileBackend._snapshot
+        self.write([{'HOST': 'www.example.net'}], mtime=os.stat(self.path).st_mtime + 10)
+        with patch.object(FileBackend, 'load', autospec=True, side_effect=FileBackend.load) as load:
+            refreshed = backend.refresh(snapshot)
+            self.assertIs(backend.refresh(snapshot), refreshed)
+        self.assertEqual(load.call_count, 1)
+        self.assertTrue(refreshed.config.get_service('http://www.example.net'))
+
+    def test_snapshot_reload_error(self):
+        """
+        A missing or invalid file should keep the current snapshot, and
+        a valid file should be loaded once it is fixed.
+        """
+        self.assertTrue(service_allowed('http://www.example.com'))
+        mtime = os.stat(self.path).st_mtime
+        with open(self.path, 'w') as f:
+            f.write('[{')
+        os.utime(self.path, (mtime + 10, mtime + 10))
+        with self.assertLogs('mama_cas.services.backends', 'ERROR'):
+            self.assertTrue(service_allowed('http://www.example.com'))
+        os.rename(self.path, self.path + '.moved')
+        try:
+            with self.assertLogs('mama_cas.services.backends', 'ERROR'):
+                self.assertTrue(service_allowed('http://www.example.com'))
+        finally:
+            os.rename(self.path + '.moved', self.path)
+        self.write([{'HOST': 'www.example.net'}], mtime=mtime + 20)
+        self.assertFalse(service_allowed('http://www.example.com'))
+
+    def test_missing_file(self):
+        """
+        A missing services file should raise ``ImproperlyConfigured``.
+        """
+        with override_settings(MAMA_CAS_SERVICES_FILE=self.path + '.missing'):
+            with self.assertRaises(ImproperlyConfigured):
+                service_allowed('http://www.example.com')
+
+
+class ServiceLinterTests(TestCase):
+    def test_generate_samples(self):
+        """
+        Generated samples should match the pattern they are generated from.
+        """
+        for pattern in (r'^https?://(www\.)?example\.(com|org)/[^/]+$', r'^https://\w+\.example\.com(?=/)/\d{2,4}'):
+            pattern = re.compile(pattern)
+            samples = generate_samples(pattern)
+            self.assertTrue(samples)
+            for sample in samples:
+                self.assertTrue(pattern.match(sample))
+
+    def test_match_costs_skip_backtracking(self):
+        """
+        Patterns flagged for backtracking should not be timed, as they
+        may never finish matching a non-matching identifier.
+        """
+        services = ServiceConfig([
+            {'SERVICE': r'^https://www\.example\.com/'},
+            {'SERVICE': r'^https://[^/]+/(.*)*x'},
+        ]).services
+        linter = ServiceLinter(services)
+        findings = linter.find_backtracking(threshold=0.01)
+        self.assertEqual(set(finding.index for finding in findings), {1})
+        self.assertEqual([cost.index for cost in linter.match_costs(number=1)], [0])
+        self.assertEqual([cost.index for cost in ServiceLinter(services).match_costs(number=1)], [0])
+
+    def test_has_nested_quantifier(self):
+        """
+        Repeated groups containing unbounded repetitions should be
+        detected.
+        """
+        self.assertTrue(has_nested_quantifier(re.compile(r'^https://(a+)+$')))
+        self.assertTrue(has_nested_quantifier(re.compile(r'^https://(?:[a-z]*\.)*example\.com')))
+        self.assertFalse(has_nested_quantifier(re.compile(r'^https://([a-z]+\.)?example\.com/.*')))
@@ -2,6 +2,7 @@ from django.test import TestCase
 
 from mama_cas.utils import add_query_params
 from mama_cas.utils import clean_service_url
+from mama_cas.utils import get_service_url
 from mama_cas.utils import is_scheme_https
 from mama_cas.utils import match_service
 from mama_cas.utils import redirect
@@ -63,6 +64,29 @@ class UtilsTests(TestCase):
         self.assertFalse(match_service('https://www.example.com:80/', 'https://www.example.com/'))
         self.assertFalse(match_service('https://www.example.com', 'https://www.example.com/'))
 
+    def test_get_service_url(self):
+        """
+        ``get_service_url()`` should return an immutable, memoized
+        ``ServiceURL`` with the parsed components of the URL.
+        """
+        url = get_service_url('https://www.example.com:8443/path?query=1#fragment')
+        self.assertEqual(url.scheme, 'https')
+        self.assertEqual(url.netloc, 'www.example.com:8443')
+        self.assertEqual(url.path, '/path')
+        self.assertEqual(url.clean, 'https://www.example.com:8443/path')
+        self.assertIs(get_service_url('https://www.example.com:8443/path?query=1#fragment'), url)
+        self.assertIs(get_service_url(url), url)
+        self.assertEqual(url, get_service_url('https://www.example.com:8443/path'))
+        with self.assertRaises(AttributeError):
+            url.path = '/other'
+
+    def test_match_service_invalid(self):
+        """
+        When called with an unparseable URL, ``match_service()`` should
+        return ``False``.
+        """
+        self.assertFalse(match_service('https://[www.example.com/', 'https://www.example.com/'))
+
     def test_redirect(self):
         """
         When redirecting, params should be injected on the redirection
@@ -1,3 +1,4 @@
+import json
 from unittest.mock import patch
 
 from django.urls import reverse
@@ -14,6 +15,7 @@ from mama_cas.forms import LoginForm
 from mama_cas.models import ProxyTicket
 from mama_cas.models import ServiceTicket
 from mama_cas.request import SamlValidateRequest
+from mama_cas.views import BatchValidateView
 from mama_cas.views import ProxyView
 from mama_cas.views import ProxyValidateView
 from mama_cas.views import ServiceValidateView
@@ -61,6 +63,16 @@ class LoginViewTests(TestCase):
         self.assertEqual(int(self.client.session['_auth_user_id']), self.user.pk)
         self.assertRedirects(response, reverse('cas_login'))
 
+    def test_login_view_login_prefetch(self):
+        """
+        When a single sign-on session is started, attributes should be
+        prefetched for the user.
+        """
+        with patch('mama_cas.views.prefetch_attributes') as prefetch_attributes:
+            self.client.post(reverse('cas_login') + '?service=' + self.service_url, self.user_info)
+        self.assertEqual(prefetch_attributes.call_args[0][0], self.user)
+        self.assertEqual(str(prefetch_attributes.call_args[0][1]), self.service_url)
+
     def test_login_view_login_service(self):
         """
         When called with a logged in user, a ``GET`` request to the
@@ -330,6 +342,16 @@ class ValidateViewTests(TestCase):
         st = ServiceTicket.objects.get(ticket=self.st.ticket)
         self.assertTrue(st.is_consumed())
 
+    def test_validate_view_callbacks_skipped(self):
+        """
+        As attributes are not returned, attribute callbacks should not
+        be called.
+        """
+        st = ServiceTicketFactory(service='exception')
+        request = self.rf.get(reverse('cas_validate'), {'service': 'exception', 'ticket': st.ticket})
+        response = ValidateView.as_view()(request)
+        self.assertContains(response, "yes\nellen\n")
+
 
 class ServiceValidateViewTests(TestCase):
     url = 'http://www.example.com/'
@@ -392,6 +414,59 @@ class ServiceValidateViewTests(TestCase):
         st = ServiceTicket.objects.get(ticket=self.st.ticket)
         self.assertTrue(st.is_consumed())
 
+    @override_settings(MAMA_CAS_VALIDATION_REPLAY_WINDOW=5)
+    def test_service_validate_view_replay(self):
+        """
+        When a replay window is configured, a retried validation
+        request should return the original success response.
+        """
+        request = self.rf.get(reverse('cas_service_validate'), {'service': self.url, 'ticket': self.st.ticket})
+        response = ServiceValidateView.as_view()(request)
+        self.assertContains(response, 'authenticationSuccess')
+
+        request = self.rf.get(reverse('cas_service_validate'), {'service': self.url, 'ticket': self.st.ticket})
+        replay = ServiceValidateView.as_view()(request)
+        self.assertEqual(replay.content, response.content)
+        self.assertEqual(replay.get('Content-Type'), 'text/xml')
+
+    def test_service_validate_view_json(self):
+        """
+        When ``format`` is ``JSON``, a JSON validation success should be
+        returned.
+        """
+        request = self.rf.get(reverse('cas_p3_service_validate'), {'service': self.url, 'ticket': self.st.ticket,
+                                                                   'format': 'JSON'})
+        response = ServiceValidateView.as_view()(request)
+        self.assertEqual(response.get('Content-Type'), 'application/json')
+        success = json.loads(response.content)['serviceResponse']['authenticationSuccess']
+        self.assertEqual(success['user'], 'ellen')
+        self.assertEqual(success['attributes']['full_name'], ['Ellen Cohen'])
+
+    @override_settings(MAMA_CAS_VALIDATION_REPLAY_WINDOW=5)
+    def test_service_validate_view_json_replay(self):
+        """
+        A replayed JSON response should keep the JSON content type.
+        """
+        params = {'service': self.url, 'ticket': self.st.ticket, 'format': 'json'}
+        response = ServiceValidateView.as_view()(self.rf.get(reverse('cas_p3_service_validate'), params))
+        replay = ServiceValidateView.as_view()(self.rf.get(reverse('cas_p3_service_validate'), params))
+        self.assertEqual(replay.content, response.content)
+        self.assertEqual(replay.get('Content-Type'), 'application/json')
+
+    @override_settings(MAMA_CAS_VALIDATION_REPLAY_WINDOW=5)
+    def test_service_validate_view_replay_requester(self):
+        """
+        A replayed response should only be returned to the original
+        requester.
+        """
+        request = self.rf.get(reverse('cas_service_validate'), {'service': self.url, 'ticket': self.st.ticket})
+        ServiceValidateView.as_view()(request)
+
+        request = self.rf.get(reverse('cas_service_validate'), {'service': self.url, 'ticket': self.st.ticket},
+                              REMOTE_ADDR='10.0.0.1')
+        response = ServiceValidateView.as_view()(request)
+        self.assertContains(response, 'INVALID_TICKET')
+
     def test_service_validate_view_pgturl(self):
         """
         When called with valid parameters and a ``pgtUrl``, the
@@ -450,6 +525,81 @@ class ServiceValidateViewTests(TestCase):
         self.assertContains(response, 'INTERNAL_ERROR')
         self.assertContains(response, 'Error in attribute callback')
 
+    def test_service_validate_view_exception_callbacks_pgturl(self):
+        """
+        When an attribute callback raises a ValidationError and a
+        pgtUrl is provided, a proxy-granting ticket should not be created.
+        """
+        st = ServiceTicketFactory(service='exception')
+        request = self.rf.get(reverse('cas_service_validate'),
+                              {'service': 'exception', 'ticket': st.ticket, 'pgtUrl': 'https://www.example.com/'})
+        with patch('mama_cas.models.ProxyGrantingTicketManager.create_ticket') as create_ticket:
+            response = ServiceValidateView.as_view()(request)
+        self.assertContains(response, 'INTERNAL_ERROR')
+        self.assertFalse(create_ticket.called)
+
+
+class BatchValidateViewTests(TestCase):
+    url = 'http://www.example.com/'
+
+    def setUp(self):
+        self.st = ServiceTicketFactory()
+        self.rf = RequestFactory()
+
+    def post(self, data):
+        request = self.rf.post(reverse('cas_batch_validate'), json.dumps(data), content_type='application/json')
+        return BatchValidateView.as_view()(request)
+
+    def test_batch_validate_view(self):
+        """
+        A result should be returned for each ticket in order, with the
+        same outcome as validating each separately.
+        """
+        pt_str = ProxyTicket.objects.create_ticket_str()
+        response = self.post([
+            [self.st.ticket, self.url],
+            [pt_str, self.url],
+            [self.st.ticket, self.url],
+            [None, self.url],
+        ])
+        self.assertEqual(response.get('Content-Type'), 'application/json')
+        results = [result['serviceResponse'] for result in json.loads(response.content)['results']]
+        self.assertEqual(results[0]['authenticationSuccess']['user'], 'ellen')
+        self.assertEqual(results[0]['authenticationSuccess']['attributes']['full_name'], ['Ellen Cohen'])
+        self.assertEqual(results[1]['authenticationFailure']['code'], 'INVALID_TICKET_SPEC')
+        self.assertEqual(results[2]['authenticationFailure']['code'], 'INVALID_TICKET')
+        self.assertEqual(results[3]['authenticationFailure']['code'], 'INVALID_REQUEST')
+        self.assertTrue(ServiceTicket.objects.get(ticket=self.st.ticket).is_consumed())
+
+    def test_batch_validate_view_callback_exception(self):
+        """
+        A failing attribute callback should only fail the tickets for
+        its service.
+        """
+        st = ServiceTicketFactory(service='exception')
+        response = self.post([[st.ticket, 'exception'], [self.st.ticket, self.url]])
+        results = [result['serviceResponse'] for result in json.loads(response.content)['results']]
+        self.assertEqual(results[0]['authenticationFailure']['code'], 'INTERNAL_ERROR')
+        self.assertIn('authenticationSuccess', results[1])
+
+    def test_batch_validate_view_invalid_request(self):
+        """
+        A request body that is not a list of pairs should be rejected.
+        """
+        for data in ({'ticket': self.st.ticket}, [[self.st.ticket]], [[self.st.ticket, 1]]):
+            response = self.post(data)
+            self.assertEqual(response.status_code, 400)
+            self.assertEqual(json.loads(response.content)['error']['code'], 'INVALID_REQUEST')
+
+    @override_settings(MAMA_CAS_BATCH_VALIDATE_LIMIT=1)
+    def test_batch_validate_view_limit(self):
+        """
+        A request exceeding the batch limit should be rejected.
+        """
+        response = self.post([[self.st.ticket, self.url]] * 2)
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(ServiceTicket.objects.get(ticket=self.st.ticket).is_consumed())
+
 
 class ProxyValidateViewTests(TestCase):
     url = 'http://www.example.com/'
@@ -613,6 +763,17 @@ class ProxyViewTests(TestCase):
         response = ProxyView.as_view()(request)
         self.assertContains(response, 'proxyTicket')
 
+    def test_proxy_view_json(self):
+        """
+        When ``format`` is ``JSON``, a JSON proxy success should be
+        returned.
+        """
+        request = self.rf.get(reverse('cas_proxy'), {'targetService': self.url, 'pgt': self.pgt.ticket,
+                                                     'format': 'JSON'})
+        response = ProxyView.as_view()(request)
+        self.assertEqual(response.get('Content-Type'), 'application/json')
+        self.assertIn('proxyTicket', json.loads(response.content)['serviceResponse']['proxySuccess'])
+
     def test_proxy_view_invalid_service_url(self):
         """
         When called with an invalid service identifier, a proxy
@@ -4,6 +4,7 @@
 
 from django.urls import re_path
 
+from mama_cas.views import BatchValidateView
 from mama_cas.views import LoginView
 from mama_cas.views import LogoutView
 from mama_cas.views import ValidateView
@@ -19,6 +20,7 @@ urlpatterns = [
     re_path(r'^logout/?$', LogoutView.as_view(), name='cas_logout'),
     re_path(r'^validate/?$', ValidateView.as_view(), name='cas_validate'),
     re_path(r'^serviceValidate/?$', ServiceValidateView.as_view(), name='cas_service_validate'),
+    re_path(r'^batchValidate/?$', BatchValidateView.as_view(), name='cas_batch_validate'),
     re_path(r'^proxyValidate/?$', ProxyValidateView.as_view(), name='cas_proxy_validate'),
     re_path(r'^proxy/?$', ProxyView.as_view(), name='cas_proxy'),
     re_path(r'^p3/serviceValidate/?$', ServiceValidateView.as_view(), name='cas_p3_service_validate'),
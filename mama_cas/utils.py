@@ -1,19 +1,80 @@
+from functools import lru_cache
 import logging
 from urllib.parse import parse_qsl, urlencode, urlparse, urlunparse
 
 from django.conf import settings
+from django.core.cache import caches
 from django.core.exceptions import PermissionDenied
 from django.urls import reverse, NoReverseMatch
 
 from django.http import HttpResponseRedirect
 from django.utils.encoding import force_bytes
 
+from mama_cas.services import ServiceContext
 from mama_cas.services import service_allowed
 
 
 logger = logging.getLogger(__name__)
 
 
+SERVICE_URL_CACHE_SIZE = 1024
+
+
+class ServiceURL(object):
+    """
+    An immutable, parsed service URL. The scheme, network location and
+    path, and the cleaned URL built from them, are computed once, so
+    service URLs can be compared by their ``key`` without parsing them
+    again. Use ``get_service_url()`` to obtain a memoized instance.
+    """
+    __slots__ = ('url', 'parsed', 'scheme', 'netloc', 'path', 'key', 'clean')
+
+    def __init__(self, url):
+        parsed = urlparse(url)
+        key = (parsed.scheme, parsed.netloc, parsed.path)
+        for name, value in (('url', url), ('parsed', parsed), ('scheme', parsed.scheme),
+                            ('netloc', parsed.netloc), ('path', parsed.path), ('key', key),
+                            ('clean', urlunparse(key + ('', '', '')))):
+            object.__setattr__(self, name, value)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("%s is immutable" % self.__class__.__name__)
+
+    def __delattr__(self, name):
+        raise AttributeError("%s is immutable" % self.__class__.__name__)
+
+    def __eq__(self, other):
+        if isinstance(other, ServiceURL):
+            return self.key == other.key
+        return NotImplemented
+
+    def __hash__(self):
+        return hash(self.key)
+
+    def __str__(self):
+        return self.url
+
+    def __repr__(self):
+        return '<ServiceURL: %s>' % self.url
+
+
+@lru_cache(maxsize=SERVICE_URL_CACHE_SIZE)
+def _get_service_url(url):
+    return ServiceURL(url)
+
+
+def get_service_url(url):
+    """
+    Return a ``ServiceURL`` for a URL string, ``ServiceContext`` or
+    ``ServiceURL``. Instances are memoized by URL in a bounded cache.
+    """
+    if isinstance(url, ServiceURL):
+        return url
+    if isinstance(url, ServiceContext):
+        return url.url
+    return _get_service_url(url)
+
+
 def add_query_params(url, params):
     """
     Inject additional query parameters into an existing URL. If
@@ -25,7 +86,7 @@ def add_query_params(url, params):
         return force_bytes(s, settings.DEFAULT_CHARSET)
     params = dict([(encode(k), encode(v)) for k, v in params.items() if v])
 
-    parts = list(urlparse(url))
+    parts = list(get_service_url(url).parsed)
     query = dict(parse_qsl(parts[4]))
     query.update(params)
     parts[4] = urlencode(query)
@@ -37,7 +98,7 @@ def is_scheme_https(url):
     Test the scheme of the parameter URL to see if it is HTTPS. If
     it is HTTPS return ``True``, otherwise return ``False``.
     """
-    return 'https' == urlparse(url).scheme
+    return 'https' == get_service_url(url).scheme
 
 
 def clean_service_url(url):
@@ -45,8 +106,7 @@ def clean_service_url(url):
     Return only the scheme, hostname (with optional port) and path
     components of the parameter URL.
     """
-    parts = urlparse(url)
-    return urlunparse((parts.scheme, parts.netloc, parts.path, '', '', ''))
+    return get_service_url(url).clean
 
 
 def match_service(service1, service2):
@@ -54,9 +114,8 @@ def match_service(service1, service2):
     Compare two service URLs. Return ``True`` if the scheme, hostname,
     optional port and path match.
     """
-    s1, s2 = urlparse(service1), urlparse(service2)
     try:
-        return (s1.scheme, s1.netloc, s1.path) == (s2.scheme, s2.netloc, s2.path)
+        return get_service_url(service1).key == get_service_url(service2).key
     except ValueError:
         return False
 
@@ -66,16 +125,20 @@ def redirect(to, *args, **kwargs):
     Similar to the Django ``redirect`` shortcut but with altered
     functionality. If an optional ``params`` argument is provided, the
     dictionary items will be injected as query parameters on the
-    redirection URL.
+    redirection URL. A ``ServiceContext`` may be provided in place of
+    a service URL.
     """
     params = kwargs.pop('params', {})
+    service = to
+    if isinstance(to, ServiceContext):
+        to = to.service
 
     try:
         to = reverse(to, args=args, kwargs=kwargs)
     except NoReverseMatch:
         if '/' not in to and '.' not in to:
             to = reverse('cas_login')
-        elif not service_allowed(to):
+        elif not service_allowed(service):
             raise PermissionDenied()
 
     if params:
@@ -85,6 +148,14 @@ def redirect(to, *args, **kwargs):
     return HttpResponseRedirect(to)
 
 
+def get_cache():
+    """
+    Return the cache used for transient CAS state, as configured by
+    ``MAMA_CAS_CACHE``.
+    """
+    return caches[getattr(settings, 'MAMA_CAS_CACHE', 'default')]
+
+
 def to_bool(str):
     """
     Converts a given string to a boolean value. Leading and trailing
@@ -1,30 +1,43 @@
+import json
 import logging
 
 from django.conf import settings
 from django.contrib import messages
 from django.contrib.auth import login
 from django.http import HttpResponse
+from django.http import JsonResponse
+from django.utils.decorators import method_decorator
 from django.utils.translation import gettext as _
+from django.views.decorators.csrf import csrf_exempt
 from django.views.generic import FormView
 from django.views.generic import TemplateView
 from django.views.generic import View
 
+from mama_cas.attributes import prefetch_attributes
+from mama_cas.attributes import record_service
 from mama_cas.compat import defused_etree
+from mama_cas.exceptions import InvalidRequest
 from mama_cas.exceptions import ValidationError
 from mama_cas.forms import LoginForm
 from mama_cas.mixins import CasResponseMixin
 from mama_cas.mixins import CsrfProtectMixin
 from mama_cas.mixins import LoginRequiredMixin
+from mama_cas.mixins import ValidationReplayMixin
 from mama_cas.cas import logout_user
 from mama_cas.cas import validate_service_ticket
+from mama_cas.cas import validate_service_tickets
 from mama_cas.cas import validate_proxy_ticket
 from mama_cas.cas import validate_proxy_granting_ticket
 from mama_cas.mixins import NeverCacheMixin
 from mama_cas.models import ProxyTicket
 from mama_cas.models import ServiceTicket
+from mama_cas.response import BatchValidationResponse
+from mama_cas.response import JsonProxyResponse
+from mama_cas.response import JsonValidationResponse
 from mama_cas.response import ValidationResponse
 from mama_cas.response import ProxyResponse
 from mama_cas.response import SamlValidationResponse
+from mama_cas.services import get_service_context
 from mama_cas.services import service_allowed
 from mama_cas.utils import add_query_params
 from mama_cas.utils import clean_service_url
@@ -79,7 +92,7 @@ class LoginView(CsrfProtectMixin, NeverCacheMixin, FormView):
            Otherwise, the user remains logged out and is forwarded to
            the specified service.
         """
-        service = request.GET.get('service')
+        service = get_service_context(request.GET.get('service'))
         renew = to_bool(request.GET.get('renew'))
         gateway = to_bool(request.GET.get('gateway'))
 
@@ -89,6 +102,7 @@ class LoginView(CsrfProtectMixin, NeverCacheMixin, FormView):
             logger.debug("Gateway request received by credential requestor")
             if request.user.is_authenticated:
                 st = ServiceTicket.objects.create_ticket(service=service, user=request.user)
+                record_service(request.user, service)
                 if self.warn_user():
                     return redirect('cas_warn', params={'service': service, 'ticket': st.ticket})
                 return redirect(service, params={'ticket': st.ticket})
@@ -98,6 +112,7 @@ class LoginView(CsrfProtectMixin, NeverCacheMixin, FormView):
             if service:
                 logger.debug("Service ticket request received by credential requestor")
                 st = ServiceTicket.objects.create_ticket(service=service, user=request.user)
+                record_service(request.user, service)
                 if self.warn_user():
                     return redirect('cas_warn', params={'service': service, 'ticket': st.ticket})
                 return redirect(service, params={'ticket': st.ticket})
@@ -142,7 +157,8 @@ class LoginView(CsrfProtectMixin, NeverCacheMixin, FormView):
         if form.cleaned_data.get('warn'):
             self.request.session['warn'] = True
 
-        service = self.request.GET.get('service')
+        service = get_service_context(self.request.GET.get('service'))
+        prefetch_attributes(self.request.user, service)
         if service:
             st = ServiceTicket.objects.create_ticket(service=service, user=self.request.user, primary=True)
             return redirect(service, params={'ticket': st.ticket})
@@ -158,7 +174,7 @@ class WarnView(NeverCacheMixin, LoginRequiredMixin, TemplateView):
     template_name = warn_view_template_name
 
     def get(self, request, *args, **kwargs):
-        service = request.GET.get('service')
+        service = get_service_context(request.GET.get('service'))
         ticket = request.GET.get('ticket')
 
         if not service_allowed(service):
@@ -194,7 +210,7 @@ class LogoutView(NeverCacheMixin, View):
         follow_url = getattr(settings, 'MAMA_CAS_FOLLOW_LOGOUT_URL', True)
         logout_user(request)
         if service and follow_url:
-            return redirect(service)
+            return redirect(get_service_context(service))
         return redirect('cas_login')
 
 
@@ -225,7 +241,7 @@ class ValidateView(NeverCacheMixin, View):
         return HttpResponse(content=content, content_type='text/plain')
 
 
-class ServiceValidateView(NeverCacheMixin, CasResponseMixin, View):
+class ServiceValidateView(NeverCacheMixin, ValidationReplayMixin, CasResponseMixin, View):
     """
     (2.5) Check the validity of a service ticket. [CAS 2.0]
 
@@ -242,8 +258,12 @@ class ServiceValidateView(NeverCacheMixin, CasResponseMixin, View):
     If ``pgtUrl`` is specified, the response will include a
     ``ProxyGrantingTicket`` if the proxy callback URL has a valid SSL
     certificate and responds with a successful HTTP status code.
+
+    If ``format`` is ``JSON``, the response is a JSON document instead.
+    [CAS 3.0]
     """
     response_class = ValidationResponse
+    json_response_class = JsonValidationResponse
 
     def get_context_data(self, **kwargs):
         service = self.request.GET.get('service')
@@ -259,7 +279,60 @@ class ServiceValidateView(NeverCacheMixin, CasResponseMixin, View):
             return {'ticket': None, 'error': e}
 
 
-class ProxyValidateView(NeverCacheMixin, CasResponseMixin, View):
+@method_decorator(csrf_exempt, name='dispatch')
+class BatchValidateView(NeverCacheMixin, View):
+    """
+    Check the validity of several service tickets in one request.
+
+    Expects a HTTP POST with a JSON array of ``[ticket, service]``
+    pairs, and responds with a JSON document containing a validation
+    success or failure for each pair, in order. Each ticket is validated
+    and consumed exactly as by ``ServiceValidateView``, and at most
+    ``MAMA_CAS_BATCH_VALIDATE_LIMIT`` tickets are accepted.
+
+    If ``renew`` is specified, it applies to every ticket.
+    """
+    response_class = BatchValidationResponse
+
+    def post(self, request, *args, **kwargs):
+        try:
+            items = self.get_items()
+        except InvalidRequest as e:
+            logger.warning("%s %s" % (e.code, e))
+            return JsonResponse({'error': {'code': e.code, 'description': str(e)}}, status=400)
+        renew = to_bool(request.GET.get('renew'))
+
+        contexts = []
+        for result in validate_service_tickets(items, renew=renew):
+            if isinstance(result, ValidationError):
+                logger.warning("%s %s" % (result.code, result))
+                contexts.append({'ticket': None, 'error': result})
+            else:
+                st, attributes = result
+                contexts.append({'ticket': st, 'attributes': attributes, 'error': None})
+        return self.response_class(contexts)
+
+    def get_items(self):
+        try:
+            items = json.loads(self.request.body)
+        except ValueError:
+            raise InvalidRequest("Request body is not valid JSON")
+
+        if not isinstance(items, list):
+            raise InvalidRequest("Request body must be a list of [ticket, service] pairs")
+        for item in items:
+            if not isinstance(item, list) or len(item) != 2:
+                raise InvalidRequest("Request body must be a list of [ticket, service] pairs")
+            if not all(value is None or isinstance(value, str) for value in item):
+                raise InvalidRequest("Ticket and service must be strings")
+
+        limit = getattr(settings, 'MAMA_CAS_BATCH_VALIDATE_LIMIT', 100)
+        if len(items) > limit:
+            raise InvalidRequest("At most %d tickets may be validated in one request" % limit)
+        return [tuple(item) for item in items]
+
+
+class ProxyValidateView(NeverCacheMixin, ValidationReplayMixin, CasResponseMixin, View):
     """
     (2.6) Perform the same validation tasks as ServiceValidateView and
     additionally validate proxy tickets. [CAS 2.0]
@@ -277,8 +350,12 @@ class ProxyValidateView(NeverCacheMixin, CasResponseMixin, View):
     If ``pgtUrl`` is specified, the response will include a
     ``ProxyGrantingTicket`` if the proxy callback URL has a valid SSL
     certificate and responds with a successful HTTP status code.
+
+    If ``format`` is ``JSON``, the response is a JSON document instead.
+    [CAS 3.0]
     """
     response_class = ValidationResponse
+    json_response_class = JsonValidationResponse
 
     def get_context_data(self, **kwargs):
         service = self.request.GET.get('service')
@@ -310,8 +387,12 @@ class ProxyView(NeverCacheMixin, CasResponseMixin, View):
     ``ProxyGrantingTicket`` validation success or failure. If
     validation succeeds, a ``ProxyTicket`` will be created and included
     in the response.
+
+    If ``format`` is ``JSON``, the response is a JSON document instead.
+    [CAS 3.0]
     """
     response_class = ProxyResponse
+    json_response_class = JsonProxyResponse
 
     def get_context_data(self, **kwargs):
         pgt = self.request.GET.get('pgt')
@@ -338,7 +419,12 @@ class SamlValidateView(NeverCacheMixin, View):
         return self.render_to_response(context)
 
     def render_to_response(self, context):
-        return self.response_class(context, content_type=self.content_type)
+        try:
+            return self.response_class(context, content_type=self.content_type)
+        except ValidationError as e:
+            logger.warning("%s %s" % (e.code, e))
+            context.update({'ticket': None, 'error': e})
+            return self.response_class(context, content_type=self.content_type)
 
     def get_context_data(self, **kwargs):
         target = self.request.GET.get('TARGET')